@@ -1,166 +1,251 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-from matplotlib import cm
-from matplotlib.animation import FuncAnimation
+import collections
+import itertools
+import threading
+
+# Marker of blocked cells in snapshot action grids (-1 is END)
+BLOCKED = -2
+
+
+def take_snapshot(env, agent, label):
+    """
+    Return a compact snapshot (label, values, actions) of agent "Mario"'s current state values and policy:
+        values: (ydim, xdim) float32 grid, NaN for blocked cells
+        actions: (ydim, xdim) int8 grid of action indices into env.action_space, -1 for END, BLOCKED for blocked cells
+    """
+    if getattr(agent, 'storage', 'dict') == 'array':
+        agent.sync_layout()
+        values = np.where(agent.valid_mask, agent.value_grid, np.nan).astype(np.float32)
+        actions = np.where(agent.valid_mask, agent.action_grid, BLOCKED).astype(np.int8)
+        return label, values, actions
+    values = np.full((env.ydim, env.xdim), np.nan, dtype=np.float32)
+    actions = np.full((env.ydim, env.xdim), BLOCKED, dtype=np.int8)
+    action_index = {action: a for a, action in enumerate(env.action_space)}
+    for (i,j), value in agent.state_values.items():
+        values[j-1, i-1] = value
+    for (i,j), (action, name) in agent.policy.items():
+        # END is told apart by name, the 'stay' action is (0,0) as well (see "PolicyView" in mario.py)
+        actions[j-1, i-1] = -1 if name == 'END' else action_index.get(tuple(action), -1)
+    return label, values, actions
+
+
+class SnapshotQueue:
+    def __init__(self, maxsize=64, block=False):
+        """
+        Bounded queue of snapshots between the solver thread (producer) and the renderer (consumer)
+        Arguments:
+            maxsize: maximum number of pending snapshots
+            block: False --> "put" never waits, the oldest pending snapshot is dropped when full (the solver never stalls)
+                   True --> "put" waits for free space (every snapshot is rendered)
+        """
+        self.items = collections.deque()
+        self.maxsize = maxsize
+        self.block = block
+        self.dropped = 0
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def put(self, snapshot):
+        with self.condition:
+            while self.block and len(self.items) >= self.maxsize:
+                self.condition.wait()
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(snapshot)
+            self.condition.notify_all()
+
+    def close(self, error=None):
+        """Mark the end of the stream (optionally with the exception raised by the producer)"""
+        with self.condition:
+            self.closed = True
+            self.error = error
+            self.condition.notify_all()
+
+    def __iter__(self):
+        """Yield snapshots until the producer closes the queue"""
+        while True:
+            with self.condition:
+                while not self.items and not self.closed:
+                    self.condition.wait()
+                if self.items:
+                    snapshot = self.items.popleft()
+                    self.condition.notify_all()
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield snapshot
+
 
 class Animation:
-    def __init__(self, env, agent, gen, filename):
+    def __init__(self, env, agent, gen, filename, maxsize=None, block=False, annotate=None, snapshots=None):
+        """
+        Arguments:
+            env: object of class "GridWorld"
+            agent: object of class "Mario" updated by the solver
+            gen: solver generator (e.g. Iter.by_value_iter(anim=True)), yields a frame label after every iteration
+            filename: name of the gif file (without extension)
+            maxsize, block: snapshot queue between solver and renderer (see "SnapshotQueue"),
+                default maxsize keeps about 64 MB of pending snapshots
+            annotate: write values and action names into the cells (default: only for grids of at most 400 cells)
+            snapshots: iterable of recorded snapshots to render instead of running gen (agent and gen may then be None),
+                e.g. TrajectoryReader.snapshots() in recorder.py
+        The solver runs on its own thread and pushes snapshots, the renderer (main thread) encodes them as they come
+        matplotlib is only imported here, so importing this module (e.g. for "take_snapshot" or BLOCKED) stays cheap
+        """
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as colors
+        from matplotlib import cm
         self.env = env
         self.agent = agent
         self.root_gen = gen
         self.filename = filename
+        self.snapshots = snapshots
+        if maxsize is None:
+            maxsize = max(16, (64 << 20) // (5*env.xdim*env.ydim)) # float32 value + int8 action per cell
+        self.queue = SnapshotQueue(maxsize, block)
+        self.annotate = annotate if annotate is not None else env.xdim*env.ydim <= 400
+        self.actions = np.array(list(env.action_space), dtype=np.float64).reshape(-1, 2)
+        self.action_names = list(env.action_space.values())
 
         # Create the figure and axis
         self.fig, (self.ax1, self.ax2) = plt.subplots(1, 2, figsize=(10,6), layout='constrained')
         self.fig.set_constrained_layout_pads(w_pad=0.04, h_pad=0.3, wspace=0, hspace=0)
         self.set_axis(self.ax1, 'State Values')
         self.set_axis(self.ax2, 'Policy')
+        self.title = self.fig.suptitle('', fontsize=30)
 
-        # Create the grid of text elements
+        # Artists are created once and updated in place for every frame
+        cmap = cm.coolwarm(range(256))
+        cmap[0,] = np.array([0., 0., 0., 0.]) # New colormap with vmin set to white
+        empty = np.zeros((self.env.ydim, self.env.xdim))
+        self.value_image = self.ax1.imshow(
+            empty, colors.ListedColormap(cmap), colors.Normalize(vmin=-1, vmax=1), animated=True
+            )
+        self.policy_image = self.ax2.imshow(
+            empty, colors.ListedColormap(['white','grey','dodgerblue']), colors.BoundaryNorm([-1,0,0.5,1], 3), animated=True
+            )
+        xs, ys = np.meshgrid(np.arange(self.env.xdim), np.arange(self.env.ydim))
+        self.arrows = self.ax2.quiver(
+            xs, ys, empty, empty,
+            scale_units='xy', angles='xy', scale=2, minlength=0,
+            color='indianred', width=0.1, headaxislength=5, headwidth=5, animated=True
+            )
         self.grid_state_values = np.empty((self.env.ydim, self.env.xdim), dtype=object)
-        for j in range(self.env.ydim, 0, -1):
-            for i in range(1, self.env.xdim+1):
-                if (i,j) in self.agent.state_values:
-                    self.grid_state_values[self.env.ydim-j, i-1] = self.ax1.text(
-                        i-1,j-1, 
-                        "{:.3f}".format(self.agent.state_values[(i,j)]), 
-                        ha='center', va='center', fontsize=20
-                        )
-                else:
-                    self.grid_state_values[self.env.ydim-j, i-1] = self.ax1.text(
-                        i-1,j-1, 
-                        '', 
-                        ha='center', va='center', fontsize=20
-                        )
         self.grid_policy = np.empty((self.env.ydim, self.env.xdim), dtype=object)
-        for j in range(self.env.ydim, 0, -1):
-            for i in range(1, self.env.xdim+1):
-                if (i,j) in self.agent.policy:
-                    _, action_name = self.agent.policy[(i,j)]
-                    self.grid_policy[self.env.ydim-j, i-1] = self.ax2.text(
-                        i-1,j-1, 
-                        action_name, 
-                        ha='center', va='center', fontsize=20
-                        )
-                else:
-                    self.grid_policy[self.env.ydim-j, i-1] = self.ax2.text(
-                        i-1,j-1, 
-                        '', 
-                        ha='center', va='center', fontsize=20
-                        )
-
-    def animate(self):
-        # Set up the animation
+        if self.annotate:
+            for j in range(self.env.ydim):
+                for i in range(self.env.xdim):
+                    self.grid_state_values[j, i] = self.ax1.text(i, j, '', ha='center', va='center', fontsize=20, animated=True)
+                    self.grid_policy[j, i] = self.ax2.text(i, j, '', ha='center', va='center', fontsize=20, animated=True)
+        # last rendered grids --> only cells that changed are redrawn
+        self.shown_values = None
+        self.shown_actions = None
+        self.initial = None
+
+    def solve(self):
+        """Producer: run the solver generator and push a snapshot after every iteration"""
+        try:
+            for frame in self.root_gen:
+                self.queue.put(take_snapshot(self.env, self.agent, frame))
+        except BaseException as error:
+            self.queue.close(error)
+        else:
+            self.queue.close()
+
+    def animate(self, fps=0.5, blit=True):
+        from matplotlib.animation import FuncAnimation
+        if self.snapshots is not None:
+            # Replay: no solver, the first recorded snapshot is also the initial frame
+            frames = iter(self.snapshots)
+            self.initial = next(frames, None)
+            if self.initial is None:
+                return
+            frames = itertools.chain([self.initial], frames)
+            solver = None
+        else:
+            # Start the solver (after the initial snapshot) and set up the animation
+            self.initial = take_snapshot(self.env, self.agent, 'Initialization')
+            solver = threading.Thread(target=self.solve, daemon=True)
+            solver.start()
+            frames = iter(self.queue)
         self.ani = FuncAnimation(
-            self.fig, self.update_value_policy, 
-            frames=self.root_gen,
-            init_func=self.init_value_policy, 
-            save_count=10000,
-            interval=2000, repeat=False
+            self.fig, self.update_value_policy,
+            frames=frames,
+            init_func=self.init_value_policy,
+            save_count=10000, cache_frame_data=False,
+            interval=2000, repeat=False, blit=blit
             )
-        # self.ax1.grid(True, linewidth = 2)
-        # self.ax2.grid(True, linewidth = 2)
-        self.ani.save('{}.gif'.format(self.filename), writer='Pillow', fps=0.5,)
+        self.ani.save('{}.gif'.format(self.filename), writer='pillow', fps=fps)
+        if solver is not None:
+            solver.join()
         # Show the animation
         # plt.show()
 
     def init_value_policy(self):
-        self.fig.suptitle(f'Initialization', fontsize =30)
-        # ax1 - state values
-        for j in range(self.env.ydim, 0, -1):
-            for i in range(1, self.env.xdim+1):
-                if (i,j) in self.agent.state_values:
-                    self.grid_state_values[self.env.ydim-j, i-1].set_text("{:.3f}".format(0))
-                else:
-                    self.grid_state_values[self.env.ydim-j, i-1].set_text('')
-        
-        # ax2 - policy
-        for j in range(self.env.ydim, 0, -1):
-            for i in range(1, self.env.xdim+1):
-                if (i,j) in self.agent.policy:
-                    _, action_name = self.agent.policy[(i,j)]
-                    self.grid_policy[self.env.ydim-j, i-1].set_text(action_name)
-                else:
-                    self.grid_policy[self.env.ydim-j, i-1].set_text('')
-        self.color_policy()
-
+        self.shown_values = None
+        self.shown_actions = None
+        return self.update_value_policy(self.initial)
 
-    def update_value_policy(self, frame):
-        self.fig.suptitle(f'{frame}', fontsize =30)
-        # ax1 - state value
-        for j in range(self.env.ydim, 0, -1):
-            for i in range(1, self.env.xdim+1):
-                if (i,j) in self.agent.state_values:
-                    self.grid_state_values[self.env.ydim-j, i-1].set_text("{:.3f}".format(self.agent.state_values[(i,j)]))
-                else:
-                    self.grid_state_values[self.env.ydim-j, i-1].set_text('')
-
-        # ax2 - policy
-        for j in range(self.env.ydim, 0, -1):
-            for i in range(1, self.env.xdim+1):
-                if (i,j) in self.agent.policy:
-                    _, action_name = self.agent.policy[(i,j)]
-                    self.grid_policy[self.env.ydim-j, i-1].set_text(action_name)
-                else:
-                    self.grid_policy[self.env.ydim-j, i-1].set_text('')
-        self.color_policy()
+    def update_value_policy(self, snapshot):
+        label, values, actions = snapshot
+        self.title.set_text(f'{label}')
+        changed = []
+        # ax1 - state values
+        self.value_image.set_data(np.nan_to_num(values, nan=-1))
+        changed.append(self.value_image)
+        # ax2 - policy and greedy path from (1,1)
+        path, arrows_u, arrows_v = self.greedy_path(actions)
+        self.policy_image.set_data(np.where(actions == BLOCKED, -1, path).astype(np.float64))
+        self.arrows.set_UVC(arrows_u, arrows_v)
+        changed += [self.policy_image, self.arrows]
+        if self.annotate:
+            changed += self.update_text(values, actions)
+        self.shown_values, self.shown_actions = values, actions
+        return changed
 
-    def color_policy(self):
-        values, policy, arrows = self.get_data()
+    def update_text(self, values, actions):
+        """Helper function: rewrite the text of cells whose displayed value or action changed, return those artists"""
+        changed = []
+        rounded = np.round(values, 3)
+        if self.shown_values is None:
+            value_cells = policy_cells = np.ones(values.shape, dtype=bool)
+        else:
+            # NaN != NaN --> compare with equal_nan semantics
+            value_cells = ~((rounded == np.round(self.shown_values, 3)) | (np.isnan(rounded) & np.isnan(self.shown_values)))
+            policy_cells = actions != self.shown_actions
+        for j, i in zip(*np.nonzero(value_cells)):
+            text = self.grid_state_values[j, i]
+            text.set_text('' if np.isnan(values[j, i]) else "{:.3f}".format(values[j, i]))
+            changed.append(text)
+        for j, i in zip(*np.nonzero(policy_cells)):
+            a = actions[j, i]
+            text = self.grid_policy[j, i]
+            text.set_text('' if a == BLOCKED else 'END' if a < 0 else self.action_names[a])
+            changed.append(text)
+        return changed
 
-        # New colormap with vmin set to white
-        cmap = cm.coolwarm(range(256))
-        cmap[0,] = np.array([0., 0., 0., 0.])
-
-        cmap = colors.ListedColormap(cmap)
-        norm = colors.Normalize(vmin =-1, vmax =1)
-        self.ax1.imshow(values, cmap, norm)
-
-        cmap = colors.ListedColormap(['white','grey','dodgerblue'])
-        norm = colors.BoundaryNorm([-1,0,0.5,1], cmap.N)
-        self.ax2.imshow(policy, cmap, norm)
-        x, y = zip(*arrows)
-        x = np.array(x)
-        y = np.array(y)
-        self.ax2.quiver(
-            x[:-1], y[:-1], x[1:]-x[:-1], y[1:]-y[:-1], 
-            scale_units='xy', angles='xy', scale=2,
-            color='indianred', width=0.1, headaxislength=5, headwidth=5
-            )
-
-    def get_data(self):
-        xdim = self.env.xdim
-        ydim = self.env.ydim
-        policy = np.zeros((ydim, xdim))
-        values = np.empty((ydim, xdim))
-        arrows = []
-
-        for j in range(ydim, 0, -1):
-            for i in range(1, xdim+1):
-                if (i,j) in self.env.valid_states:
-                    values[j-1, i-1] = self.agent.state_values[(i,j)]
-                else:
-                    values[j-1, i-1] = -1
-        for (i,j) in self.env.blocked_states:
-            policy[j-1, i-1] = -1
-
-        goto = (1,1)
-        action_name = 'down'
-        iter = 0
-        while action_name != 'END': # and iter < xdim*ydim:
-            iter += 1
-            x,y = goto
-            arrows.append((x-1,y-1))
-            policy[y-1, x-1] = 1
-            action, action_name = self.agent.policy[goto]
-            new_state = tuple(map(sum, zip(goto, action)))
-            if new_state in self.env.valid_states:
-                goto = new_state
-            else:
-                # arrows.append((x-1,y-1))
+    def greedy_path(self, actions):
+        """
+        Follow the greedy policy from (1,1) until END, a blocked/out of bounds move or a repeated cell
+        Return the (ydim, xdim) path mask and per-cell arrow components towards the next cell of the path
+        """
+        path = np.zeros(actions.shape)
+        arrows_u = np.zeros(actions.shape)
+        arrows_v = np.zeros(actions.shape)
+        x, y = 0, 0
+        while actions[y, x] >= 0 and path[y, x] == 0:
+            path[y, x] = 1
+            dx, dy = self.actions[actions[y, x]].astype(int)
+            new_x, new_y = x + dx, y + dy
+            if not (0 <= new_x < self.env.xdim and 0 <= new_y < self.env.ydim) or actions[new_y, new_x] == BLOCKED:
                 break
-        return values, policy, arrows
+            arrows_u[y, x], arrows_v[y, x] = dx, dy
+            x, y = new_x, new_y
+        path[y, x] = 1 if actions[y, x] != BLOCKED else 0
+        return path, arrows_u, arrows_v
 
     def set_axis(self, ax, title):
         ax.set_xlim(-0.5, self.env.xdim - 0.5)
@@ -174,4 +259,4 @@ class Animation:
         ax.xaxis.set_ticks_position('none')
         ax.yaxis.set_ticks_position('none')
         for loc in ["top", "bottom", "left", "right"]:
-            ax.spines[loc].set_linewidth(2)
\ No newline at end of file
+            ax.spines[loc].set_linewidth(2)
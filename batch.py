@@ -0,0 +1,264 @@
+from grid_world import GridWorld
+from mario import Mario
+from iter_schemes import Iter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import itertools
+import json
+import os
+import time
+import numpy as np
+
+# Defaults of a single configuration (same as the defaults of GridWorld, Mario and Iter)
+DEFAULT_CONFIG = {
+    'x': 4,
+    'y': 3,
+    'blocked_states': [(2,2)],
+    'end_states': [(4,3),(4,2)],
+    'controller_reliability': 0.8,
+    'actions': '4', # action set, see ACTION_SETS in grid_world.py
+    'slip': 'perpendicular', # slip kernel, see SLIP_KERNELS in grid_world.py
+    'stay': False,
+    'gamma': 0.9,
+    'reward_dict': {(4,2): -1, (4,3): 1},
+    'other_states': 0.0,
+    'transition_reward': 0.0,
+    'method': 'value_iter', # 'value_iter' or 'policy_iter'
+    'evaluation': 'iterative', # policy evaluation mode for 'policy_iter', see Iter.by_policy_iter
+    'tol': 0.000001,
+}
+
+# Columns of the result file: one row per solved configuration
+SCALAR_COLUMNS = {'index': np.int64, 'n_states': np.int64, 'iterations': np.int64, 'epochs': np.int64, 'wall_time': np.float64}
+ARRAY_COLUMNS = {'values': np.float64, 'policy': np.int8} # flattened, row i spans offsets[i]:offsets[i+1]
+
+
+def move_pairs(value):
+    """Return a named action set / slip kernel as is, a dict or list of [move, value] pairs as a sorted tuple of pairs"""
+    if isinstance(value, str):
+        return value
+    items = value.items() if isinstance(value, dict) else value
+    return tuple(sorted((tuple(move), item) for move, item in items))
+
+
+def normalize_config(config):
+    """
+    Fill in defaults and convert JSON friendly containers (lists) to the tuples used by GridWorld
+        reward_dict may be a dict keyed by states or a list of [state, reward] pairs
+        actions and slip may be a name, a dict keyed by moves or a list of [move, value] pairs; the latter two
+        become sorted tuples of pairs, so that "topology_key" can hash them (custom actions are indexed in this order)
+    """
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f'Unknown configuration keys: {sorted(unknown)}')
+    config = {**DEFAULT_CONFIG, **config}
+    config['blocked_states'] = [tuple(state) for state in config['blocked_states']]
+    config['end_states'] = [tuple(state) for state in config['end_states']]
+    reward_items = config['reward_dict'].items() if isinstance(config['reward_dict'], dict) else config['reward_dict']
+    config['reward_dict'] = {tuple(state): reward for state, reward in reward_items}
+    config['actions'] = move_pairs(config['actions'])
+    config['slip'] = move_pairs(config['slip'])
+    return config
+
+
+def expand_grid(base=None, sweep=None):
+    """
+    Return the list of configurations of a parameter grid
+        base: configuration shared by all solves
+        sweep: {key = configuration key: value = list of values}, the cartesian product is taken over all keys
+    """
+    base = base or {}
+    sweep = sweep or {}
+    keys = list(sweep)
+    return [
+        normalize_config({**base, **dict(zip(keys, values))})
+        for values in itertools.product(*(sweep[key] for key in keys))
+    ]
+
+
+def topology_key(config):
+    """Configurations with the same key share one compiled transition structure"""
+    return (
+        config['x'], config['y'], tuple(config['blocked_states']), tuple(config['end_states']),
+        config['actions'], config['slip'], config['stay'],
+    )
+
+
+def make_chunks(configs, chunksize):
+    """
+    Group (index, config) pairs by grid topology and split every group into chunks of at most chunksize,
+    so that a worker compiles the transition structure of a topology once per chunk
+    """
+    groups = {}
+    for index, config in enumerate(configs):
+        groups.setdefault(topology_key(config), []).append((index, config))
+    chunks = []
+    for group in groups.values():
+        # sort by reliability so that consecutive solves only reweight the probabilities
+        group.sort(key=lambda item: item[1]['controller_reliability'])
+        chunks.extend(group[i:i+chunksize] for i in range(0, len(group), chunksize))
+    return chunks
+
+
+def as_dict(value):
+    """Inverse of "move_pairs" for GridWorld: names stay names, tuples of pairs become dicts"""
+    return value if isinstance(value, str) else dict(value)
+
+
+def solve_chunk(chunk):
+    """Solve a chunk of (index, config) pairs sharing one topology and return the list of results"""
+    results = []
+    env = None
+    for index, config in chunk:
+        start = time.perf_counter()
+        if env is None:
+            env = GridWorld(
+                config['x'], config['y'], config['blocked_states'], config['end_states'], config['controller_reliability'],
+                as_dict(config['actions']), as_dict(config['slip']), config['stay'],
+            )
+        env.prob = config['controller_reliability'] # reuses the compiled structure (see GridWorld.model)
+        env.set_rewards(config['reward_dict'], config['other_states'], config['transition_reward'])
+        agent = Mario(env=env, gamma=config['gamma'])
+        learn = Iter(env=env, agent=agent, tol=config['tol'], write_back=False, quiet=True)
+        if config['method'] == 'value_iter':
+            for _ in learn.by_value_iter():
+                pass
+        elif config['method'] == 'policy_iter':
+            for _ in learn.by_policy_iter(evaluation=config['evaluation']):
+                pass
+        else:
+            raise ValueError(f"Unknown method '{config['method']}', expected 'value_iter' or 'policy_iter'")
+        results.append({
+            'index': index,
+            'n_states': len(learn.values),
+            'iterations': learn.iterations,
+            'epochs': learn.epochs,
+            'wall_time': time.perf_counter() - start,
+            'values': learn.values,
+            'policy': learn.policy_index.astype(np.int8),
+        })
+    return results
+
+
+def iter_solve_batch(configs, max_workers=None, chunksize=16):
+    """
+    Solve many configurations over a process pool
+    Yield one result dict per configuration as soon as its chunk finishes (in completion order, see result['index'])
+        configs: list of configurations (see "DEFAULT_CONFIG", "expand_grid")
+        max_workers: number of worker processes (default: number of CPUs)
+        chunksize: maximum number of configurations sent to a worker at once
+    """
+    configs = [normalize_config(config) for config in configs]
+    chunks = make_chunks(configs, chunksize)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(solve_chunk, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+class ResultWriter:
+    def __init__(self, path):
+        """
+        Columnar result file: one raw binary file per column in directory "path", appended as results stream in
+        Arguments:
+            path: output directory (created if missing)
+        Column dtypes and the row count are written to meta.json on close (see "load_results")
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.rows = 0
+        self.files = {
+            name: open(os.path.join(path, f'{name}.bin'), 'wb')
+            for name in list(SCALAR_COLUMNS) + list(ARRAY_COLUMNS)
+        }
+
+    def append(self, result):
+        for name, dtype in SCALAR_COLUMNS.items():
+            self.files[name].write(np.asarray(result[name], dtype=dtype).tobytes())
+        for name, dtype in ARRAY_COLUMNS.items():
+            self.files[name].write(np.ascontiguousarray(result[name], dtype=dtype).tobytes())
+        self.rows += 1
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        meta = {
+            'rows': self.rows,
+            'columns': {name: np.dtype(dtype).str for name, dtype in {**SCALAR_COLUMNS, **ARRAY_COLUMNS}.items()},
+            'array_columns': list(ARRAY_COLUMNS),
+        }
+        with open(os.path.join(self.path, 'meta.json'), 'w') as file:
+            json.dump(meta, file, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_results(path):
+    """
+    Read a result directory written by "ResultWriter" as memory-mapped columns
+    Returns a dict of arrays plus 'offsets', so that row i of an array column is column[offsets[i]:offsets[i+1]]
+    """
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    columns = {}
+    for name, dtype in meta['columns'].items():
+        file_name = os.path.join(path, f'{name}.bin')
+        columns[name] = np.memmap(file_name, dtype=dtype, mode='r') if os.path.getsize(file_name) else np.empty(0, dtype)
+    columns['offsets'] = np.concatenate([[0], np.cumsum(columns['n_states'])])
+    return columns
+
+
+def solve_batch(configs, path, max_workers=None, chunksize=16, configs_file=True):
+    """
+    Solve many configurations over a process pool and stream the results into the columnar file at "path"
+    Returns the number of solved configurations
+    """
+    configs = [normalize_config(config) for config in configs]
+    with ResultWriter(path) as writer:
+        if configs_file:
+            with open(os.path.join(path, 'configs.json'), 'w') as file:
+                json.dump([
+                    # tuples of pairs (reward_dict items, custom actions and slip) are written as lists of [move, value]
+                    {**config, 'reward_dict': [[state, reward] for state, reward in config['reward_dict'].items()]}
+                    for config in configs
+                ], file)
+        for result in iter_solve_batch(configs, max_workers, chunksize):
+            writer.append(result)
+    return writer.rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Solve a grid of GridWorld configurations over a process pool')
+    parser.add_argument('--config', help='JSON file {"base": {...}, "sweep": {key: [values]}} (see DEFAULT_CONFIG)')
+    parser.add_argument('--gamma', type=float, nargs='+', help='sweep over these discount factors')
+    parser.add_argument('--reliability', type=float, nargs='+', help='sweep over these controller reliabilities')
+    parser.add_argument('--method', choices=['value_iter', 'policy_iter'], help='iteration scheme for all solves')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPUs)')
+    parser.add_argument('--chunksize', type=int, default=16, help='configurations per task sent to a worker')
+    parser.add_argument('--out', default='batch_results', help='output directory of the columnar result file')
+    args = parser.parse_args(argv)
+
+    base, sweep = {}, {}
+    if args.config:
+        with open(args.config) as file:
+            spec = json.load(file)
+        base, sweep = spec.get('base', {}), spec.get('sweep', {})
+    if args.gamma:
+        sweep['gamma'] = args.gamma
+    if args.reliability:
+        sweep['controller_reliability'] = args.reliability
+    if args.method:
+        base['method'] = args.method
+    configs = expand_grid(base, sweep)
+
+    start = time.perf_counter()
+    rows = solve_batch(configs, args.out, args.workers, args.chunksize)
+    print(f'*** Solved {rows} configurations in {time.perf_counter() - start:.2f}s --> {args.out} ***')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+from grid_world import GridWorld
+from mario import Mario
+from iter_schemes import Iter
+from parallel import SweepExecutor
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+# Solvers timed by the suite: name --> (method, keyword arguments, largest grid (in cells) it is run on)
+SOLVERS = {
+    'value_iter': ('value_iter', {'sweep': 'synchronous'}, None),
+    'value_iter_gauss_seidel': ('value_iter', {'sweep': 'gauss_seidel'}, None),
+    'value_iter_parallel': ('value_iter', {'sweep': 'synchronous', 'workers': None}, None),
+    'value_iter_prioritized': ('value_iter', {'sweep': 'prioritized'}, 10000),
+    'policy_iter': ('policy_iter', {'evaluation': 'iterative'}, 250000),
+    'policy_iter_exact': ('policy_iter', {'evaluation': 'exact'}, 250000),
+    'policy_iter_modified': ('policy_iter', {'evaluation': 'modified', 'sweeps': 20}, None),
+    'value_iter_dict': ('value_iter', {'backend': 'dict'}, 2500),
+    'policy_iter_dict': ('policy_iter', {'backend': 'dict'}, 2500),
+}
+DEFAULT_SIZES = ['4x3', '25x25', '100x100', '200x200']
+FULL_SIZES = ['4x3', '25x25', '100x100', '200x200', '500x500', '1000x1000']
+
+
+def parse_size(size):
+    """'<x>x<y>' --> (x, y)"""
+    x, y = size.lower().split('x')
+    return int(x), int(y)
+
+
+def random_world(x, y, controller_reliability=0.8, blocked_fraction=0.1, n_end=2, seed=0):
+    """
+    Return a x by y GridWorld with randomized blocked states and end states (first end state +1, the others -1)
+    and a small living penalty on all other states
+    """
+    if (x, y) == (4, 3):
+        return GridWorld(controller_reliability=controller_reliability) # default problem statement
+    rng = np.random.default_rng(seed)
+    cells = rng.permutation(x*y)
+    n_blocked = int(blocked_fraction*x*y)
+    end_states = [(int(c % x)+1, int(c // x)+1) for c in cells[:n_end]]
+    blocked = [(int(c % x)+1, int(c // x)+1) for c in cells[n_end:n_end+n_blocked]]
+    env = GridWorld(x, y, blocked, end_states, controller_reliability)
+    env.set_rewards({state: (1 if k == 0 else -1) for k, state in enumerate(end_states)}, other_states=-0.01)
+    return env
+
+
+def sparse_reward_world(n, controller_reliability=0.8, blocked_fraction=0.1, seed=0):
+    """
+    Return a n x n GridWorld with a single rewarding end state in a corner, a penalty end state in the middle
+    and random blocked cells (reward information has to travel across the whole map --> worst case for synchronous sweeps)
+    """
+    rng = np.random.default_rng(seed)
+    goal, pit = (n, n), (n//2+1, n//2+1)
+    keep_free = {goal, pit, (1,1), (n-1,n), (n,n-1)} # goal stays reachable
+    cells = rng.choice(n*n, size=int(blocked_fraction*n*n), replace=False)
+    blocked = [(int(c % n)+1, int(c // n)+1) for c in cells]
+    blocked = [state for state in blocked if state not in keep_free]
+    env = GridWorld(n, n, blocked, [goal, pit], controller_reliability)
+    env.set_rewards({goal: 1, pit: -1}, other_states=0.0)
+    return env
+
+
+def run_solver(env, gamma, tol, method='value_iter', backend='numpy', **kwargs):
+    """
+    Solve env quietly and return (Iter object, wall time in seconds)
+    A 'workers' keyword runs the sweeps on a "SweepExecutor" with that many processes (None: all available CPUs)
+    """
+    agent = Mario(env=env, gamma=gamma)
+    executor = SweepExecutor(kwargs.pop('workers')) if 'workers' in kwargs else None
+    learn = Iter(env=env, agent=agent, tol=tol, backend=backend, write_back=False, quiet=True, executor=executor)
+    solver = {'value_iter': learn.by_value_iter, 'policy_iter': learn.by_policy_iter}[method]
+    start = time.perf_counter()
+    for _ in solver(**kwargs):
+        pass
+    wall_time = time.perf_counter() - start
+    return learn, wall_time
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10) # bytes on macOS, kB on Linux
+
+
+def run_case(case):
+    """Build the environment and time one solver on it, return the measurements (runs in a fresh process)"""
+    x, y = parse_size(case['size'])
+    method, kwargs, _ = SOLVERS[case['solver']]
+    kwargs = dict(kwargs)
+    backend = kwargs.pop('backend', 'numpy')
+    start = time.perf_counter()
+    env = random_world(x, y, case['controller_reliability'], seed=case['seed'])
+    env.model # compile outside of the timed solve
+    setup_time = time.perf_counter() - start
+    learn, wall_time = run_solver(env, case['gamma'], case['tol'], method, backend, **kwargs)
+    return {
+        **case,
+        'status': 'ok',
+        'n_states': len(env.valid_states),
+        'setup_time': setup_time,
+        'time_to_tolerance': wall_time,
+        'sweeps': learn.iterations,
+        'epochs': learn.epochs,
+        'backups': learn.backups,
+        'backups_per_second': learn.backups / wall_time if wall_time > 0 else float('inf'),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _run_case_child(case, connection):
+    try:
+        connection.send(run_case(case))
+    except Exception as error:
+        connection.send({**case, 'status': f'error: {error!r}'})
+    connection.close()
+
+
+def run_case_isolated(case, timeout=None):
+    """Run "run_case" in a freshly spawned process (clean peak RSS), give up after timeout seconds"""
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case_child, args=(case, child))
+    process.start()
+    child.close()
+    result = {**case, 'status': 'timeout'}
+    if parent.poll(timeout):
+        try:
+            result = parent.recv()
+        except EOFError:
+            result = {**case, 'status': f'crashed (exit code {process.exitcode})'}
+    process.terminate()
+    process.join()
+    return result
+
+
+def make_cases(sizes, reliabilities, gammas, solvers, tol=0.000001, seed=0):
+    """Return the list of benchmark cases (every solver on every grid size, reliability and gamma)"""
+    cases = []
+    for size in sizes:
+        x, y = parse_size(size)
+        for solver in solvers:
+            max_cells = SOLVERS[solver][2]
+            if max_cells is not None and x*y > max_cells:
+                continue
+            for controller_reliability in reliabilities:
+                for gamma in gammas:
+                    cases.append({
+                        'size': size, 'solver': solver, 'controller_reliability': controller_reliability,
+                        'gamma': gamma, 'tol': tol, 'seed': seed,
+                    })
+    return cases
+
+
+def case_key(result):
+    return (result['size'], result['solver'], result['controller_reliability'], result['gamma'], result['tol'], result['seed'])
+
+
+def environment_info():
+    """Commit, interpreter and library versions the results were measured with"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run_suite(cases, timeout=None, verbose=True):
+    """Run all cases (one process each) and return the report {'environment': ..., 'results': [...]}"""
+    results = []
+    if verbose:
+        print(f'{"size":>10s} {"solver":>24s} {"rel":>5s} {"gamma":>6s} {"sweeps":>7s} {"time [s]":>9s} {"backups/s":>10s} {"RSS [MB]":>9s}')
+    for case in cases:
+        result = run_case_isolated(case, timeout)
+        results.append(result)
+        if verbose:
+            prefix = f'{case["size"]:>10s} {case["solver"]:>24s} {case["controller_reliability"]:5.2f} {case["gamma"]:6.3f}'
+            if result['status'] == 'ok':
+                print(f'{prefix} {result["sweeps"]:7d} {result["time_to_tolerance"]:9.3f} '
+                      f'{result["backups_per_second"]:10.3g} {result["peak_rss_mb"]:9.1f}')
+            else:
+                print(f'{prefix} {result["status"]}')
+    return {'environment': environment_info(), 'results': results}
+
+
+def compare_reports(baseline, current, threshold=0.2, min_time=0.01):
+    """
+    Return the regressions of report "current" against report "baseline": cases that got slower by more than
+    threshold (relative time-to-tolerance, ignoring cases faster than min_time seconds in both) or stopped finishing
+    """
+    before = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = before.get(case_key(result))
+        if old is None or old['status'] != 'ok':
+            continue
+        if result['status'] != 'ok':
+            regressions.append((result, old, result['status']))
+            continue
+        old_time, new_time = old['time_to_tolerance'], result['time_to_tolerance']
+        if max(old_time, new_time) >= min_time and new_time > (1 + threshold) * old_time:
+            regressions.append((result, old, f'{old_time:.3f}s --> {new_time:.3f}s ({new_time/old_time - 1:+.0%})'))
+    return regressions
+
+
+def compare_sweeps(n, gamma=0.9, tol=0.000001, controller_reliability=0.8, seed=0):
+    """
+    Compare state backups of synchronous, Gauss-Seidel and prioritized value iteration on a sparse-reward map
+    All runs stop with the same guarantee |v - v*| < tol: the synchronous run uses tol*(1-gamma)/gamma on successive changes
+    """
+    env = sparse_reward_world(n, controller_reliability, seed=seed)
+    runs = [
+        ('synchronous', tol * (1 - gamma) / gamma),
+        ('gauss_seidel', tol),
+        ('prioritized', tol),
+    ]
+    rows = []
+    for sweep, sweep_tol in runs:
+        learn, wall_time = run_solver(env, gamma, sweep_tol, sweep=sweep)
+        rows.append({'sweep': sweep, 'iterations': learn.iterations, 'backups': learn.backups, 'wall_time': wall_time})
+    return rows
+
+
+# Cold-start commands timed by "cold_start": name --> python arguments (run from the repository directory)
+COLD_STARTS = {
+    'import_main': ['-c', 'import main'],
+    'headless_solve': ['main.py', '--headless', '--quiet'],
+}
+# Modules a headless run must not import
+HEAVY_MODULES = ('matplotlib',)
+
+
+def cold_start(arguments, repeats=5):
+    """Return the sorted wall times (seconds) of "repeats" fresh interpreters running python with arguments"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *arguments], cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def heavy_imports():
+    """Return the modules of HEAVY_MODULES a fresh interpreter imports for a headless solve"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    code = (
+        'import sys, main; main.main(["--headless", "--quiet"]); '
+        f'print("heavy:" + ",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    )
+    output = subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True, capture_output=True, text=True).stdout
+    line = [line for line in output.splitlines() if line.startswith('heavy:')][-1]
+    return [module for module in line[len('heavy:'):].split(',') if module]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark GridWorld solvers')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    suite = commands.add_parser('suite', help='time the solvers over grid sizes, reliabilities and gammas')
+    suite.add_argument('--sizes', nargs='+', default=None, help=f'grid sizes as <x>x<y> (default: {" ".join(DEFAULT_SIZES)})')
+    suite.add_argument('--full', action='store_true', help=f'sizes {" ".join(FULL_SIZES)}')
+    suite.add_argument('--reliability', type=float, nargs='+', default=[0.8, 1.0])
+    suite.add_argument('--gamma', type=float, nargs='+', default=[0.9, 0.99])
+    suite.add_argument('--solvers', nargs='+', default=list(SOLVERS), choices=list(SOLVERS))
+    suite.add_argument('--tol', type=float, default=0.000001)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--timeout', type=float, default=600, help='seconds per case')
+    suite.add_argument('--out', default='bench_results.json', help='JSON report')
+
+    compare = commands.add_parser('compare', help='compare two JSON reports, exit code 1 on regressions')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.2, help='relative slowdown counted as a regression')
+
+    sweeps = commands.add_parser('sweeps', help='backups of synchronous vs in-place sweeps on sparse-reward maps')
+    sweeps.add_argument('--sizes', type=int, nargs='+', default=[25, 50, 100], help='side lengths of the square maps')
+    sweeps.add_argument('--gamma', type=float, default=0.9)
+    sweeps.add_argument('--tol', type=float, default=0.000001)
+
+    cold = commands.add_parser('coldstart', help='cold-start time of the headless path, exit code 1 over budget')
+    cold.add_argument('--budget', type=float, default=1.0, help='seconds allowed for the median run of every command')
+    cold.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == 'suite':
+        sizes = args.sizes or (FULL_SIZES if args.full else DEFAULT_SIZES)
+        cases = make_cases(sizes, args.reliability, args.gamma, args.solvers, args.tol, args.seed)
+        report = run_suite(cases, args.timeout)
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'*** {len(cases)} cases --> {args.out} ***')
+    elif args.command == 'compare':
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        regressions = compare_reports(baseline, current, args.threshold)
+        print(f'*** {baseline["environment"]["commit"]} --> {current["environment"]["commit"]}: '
+              f'{len(regressions)} regression(s) ***')
+        for result, _, reason in regressions:
+            print(f'{result["size"]:>10s} {result["solver"]:>24s} {result["controller_reliability"]:5.2f} '
+                  f'{result["gamma"]:6.3f} {reason}')
+        sys.exit(1 if regressions else 0)
+    elif args.command == 'coldstart':
+        failed = False
+        for name, arguments in COLD_STARTS.items():
+            times = cold_start(arguments, args.repeats)
+            median = times[len(times) // 2]
+            over = median > args.budget
+            failed |= over
+            print(f'{name:>15s} median {median:.3f}s | min {times[0]:.3f}s | max {times[-1]:.3f}s'
+                  f'{" --> over the budget of %.3fs" % args.budget if over else ""}')
+        heavy = heavy_imports()
+        if heavy:
+            failed = True
+            print(f'headless solve imported {", ".join(heavy)}')
+        sys.exit(1 if failed else 0)
+    else:
+        print(f'{"size":>6s} {"sweep":>13s} {"iterations":>10s} {"backups":>12s} {"time [s]":>9s}')
+        for n in args.sizes:
+            for row in compare_sweeps(n, args.gamma, args.tol):
+                print(f'{n:6d} {row["sweep"]:>13s} {row["iterations"]:10d} {row["backups"]:12d} {row["wall_time"]:9.3f}')
+
+
+if __name__ == "__main__":
+    main()
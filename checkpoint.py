@@ -0,0 +1,114 @@
+import argparse
+import hashlib
+import json
+import numpy as np
+
+VERSION = 1
+
+
+def fingerprint(env, gamma):
+    """
+    Return a hex digest identifying the planning problem: layout, end states, actions, slip kernel, controller reliability,
+    rewards and gamma. Two problems with the same fingerprint have the same optimal values and policy
+    """
+    digest = hashlib.sha256()
+    digest.update(np.array([env.xdim, env.ydim], dtype='<i8').tobytes())
+    digest.update(np.array(sorted(env.blocked_states), dtype='<i8').tobytes())
+    digest.update(b'|')
+    digest.update(np.array(sorted(env.end_states), dtype='<i8').tobytes())
+    digest.update(json.dumps([list(env.action_space.items()), sorted(env.slip.items())]).encode())
+    digest.update(np.array([env.prob, gamma], dtype='<f8').tobytes())
+    digest.update(np.array(env.valid_states, dtype='<i8').tobytes())
+    digest.update(env.reward_vector().astype('<f8').tobytes())
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    def __init__(self, xdim, ydim, states, actions, values, policy, gamma, fingerprint, method,
+                 iterations=0, epochs=0, backups=0, cold_sweeps=None):
+        """
+        Solver state saved by "Iter.save_checkpoint" and reused by the solvers' warm_start argument
+        Arguments:
+            xdim, ydim: grid size
+            states: (S, 2) int array of state coordinates
+            actions: (A, 2) int array of actions, policy indexes into it
+            values: (S,) float64 state values, policy: (S,) int8 action indices, -1 for END
+            gamma: discount the values were computed with
+            fingerprint: see "fingerprint"
+            method: solver that produced the values (e.g. 'value_iter:synchronous')
+            iterations, epochs, backups: counters of that solve
+            cold_sweeps: sweeps of the last cold (not warm started) solve this checkpoint descends from,
+                the reference for the sweeps a warm start saves
+        """
+        self.xdim = int(xdim)
+        self.ydim = int(ydim)
+        self.states = np.asarray(states, dtype=np.int64).reshape(-1, 2)
+        self.actions = np.asarray(actions, dtype=np.int64).reshape(-1, 2)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.policy = np.asarray(policy, dtype=np.int8)
+        self.gamma = float(gamma)
+        self.fingerprint = fingerprint
+        self.method = method
+        self.iterations = int(iterations)
+        self.epochs = int(epochs)
+        self.backups = int(backups)
+        self.cold_sweeps = cold_sweeps
+
+    def meta(self):
+        return {
+            'version': VERSION, 'xdim': self.xdim, 'ydim': self.ydim, 'gamma': self.gamma, 'fingerprint': self.fingerprint,
+            'method': self.method, 'iterations': self.iterations, 'epochs': self.epochs, 'backups': self.backups,
+            'cold_sweeps': self.cold_sweeps,
+        }
+
+    def save(self, path):
+        """Write the checkpoint as an uncompressed .npz archive (int32 coordinates, float64 values, int8 policy)"""
+        with open(path, 'wb') as file:
+            np.savez(
+                file,
+                meta=np.frombuffer(json.dumps(self.meta()).encode(), dtype=np.uint8),
+                states=self.states.astype('<i4'),
+                actions=self.actions.astype('<i4'),
+                values=self.values.astype('<f8'),
+                policy=self.policy,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as archive:
+            meta = json.loads(archive['meta'].tobytes().decode())
+            if meta['version'] != VERSION:
+                raise ValueError(f"Unsupported checkpoint version {meta['version']}")
+            return cls(
+                meta['xdim'], meta['ydim'], archive['states'], archive['actions'], archive['values'], archive['policy'],
+                meta['gamma'], meta['fingerprint'], meta['method'],
+                meta['iterations'], meta['epochs'], meta['backups'], meta['cold_sweeps'],
+            )
+
+    def state_map(self, model):
+        """
+        Match the checkpoint states to the states of a compiled model by coordinates
+        Return (model_indices, checkpoint_indices) of the states present in both
+        """
+        x, y = self.states[:, 0], self.states[:, 1]
+        inside = (x >= 1) & (x <= model.xdim) & (y >= 1) & (y <= model.ydim)
+        model_indices = np.full(len(self.states), -1, dtype=np.int64)
+        model_indices[inside] = model.grid_index[y[inside]-1, x[inside]-1]
+        matched = np.flatnonzero(model_indices >= 0)
+        return model_indices[matched], matched
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect a solver checkpoint written by Iter.save_checkpoint')
+    parser.add_argument('path')
+    args = parser.parse_args(argv)
+    checkpoint = Checkpoint.load(args.path)
+    print(f'{args.path}: {checkpoint.xdim}x{checkpoint.ydim} grid, {len(checkpoint.states)} states, gamma {checkpoint.gamma}')
+    print(f'Solved by {checkpoint.method}: {checkpoint.iterations} sweeps, {checkpoint.epochs} epochs, {checkpoint.backups} backups')
+    if checkpoint.cold_sweeps is not None:
+        print(f'Cold start reference: {checkpoint.cold_sweeps} sweeps')
+    print(f'Fingerprint: {checkpoint.fingerprint}')
+
+
+if __name__ == "__main__":
+    main()
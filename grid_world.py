@@ -1,7 +1,95 @@
+import bisect
+import copy
+import itertools
 import numpy as np
 
+# Action sets: {key = action (move): value = action name}
+ACTION_SETS = {
+    '4': {(0,-1): 'down', (-1,0): 'left', (1,0): 'right', (0,1): 'up'},
+    '8': {
+        (0,-1): 'down', (-1,0): 'left', (1,0): 'right', (0,1): 'up',
+        (-1,-1): 'down-left', (1,-1): 'down-right', (-1,1): 'up-left', (1,1): 'up-right',
+    },
+}
+STAY = {(0,0): 'stay'} # optional action, always stays in place (no slip)
+
+# Slip kernels: relative weights of the outcomes of a move that does not go as intended, as moves of the action "up"
+# (0,1). They turn with the action: by quarter turns, and for 3x3 kernels by eighth turns around the neighbourhood
+# (diagonal actions). The intended move gets controller_reliability, the slips share the rest by weight.
+SLIP_KERNELS = {
+    'perpendicular': {(-1,0): 1, (1,0): 1},
+    'veer': {(-1,1): 1, (1,1): 1},
+    'spread': {(-1,0): 1, (1,0): 1, (-1,1): 1, (1,1): 1},
+    'reverse': {(0,-1): 1},
+    'stuck': {(0,0): 1},
+    'none': {},
+}
+# Neighbourhood ring, eighth turns clockwise from "up"
+RING = [(0,1), (1,1), (1,0), (1,-1), (0,-1), (-1,-1), (-1,0), (-1,1)]
+
+
+def turn(move, action):
+    """Helper function: move of a slip kernel (given for the action "up") turned along with action"""
+    move, action = tuple(move), tuple(action)
+    if move == (0,0):
+        return move
+    dx, dy = action
+    if 0 in action:
+        # quarter turns: "up" --> action, exact for any move
+        return (move[0]*dy + move[1]*dx, move[1]*dy - move[0]*dx)
+    if max(abs(move[0]), abs(move[1])) > 1:
+        raise ValueError(f'Slip kernel moves of diagonal actions must be neighbours, got {move}')
+    return RING[(RING.index(move) + RING.index((int(np.sign(dx)), int(np.sign(dy))))) % len(RING)]
+
+
+def action_kernel(action, slip, controller_reliability):
+    """
+    Return the outcomes of an action as a list of (move, probability), the intended move first
+        slip: {key = move for the action "up": value = relative weight}, see SLIP_KERNELS
+    The stay action and actions without slip outcomes always go as intended
+    """
+    action = tuple(action)
+    total = float(sum(slip.values()))
+    if action == (0,0) or total <= 0:
+        return [(action, 1.0)]
+    return [(action, controller_reliability)] + [
+        (turn(move, action), (1 - controller_reliability) * weight / total) for move, weight in slip.items()
+    ]
+
+def build_action_space(actions='4', stay=False):
+    """Return the action space {key = move: value = action name} of an action set (see ACTION_SETS) or dict, plus 'stay'"""
+    action_space = {tuple(move): name for move, name in (ACTION_SETS[actions] if isinstance(actions, str) else actions).items()}
+    if stay:
+        action_space.update(STAY)
+    return action_space
+
+
+class _ModelField:
+    """
+    Helper descriptor: attribute of "GridWorld" its compiled model depends on. Assigning it bumps env.version, which is
+    all "GridWorld.model" compares (in-place changes of the lists or dicts go through the mutators, which bump it too)
+    """
+
+    def __set_name__(self, owner, name):
+        self.attribute = '_' + name
+
+    def __get__(self, env, owner=None):
+        return self if env is None else getattr(env, self.attribute)
+
+    def __set__(self, env, value):
+        setattr(env, self.attribute, value)
+        env.version = getattr(env, 'version', 0) + 1
+
+
 class GridWorld:
-    def __init__(self, x=4, y=3, blocked_states=[(2,2)], end_states=[(4,3),(4,2)], controller_reliability=0.8):
+    blocked_states = _ModelField()
+    end_states = _ModelField()
+    prob = _ModelField()
+    action_space = _ModelField()
+    slip = _ModelField()
+
+    def __init__(self, x=4, y=3, blocked_states=[(2,2)], end_states=[(4,3),(4,2)], controller_reliability=0.8,
+                 actions='4', slip='perpendicular', stay=False):
         """
         Arguments:
             x: length of gridworld
@@ -9,6 +97,11 @@ class GridWorld:
             blocked_states: list of states blocked from access to agent "Mario"
             end_states: list of states where the game terminates
             controller_reliability: reliablity of controller expressed as probability
+            actions: name of an action set ('4' or '8' neighbours, see ACTION_SETS) or {key = move: value = action name}
+            slip: name of a slip kernel (see SLIP_KERNELS) or {key = move for the action "up": value = relative weight}
+            stay: add the action (0,0) 'stay'
+        Moves into blocked states or off the grid stay in place, outcomes landing on the same state add up
+        The layout can change later on through "add_blocked", "remove_blocked", "set_end_state" and "update_reward"
 
         Default rewards:
             B: blocked states (default env setup)
@@ -19,18 +112,20 @@ class GridWorld:
         """
         self.xdim = x
         self.ydim = y
-        self.blocked_states = blocked_states # list of states (as tuples) that cannot be accessed by agent
-        self.end_states = end_states # list of end states (as tuples) --> for not evaluating state values here
+        self.blocked_states = list(blocked_states) # list of states (as tuples) that cannot be accessed by agent
+        self.end_states = list(end_states) # list of end states (as tuples) --> for not evaluating state values here
         self.prob = controller_reliability
         # valid states
-        self.valid_states = [
-            (i+1, j+1) 
-            for j in range(self.ydim) 
-            for i in range(self.xdim) 
-            if (i+1, j+1) not in self.blocked_states
-        ]
-        # Action space
-        self.action_space = {(0,-1): 'down', (-1,0): 'left', (1,0): 'right', (0,1): 'up'}
+        self.valid_states = self._build_valid_states()
+        self._valid_key = tuple(self.blocked_states)
+        # Action space and slip kernel
+        self.action_space = build_action_space(actions, stay)
+        self.slip = dict(SLIP_KERNELS[slip] if isinstance(slip, str) else slip)
+        # Compiled transition model (built lazily, see "model")
+        self._model = None
+        self._model_key = None
+        self._model_version = None
+        self.dirty = set() # states changed by the mutators since the last "Iter.replan"
         # Rewards
         self.rewards = {
             state: 0.0
@@ -67,17 +162,507 @@ class GridWorld:
                     print("     ", end="|")
             print()
 
+    @classmethod
+    def from_arrays(cls, blocked, end, rewards, controller_reliability=0.8, actions='4', slip='perpendicular', stay=False):
+        """
+        Build a gridworld from (ydim, xdim) arrays with [y-1, x-1] indexing (e.g. the map loaders in maps.py)
+            blocked: bool mask of blocked states
+            end: bool mask of end states (ignored where blocked)
+            rewards: float rewards of every state (ignored where blocked)
+            actions, slip, stay: see the constructor
+        Same gridworld as the constructor plus "set_rewards", built with array operations instead of per-state loops
+        """
+        blocked = np.asarray(blocked, dtype=bool)
+        end = np.asarray(end, dtype=bool) & ~blocked
+        env = cls.__new__(cls)
+        env.ydim, env.xdim = blocked.shape
+        ys, xs = np.nonzero(blocked)
+        env.blocked_states = list(zip((xs+1).tolist(), (ys+1).tolist()))
+        ys, xs = np.nonzero(end)
+        env.end_states = list(zip((xs+1).tolist(), (ys+1).tolist()))
+        env.prob = controller_reliability
+        ys, xs = np.nonzero(~blocked)
+        env.valid_states = list(zip((xs+1).tolist(), (ys+1).tolist()))
+        env._valid_key = tuple(env.blocked_states)
+        env.action_space = build_action_space(actions, stay)
+        env.slip = dict(SLIP_KERNELS[slip] if isinstance(slip, str) else slip)
+        env._model = None
+        env._model_key = None
+        env._model_version = None
+        env.dirty = set()
+        env.rewards = dict(zip(env.valid_states, np.asarray(rewards, dtype=np.float64)[ys, xs].tolist()))
+        return env
+
+    def _build_valid_states(self):
+        """Helper function: list valid states in row-major order (y outer, x inner)"""
+        valid = np.ones((self.ydim, self.xdim), dtype=bool)
+        blocked = np.array(self.blocked_states, dtype=np.int64).reshape(-1, 2)
+        inside = (blocked[:, 0] >= 1) & (blocked[:, 0] <= self.xdim) & (blocked[:, 1] >= 1) & (blocked[:, 1] <= self.ydim)
+        valid[blocked[inside, 1]-1, blocked[inside, 0]-1] = False
+        ys, xs = np.nonzero(valid)
+        return list(zip((xs+1).tolist(), (ys+1).tolist()))
+
+
+    @property
+    def model(self):
+        """
+        Compiled transition model of the gridworld (object of class "TransitionModel")
+        Built once and rebuilt only when blocked_states, end_states, actions, slip or controller_reliability change:
+        assigning one of them (or calling a mutator) bumps self.version, an access only compares that counter
+        """
+        if self._model is None or self._model_version != self.version:
+            self._refresh_model()
+        return self._model
+
+    def _refresh_model(self):
+        """Helper function: bring the compiled model up to date after a change of version (see "model")"""
+        key = self._key()
+        if self._model is None or key != self._model_key:
+            if key[2] != self._valid_key:
+                # blocked states changed after construction --> refresh valid states (new cells get zero reward)
+                self.valid_states = self._build_valid_states()
+                self.rewards = {state: self.rewards.get(state, 0.0) for state in self.valid_states}
+                self._valid_key = key[2]
+            if self._model is not None and key[:-1] == self._model_key[:-1]:
+                # same topology --> only the probabilities change
+                self._model = self._model.reweight(self.prob)
+            else:
+                self._model = TransitionModel(self)
+            self._model_key = key
+        self._model_version = self.version
+
+    def attach_model(self, model):
+        """Use a "TransitionModel" compiled elsewhere for the current layout (e.g. loaded from the map cache in maps.py)"""
+        self._model = model
+        self._model_key = self._key()
+        self._model_version = self.version
+        self._valid_key = self._model_key[2]
+
+    def _key(self):
+        """Helper function: everything the compiled model depends on, controller reliability last (see "model")"""
+        return (
+            self.xdim, self.ydim, tuple(self.blocked_states), tuple(self.end_states),
+            tuple(self.action_space.items()), tuple(self.slip.items()), self.prob,
+        )
+
+    def _check_state(self, state, valid=True):
+        """Helper function: state as a tuple, ValueError when off the grid (or not a valid state with valid=True)"""
+        state = tuple(state)
+        x, y = state
+        if not (1 <= x <= self.xdim and 1 <= y <= self.ydim):
+            raise ValueError(f'State {state} is off the {self.xdim}x{self.ydim} grid')
+        if valid and state not in self.rewards:
+            raise ValueError(f'State {state} is blocked')
+        return state
+
+    def _up_to_date(self):
+        """Helper function: Used for the mutators, True when the compiled model matches the layout before the change"""
+        return self._model is not None and self._model_version == self.version
+
+    def _changed(self, states, up_to_date):
+        """
+        Helper function: Used for the mutators, bump the version, mark states dirty and patch the compiled model around
+        them (only when it was up to date before the change, see "_up_to_date"; otherwise it is compiled on first use)
+        """
+        if not states:
+            return
+        self._valid_key = tuple(self.blocked_states)
+        self.version += 1
+        if up_to_date:
+            self._model = self._model.patch(self, states)
+            self._model_key = self._key()
+            self._model_version = self.version
+        self.dirty.update(states)
+
+    def add_blocked(self, states):
+        """
+        Block states (list of states as tuples) in place: they leave valid_states, end_states and rewards
+        Blocked states are ignored, the changed states are marked dirty for "Iter.replan"
+        """
+        up_to_date = self._up_to_date()
+        changed = []
+        for state in states:
+            state = self._check_state(state, valid=False)
+            if state not in self.rewards:
+                continue # already blocked
+            del self.valid_states[bisect.bisect_left(self.valid_states, (state[1], state[0]), key=lambda s: (s[1], s[0]))]
+            del self.rewards[state]
+            if state in self.end_states:
+                self.end_states.remove(state)
+            self.blocked_states.append(state)
+            changed.append(state)
+        self._changed(changed, up_to_date)
+
+    def remove_blocked(self, states, reward=0.0):
+        """
+        Unblock states (list of states as tuples) in place: they join valid_states with the given reward
+        States that are not blocked are ignored, the changed states are marked dirty for "Iter.replan"
+        """
+        up_to_date = self._up_to_date()
+        changed = []
+        for state in states:
+            state = self._check_state(state, valid=False)
+            if state in self.rewards:
+                continue # not blocked
+            bisect.insort(self.valid_states, state, key=lambda s: (s[1], s[0]))
+            self.rewards[state] = reward
+            while state in self.blocked_states:
+                self.blocked_states.remove(state)
+            changed.append(state)
+        self._changed(changed, up_to_date)
+
+    def set_end_state(self, state, end=True, reward=None):
+        """
+        Turn valid state into an end state (end=True) or back into a regular state (end=False), in place
+            reward: new reward of the state, None keeps it
+        The state is marked dirty for "Iter.replan"
+        """
+        up_to_date = self._up_to_date()
+        state = self._check_state(state)
+        if end and state not in self.end_states:
+            self.end_states.append(state)
+        elif not end and state in self.end_states:
+            self.end_states.remove(state)
+        if reward is not None:
+            self.rewards[state] = reward
+        self._changed([state], up_to_date)
+
+    def update_reward(self, state, reward):
+        """Set the reward of valid state in place and mark it dirty for "Iter.replan" (the compiled model does not change)"""
+        state = self._check_state(state)
+        self.rewards[state] = reward
+        self.dirty.add(state)
+
+    def reward_vector(self):
+        """Return rewards as a (S,) array, in the order of the compiled model states"""
+        return np.array([self.rewards[state] for state in self.valid_states], dtype=np.float64)
+
     def transition_probs(self, state, action):
         """Take any (state, action) pair and return transition probabilities to all valid transition states"""
-        # transverse actions (in list form) 
-        transverse_action_1 = np.flip(action)
-        transverse_action_2 = [-i for i in transverse_action_1]
-        # New states
-        action_state = tuple(map(sum, zip(state, action))) # new state when action executed as intended
-        flip_1_state = tuple(map(sum, zip(state, tuple(transverse_action_1))))
-        flip_2_state = tuple(map(sum, zip(state, tuple(transverse_action_2))))
-        # check and correct if new states are out of bounds
-        action_state = action_state if action_state in self.valid_states else state
-        flip_1_state = flip_1_state if flip_1_state in self.valid_states else state
-        flip_2_state = flip_2_state if flip_2_state in self.valid_states else state
-        return {action_state: self.prob, flip_1_state: 0.5*(1-self.prob), flip_2_state: 0.5*(1-self.prob)}
\ No newline at end of file
+        return self.model.transition_probs(state, action)
+
+    def step(self, state, action, rng=None):
+        """
+        Sample one transition of the slip model (same probabilities as "transition_probs")
+        Take any (state, action) pair and return (new_state, reward, done)
+            rng: numpy random Generator (default: a fresh unseeded one)
+        Reward is the reward of the new state, done is True when the new state is an end state.
+        Probability mass missing from a transition row (see "TransitionModel.sample") ends the episode
+        with zero reward in the current state, which is how the planners in iter_schemes.py value it.
+        From an end state the episode is already over --> (state, 0.0, True)
+        """
+        model = self.model
+        s = model.index[state]
+        if model.terminal[s]:
+            return state, 0.0, True
+        rng = np.random.default_rng() if rng is None else rng
+        new_s = int(model.sample(np.array([s*model.n_actions + model.action_index[tuple(action)]]), rng.random(1))[0])
+        if new_s < 0:
+            return state, 0.0, True
+        new_state = model.valid_states[new_s]
+        return new_state, self.rewards[new_state], bool(model.terminal[new_s])
+
+
+class TransitionModel:
+    def __init__(self, env):
+        """
+        Arguments:
+            env: object of class "GridWorld" to compile
+
+        Compiled arrays (S: number of valid states, A: number of actions):
+            states: (S, 2) int array of state coordinates, in the order of env.valid_states
+            valid_states: list of states (as tuples), same order as states
+            index: {key = state: value = integer index into states} (built on first use)
+            grid_index: (ydim, xdim) int array of state indices, -1 for blocked cells
+            actions: list of actions (as tuples) in the order of env.action_space
+            action_index: {key = action: value = integer index into actions}
+            terminal: (S,) bool array, True for end states
+            indptr: (S*A + 1,) CSR row pointers, row of (s, a) is s*A + a
+            next_states: CSR column indices (index of the transition state s')
+            probs: CSR values (transition probability to s')
+            outcomes: CSR bit masks, bit k is set when outcome k of the action's kernel lands on the entry
+                (see "kernel_table"; outcomes landing on the same state share one entry and add up)
+            rows: row of every CSR entry (expanded indptr, handy for np.bincount reductions)
+
+        End states keep their rows (as in "transition_probs"), solvers are expected to mask them with "terminal".
+        """
+        self.xdim = env.xdim
+        self.ydim = env.ydim
+        self.prob = env.prob
+        self.slip = dict(env.slip)
+        self.actions = list(env.action_space)
+        self.action_index = {action: a for a, action in enumerate(self.actions)}
+        self.n_actions = len(self.actions)
+
+        self.states = np.fromiter(
+            itertools.chain.from_iterable(env.valid_states), dtype=np.int64, count=2*len(env.valid_states)
+        ).reshape(-1, 2)
+        self.n_states = len(self.states)
+        self.valid_states = list(env.valid_states)
+        self.grid_index = np.full((self.ydim, self.xdim), -1, dtype=np.int64)
+        self.grid_index[self.states[:, 1]-1, self.states[:, 0]-1] = np.arange(self.n_states)
+
+        self.terminal = np.zeros(self.n_states, dtype=bool)
+        ends = self._lookup(np.array(env.end_states, dtype=np.int64).reshape(-1, 2), -1)
+        self.terminal[ends[ends >= 0]] = True
+
+        self._compile()
+        # state dict and topology dependent indices, built on first use
+        self._index = None
+        self._color_classes = None
+        self._predecessors = None
+
+    @classmethod
+    def from_arrays(cls, env, arrays):
+        """
+        Model of env from previously compiled arrays, without compiling (e.g. memory-mapped by the map cache in maps.py)
+            arrays: {name: array} with states, grid_index, terminal, indptr, next_states, probs, outcomes, rows
+        """
+        model = cls.__new__(cls)
+        model.xdim = env.xdim
+        model.ydim = env.ydim
+        model.prob = env.prob
+        model.slip = dict(env.slip)
+        model.actions = list(env.action_space)
+        model.action_index = {action: a for a, action in enumerate(model.actions)}
+        model.n_actions = len(model.actions)
+        for name in ('states', 'grid_index', 'terminal', 'indptr', 'next_states', 'probs', 'outcomes', 'rows'):
+            setattr(model, name, arrays[name])
+        model.n_states = len(model.states)
+        model.valid_states = list(env.valid_states)
+        model._index = None
+        model._color_classes = None
+        model._predecessors = None
+        return model
+
+    @property
+    def index(self):
+        """{key = state: value = integer index into states}"""
+        if self._index is None:
+            self._index = {state: s for s, state in enumerate(self.valid_states)}
+        return self._index
+
+    def _lookup(self, coords, fallback):
+        """Helper function: state indices of (..., 2) coords, fallback index where out of bounds or blocked"""
+        x, y = coords[..., 0], coords[..., 1]
+        inside = (x >= 1) & (x <= self.xdim) & (y >= 1) & (y <= self.ydim)
+        idx = np.full(x.shape, -1, dtype=np.int64)
+        idx[inside] = self.grid_index[y[inside]-1, x[inside]-1]
+        return np.where(idx >= 0, idx, fallback)
+
+    @property
+    def intended(self):
+        """CSR mask, True where the entry carries the intended move (possibly merged with slips landing on the same state)"""
+        return (self.outcomes & 1).astype(bool)
+
+    def kernel_table(self, controller_reliability):
+        """
+        Return the outcomes of every action as (A, K, 2) moves and (A, K) probabilities (see "action_kernel"),
+        actions with fewer than K outcomes are padded with zero probability outcomes
+        """
+        kernels = [action_kernel(action, self.slip, controller_reliability) for action in self.actions]
+        K = max(len(kernel) for kernel in kernels)
+        if K > 32:
+            raise ValueError(f'Slip kernels have at most 31 outcomes, got {K-1}')
+        moves = np.zeros((self.n_actions, K, 2), dtype=np.int64)
+        probs = np.zeros((self.n_actions, K))
+        for a, kernel in enumerate(kernels):
+            for k, (move, prob) in enumerate(kernel):
+                moves[a, k] = move
+                probs[a, k] = prob
+        return moves, probs
+
+    def _compile(self):
+        S, A = self.n_states, self.n_actions
+        counts, self.next_states, self.outcomes = self._compile_rows(np.arange(S))
+        self.indptr = np.zeros(S*A + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.rows = np.repeat(np.arange(S*A), counts)
+        self.probs = self._entry_probs(self.kernel_table(self.prob)[1])
+
+    def _compile_rows(self, states):
+        """
+        Helper function: compile the CSR rows of the given (sorted) state indices
+        Return ((len(states)*A,) entry counts of the rows, next_states and outcomes of their entries)
+        """
+        S, A = len(states), self.n_actions
+        moves, _ = self.kernel_table(self.prob)
+        K = moves.shape[1]
+        real = np.array([len(action_kernel(action, self.slip, self.prob)) for action in self.actions])[:, None] > np.arange(K)
+        # (S, A, K) outcome indices, moves into blocked states or off the grid stay in place
+        targets = self._lookup(self.states[states][:, None, None, :] + moves[None], states[:, None, None])
+        targets = np.where(real, targets, -1)
+        # outcomes landing on the same state share the entry of the first of them, which accumulates their probabilities
+        first = np.broadcast_to(np.arange(K), targets.shape).copy()
+        for k in range(1, K):
+            for k_prev in range(k):
+                same = (targets[..., k] == targets[..., k_prev]) & (first[..., k] == k) & real[:, k_prev]
+                first[..., k] = np.where(same, k_prev, first[..., k])
+        keep = (first == np.arange(K)) & real
+        bits = np.zeros(targets.shape, dtype=np.uint32)
+        for k in range(K):
+            for root in range(k + 1):
+                bits[..., root] |= np.where(first[..., k] == root, np.uint32(1 << k), np.uint32(0))
+        keep = keep.reshape(S*A, K)
+        return keep.sum(axis=1), targets.reshape(S*A, K)[keep], bits.reshape(S*A, K)[keep]
+
+    def _entry_probs(self, kernel_probs, rows=None, outcomes=None):
+        """
+        Helper function: CSR probabilities, every entry sums the probabilities of the outcomes landing on it
+        (of all entries, or of the entries with the given rows and outcomes)
+        """
+        rows = self.rows if rows is None else rows
+        outcomes = self.outcomes if outcomes is None else outcomes
+        action = rows % self.n_actions
+        probs = np.zeros(len(outcomes))
+        for k in range(kernel_probs.shape[1]):
+            probs += ((outcomes >> k) & 1) * kernel_probs[action, k]
+        return probs
+
+    def reweight(self, controller_reliability):
+        """
+        Return a copy of the model for another controller reliability
+        The (topology dependent) CSR structure is shared, only the probabilities are recomputed
+        """
+        model = copy.copy(self)
+        model.prob = controller_reliability
+        model.probs = self._entry_probs(self.kernel_table(controller_reliability)[1])
+        return model
+
+    def reach(self):
+        """(M, 2) array of the distinct outcome moves of all actions, (0,0) included (moves that stay in place)"""
+        moves = self.kernel_table(self.prob)[0].reshape(-1, 2)
+        return np.unique(np.concatenate([moves, [[0, 0]]]), axis=0)
+
+    def sources(self, coords):
+        """
+        Return the sorted indices of the states that may move into any of the (N, 2) coords, the valid coords included
+        A superset of the predecessors (see "predecessors") read off the outcome moves, no CSR table is needed
+        """
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+        idx = self._lookup(coords[:, None, :] - self.reach()[None], -1)
+        return np.unique(idx[idx >= 0])
+
+    def patch(self, env, coords):
+        """
+        Return the model of env after local changes of its layout at coords (list of states as tuples): blocked or freed
+        states, end states. Only the rows of the states that can move into coords are compiled again, the other rows
+        are copied from self (renumbered when states were added or removed). The arrays of self are left untouched
+        """
+        model = copy.copy(self)
+        model.valid_states = list(env.valid_states)
+        model.n_states = len(model.valid_states)
+        model._index = model._color_classes = model._predecessors = None
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+        cells = (coords[:, 1]-1, coords[:, 0]-1)
+        valid = np.array([tuple(state) in env.rewards for state in coords.tolist()], dtype=bool)
+        if np.any(valid != (self.grid_index[cells] >= 0)):
+            A = self.n_actions
+            grid_valid = self.grid_index >= 0
+            grid_valid[cells] = valid
+            ys, xs = np.nonzero(grid_valid)
+            model.states = np.stack([xs+1, ys+1], axis=1)
+            model.grid_index = np.full((self.ydim, self.xdim), -1, dtype=np.int64)
+            model.grid_index[ys, xs] = np.arange(model.n_states)
+            renumber = model.grid_index[self.states[:, 1]-1, self.states[:, 0]-1] # old --> new state index, -1 if blocked
+            # rows that can reach a changed cell are compiled again, the others keep their entries
+            compiled = model.sources(coords)
+            stale = np.zeros(model.n_states, dtype=bool)
+            stale[compiled] = True
+            counts, next_states, outcomes = model._compile_rows(compiled)
+            row_counts = np.zeros((model.n_states, A), dtype=np.int64)
+            kept = renumber >= 0
+            kept[kept] = ~stale[renumber[kept]]
+            row_counts[renumber[kept]] = np.diff(self.indptr).reshape(-1, A)[kept]
+            row_counts[compiled] = counts.reshape(-1, A)
+            model.indptr = np.zeros(model.n_states*A + 1, dtype=np.int64)
+            np.cumsum(row_counts.ravel(), out=model.indptr[1:])
+            model.rows = np.repeat(np.arange(model.n_states*A), row_counts.ravel())
+            # entries of unchanged rows keep their order, their targets can be neither blocked nor freed cells
+            fresh = stale[model.rows // A]
+            copied = kept[self.rows // A]
+            model.next_states = np.empty(len(model.rows), dtype=np.int64)
+            model.next_states[~fresh] = renumber[self.next_states[copied]]
+            model.next_states[fresh] = next_states
+            model.outcomes = np.empty(len(model.rows), dtype=np.uint32)
+            model.outcomes[~fresh] = self.outcomes[copied]
+            model.outcomes[fresh] = outcomes
+            model.probs = np.empty(len(model.rows))
+            model.probs[~fresh] = self.probs[copied]
+            model.probs[fresh] = model._entry_probs(model.kernel_table(model.prob)[1], model.rows[fresh], outcomes)
+        model.terminal = np.zeros(model.n_states, dtype=bool)
+        ends = model._lookup(np.array(env.end_states, dtype=np.int64).reshape(-1, 2), -1)
+        model.terminal[ends[ends >= 0]] = True
+        return model
+
+    def transition_probs(self, state, action):
+        """Take any (state, action) pair and return transition probabilities (as a dict) to all valid transition states"""
+        row = self.index[state]*self.n_actions + self.action_index[tuple(action)]
+        lo, hi = self.indptr[row], self.indptr[row+1]
+        return {
+            self.valid_states[new_s]: float(p)
+            for new_s, p in zip(self.next_states[lo:hi], self.probs[lo:hi])
+        }
+
+    def sample(self, rows, u):
+        """
+        Sample transition states of many (state, action) pairs at once
+        Arguments:
+            rows: int array of CSR rows (s*A + a)
+            u: uniform random numbers in [0, 1), same shape as rows
+        Returns the sampled state indices, -1 where u falls beyond the total probability of the row
+        (rows carry unit mass since coinciding outcomes add up, see "_compile", so only through rounding)
+        """
+        lo = self.indptr[rows]
+        counts = self.indptr[rows+1] - lo
+        last = len(self.probs) - 1
+        k = lo.copy()
+        cdf = self.probs[lo].copy()
+        for j in range(1, int(counts.max()) if len(rows) else 0):
+            # move on to entry j while u is past the cumulative probability of the entries before it
+            step = (j < counts) & (u >= cdf)
+            k += step
+            cdf = np.where(step, cdf + self.probs[np.minimum(lo+j, last)], cdf)
+        return np.where(u < cdf, self.next_states[k], -1)
+
+    def color_classes(self):
+        """
+        Partition the non-terminal states into classes with no transition between two different states of the same class
+        Updating one class at a time from the latest values is an exact (in-place) Gauss-Seidel sweep
+        Returns a list of (states, entries) index arrays, entries being the CSR entries of all rows of those states
+        Cached on the model (depends only on the topology)
+        """
+        if self._color_classes is None:
+            entry_states = self.rows // self.n_actions
+            moved = entry_states != self.next_states
+            src, dst = entry_states[moved], self.next_states[moved]
+            x, y = self.states[:, 0], self.states[:, 1]
+            colors = (x + y) % 2 # checkerboard, valid for moves to the 4 neighbours
+            if np.any(colors[src] == colors[dst]):
+                # parity blocks of period "reach + 1" always separate neighbours within reach
+                reach = np.abs(self.states[src] - self.states[dst]).max() if len(src) else 0
+                period = reach + 1
+                colors = (x % period) + period * (y % period)
+            self._color_classes = []
+            for color in np.unique(colors):
+                states = np.flatnonzero((colors == color) & ~self.terminal)
+                entries = np.flatnonzero(np.isin(entry_states, states))
+                self._color_classes.append((states, entries))
+        return self._color_classes
+
+    def predecessors(self):
+        """
+        Return the predecessor index as CSR arrays (pred_indptr, pred_states):
+        states s with a non-zero transition probability into s' are pred_states[pred_indptr[s']:pred_indptr[s'+1]]
+        End states are never predecessors (they are not expanded)
+        Cached on the model (depends only on the topology)
+        """
+        if self._predecessors is None:
+            entry_states = self.rows // self.n_actions
+            live = ~self.terminal[entry_states]
+            pairs = np.unique(np.stack([self.next_states[live], entry_states[live]], axis=1), axis=0)
+            counts = np.bincount(pairs[:, 0], minlength=self.n_states)
+            pred_indptr = np.zeros(self.n_states + 1, dtype=np.int64)
+            np.cumsum(counts, out=pred_indptr[1:])
+            self._predecessors = (pred_indptr, pairs[:, 1])
+        return self._predecessors
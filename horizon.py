@@ -0,0 +1,91 @@
+from grid_world import GridWorld
+from mario import Mario
+import argparse
+import time
+import numpy as np
+
+
+class TimeIndexedPolicy:
+    def __init__(self, horizon, starts, policies):
+        """
+        Policies of a finite-horizon solve ("Iter.by_finite_horizon"), one per decision step t = 0 .. horizon-1
+        (horizon - t steps to go). Consecutive steps with the same policy share one stored array: far from the horizon
+        the optimal policy becomes stationary, so a long horizon costs a handful of arrays instead of horizon of them
+        Arguments:
+            horizon: number of decision steps
+            starts: (K,) ascending first step of every stored policy, starts[0] = 0
+            policies: K (S,) action indices into the model actions, -1 for END (stored in the smallest int type)
+        """
+        self.horizon = horizon
+        self.starts = np.asarray(starts, dtype=np.int64)
+        # signed (END is -1) and just wide enough for the action indices
+        dtype = np.min_scalar_type(-max([1] + [int(policy.max()) for policy in policies]) - 1)
+        self.policies = [np.asarray(policy, dtype=dtype) for policy in policies]
+
+    def __len__(self):
+        return self.horizon
+
+    def __getitem__(self, t):
+        """(S,) policy of decision step t"""
+        if not 0 <= t < self.horizon:
+            raise IndexError(f'Step {t} is outside the horizon {self.horizon}')
+        return self.policies[int(np.searchsorted(self.starts, t, side='right')) - 1]
+
+    def dense(self):
+        """Return the (horizon, S) array of the policies of every step"""
+        counts = np.diff(np.append(self.starts, self.horizon))
+        return np.repeat(np.stack(self.policies), counts, axis=0)
+
+    @property
+    def nbytes(self):
+        """Bytes of the stored policies (dense() would take horizon * S entries)"""
+        return sum(policy.nbytes for policy in self.policies) + self.starts.nbytes
+
+
+def main(argv=None):
+    from iter_schemes import Iter # iter_schemes.py imports this module
+    parser = argparse.ArgumentParser(description='Finite-horizon and multi-gamma solves of a gridworld')
+    parser.add_argument('--map', default=None, help='ASCII or PNG map (see maps.py), default: the default GridWorld')
+    parser.add_argument('--horizon', type=int, default=50)
+    parser.add_argument('--gammas', type=float, nargs='+', default=[0.5, 0.8, 0.9, 0.95, 0.99])
+    parser.add_argument('--tol', type=float, default=0.000001)
+    args = parser.parse_args(argv)
+
+    if args.map is None:
+        env = GridWorld()
+    else:
+        from maps import load_map
+        env = load_map(args.map)
+    agent = Mario(env=env, gamma=max(args.gammas))
+    learn = Iter(env=env, agent=agent, tol=args.tol, write_back=False, quiet=True)
+
+    start = time.perf_counter()
+    for _ in learn.by_finite_horizon(args.horizon):
+        pass
+    policy = learn.horizon_policy
+    print(
+        f'*** Finite horizon {args.horizon} (gamma {agent.gamma}): {time.perf_counter() - start:.3f}s, '
+        f'{len(policy.policies)} distinct policies stored in {policy.nbytes} bytes '
+        f'({policy.dense().nbytes} dense) ***'
+    )
+
+    start = time.perf_counter()
+    for _ in learn.by_discount_sweep(args.gammas):
+        pass
+    sweep_time = time.perf_counter() - start
+    cold_sweeps = []
+    for gamma in learn.discount_gammas.tolist():
+        cold = Iter(env=env, agent=Mario(env=env, gamma=gamma), tol=args.tol, write_back=False, quiet=True)
+        for _ in cold.by_value_iter():
+            pass
+        cold_sweeps.append(cold.iterations)
+    print(f'*** {len(args.gammas)} gammas in {sweep_time:.3f}s ***')
+    print(f'{"gamma":>7s} {"sweeps":>7s} {"cold":>7s} {"max value":>10s}')
+    for gamma, sweeps, cold, values in zip(
+        learn.discount_gammas, learn.discount_iterations, cold_sweeps, learn.discount_values
+    ):
+        print(f'{gamma:7.3f} {sweeps:7d} {cold:7d} {values.max():10.4f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import collections
+import csv
+import functools
+import time
+
+
+class MemorySink:
+    def __init__(self):
+        """Keep every record in memory (list of dicts in self.records)"""
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+class CSVSink:
+    # columns of every record kind, missing fields are left empty
+    FIELDS = [
+        'kind', 'elapsed', 'epoch', 'iteration', 'residual', 'sweeps', 'backups', 'transition_lookups', 'policy_changes',
+        'time_backup', 'time_greedy', 'time_transition', 'time_evaluation', 'time_improvement', 'time_start',
+        'time_map', 'time_frontier', 'time_sync', 'time_record', 'time_io',
+    ]
+
+    def __init__(self, path):
+        """
+        Append records as rows of a CSV file
+        Arguments:
+            path: CSV file to create (overwritten if it exists)
+        Fields missing from FIELDS (e.g. a new phase timer) get a column of their own the first time they show up
+        """
+        self.file = open(path, 'w+', newline='')
+        self.fields = list(self.FIELDS)
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fields)
+        self.writer.writeheader()
+
+    def write(self, record):
+        new_fields = [name for name in record if name not in self.writer.fieldnames]
+        if new_fields:
+            self._add_fields(new_fields)
+        self.writer.writerow(record)
+
+    def _add_fields(self, names):
+        """Helper function: append columns to the header, rewriting the rows written so far (rare, once per new field)"""
+        self.file.seek(0)
+        rows = list(csv.DictReader(self.file))
+        self.fields += names
+        self.file.seek(0)
+        self.file.truncate()
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fields)
+        self.writer.writeheader()
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class CallbackSink:
+    def __init__(self, callback):
+        """Call callback(record) for every record"""
+        self.callback = callback
+
+    def write(self, record):
+        self.callback(record)
+
+    def close(self):
+        pass
+
+
+class _Phase:
+    """Helper class: context manager adding the time spent inside to one timer"""
+    __slots__ = ('timers', 'name', 'start')
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timers[self.name] += time.perf_counter() - self.start
+
+
+class Instrumentation:
+    def __init__(self, sinks=None):
+        """
+        Opt-in per-phase timers and counters for the solvers in iter_schemes.py, pass it as Iter(..., instrument=...)
+        Arguments:
+            sinks: objects with write(record) and close() methods (default: one "MemorySink")
+
+        Timers (seconds, 'time_<phase>' in records):
+            backup: Bellman backups (Q-values of all actions of the swept states)
+            transition: transition lookups ('dict' backend, part of backup)
+            greedy: max/argmax over actions and residuals
+            evaluation, improvement: policy evaluation and greedy improvement (policy iteration, and the policy
+                evaluations of "by_discount_sweep")
+            start: handing the model to the workers of a "SweepExecutor" (parallel sweeps)
+            map, frontier: mapping the previous solution onto the new layout and the frontier rounds ("replan")
+            sync: writing arrays back into agent "Mario", record: trajectory recorder, io: console printing
+        Counters:
+            sweeps, backups (state backups), transition_lookups ((state, action) transition rows read),
+            policy_changes (states whose action changed, per epoch in the 'epoch' records)
+        Records (dicts) are emitted to the sinks after every sweep ('sweep'), epoch ('epoch') and solve ('summary')
+        """
+        self.sinks = list(sinks) if sinks is not None else [MemorySink()]
+        self.timers = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        self.start = time.perf_counter()
+
+    def phase(self, name):
+        """Context manager timing the enclosed code under phase "name" """
+        return _Phase(self.timers, name)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def wrap(self, function, phase, counter=None):
+        """Return function timed under phase (and counted under counter on every call)"""
+        timers, counters = self.timers, self.counters
+        @functools.wraps(function)
+        def wrapped(*args, **kwargs):
+            if counter is not None:
+                counters[counter] += 1
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timers[phase] += time.perf_counter() - start
+        return wrapped
+
+    def emit(self, kind, **fields):
+        """Send a record {kind, elapsed, **fields} to all sinks"""
+        record = {'kind': kind, 'elapsed': time.perf_counter() - self.start, **fields}
+        for sink in self.sinks:
+            sink.write(record)
+
+    def summary(self):
+        """Return the totals: counters and 'time_<phase>' timers"""
+        return {**self.counters, **{f'time_{name}': value for name, value in self.timers.items()}}
+
+    def emit_summary(self):
+        self.emit('summary', **self.summary())
+
+    def reset(self):
+        self.timers.clear()
+        self.counters.clear()
+        self.start = time.perf_counter()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    @property
+    def records(self):
+        """Records of the first "MemorySink" (empty list if there is none)"""
+        for sink in self.sinks:
+            if isinstance(sink, MemorySink):
+                return sink.records
+        return []
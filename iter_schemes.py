@@ -1,20 +1,71 @@
 from grid_world import GridWorld
 from mario import Mario
-import copy
+from checkpoint import Checkpoint, fingerprint
+from horizon import TimeIndexedPolicy
+import contextlib
+import heapq
+import time
 import numpy as np
 
+NULL_PHASE = contextlib.nullcontext() # phase timer used when instrumentation is disabled
+
 class Iter:
-    def __init__(self, env, agent, tol = 0.000001):
+    def __init__(self, env, agent, tol = 0.000001, backend = 'numpy', write_back = True, recorder = None,
+                 instrument = None, quiet = False, executor = None):
         """
         Arguments:
             env: object of class "GridWorld" over which agent "Mario" is intended to learn policy on
             agent: object of class "Mario" who learns the policy
             tol: tolerance under which the difference between state-values during value iterations is considered converged
+            backend: 'numpy' (batched Bellman backup, one array operation per sweep) or 'dict' (per-state reference loop)
+            write_back: with the 'numpy' backend, copy the final values and policy into agent "Mario" at the end of a solve
+                (intermediate sweeps are written back only when requested through show_updates or anim)
+            recorder: with the 'numpy' backend, object with an append(values, policy_index, residual) method called after
+                every sweep (e.g. "TrajectoryRecorder" in recorder.py)
+            instrument: object of class "Instrumentation" (instrumentation.py) collecting per-phase timers and counters,
+                None disables instrumentation entirely
+            quiet: no per-iteration printing (show_updates still prints when explicitly requested)
+            executor: with the 'numpy' backend, object of class "SweepExecutor" (parallel.py) running the synchronous
+                value iteration sweeps on several cores, None for a single process
             NOTE: value iteration step is done during both value_iteration method and policy iteration method
         """
+        if backend not in ('numpy', 'dict'):
+            raise ValueError(f"Unknown backend '{backend}', expected 'numpy' or 'dict'")
         self.env = env
         self.agent = agent
         self.tolerance = tol
+        self.backend = backend
+        self.write_back = write_back
+        self.recorder = recorder
+        self.instrument = instrument
+        self.quiet = quiet
+        self.executor = executor
+        if instrument is not None and backend == 'dict':
+            # per-state hooks are installed on this instance only --> no cost when instrumentation is disabled
+            self.expected_Q_value = instrument.wrap(self.expected_Q_value, 'transition', 'transition_lookups')
+            self.state_value_greedy = instrument.wrap(self.state_value_greedy, 'backup')
+        self.model = env.model # compiled transition model, refreshed at the start of every solve
+        # array results of the 'numpy' backend, in the order of self.model.states
+        self.values = None # (S,) state values
+        self.policy_index = None # (S,) action indices into self.model.actions, -1 for END
+        self.expected_rewards = None # (S, A) expected immediate rewards
+        # counters of the last solve
+        self.iterations = 0 # total sweeps (value updates over all states)
+        self.epochs = 0 # policies tried (policy iteration only)
+        self.backups = 0 # state backups (Q-values of the actions of one state)
+        self.method = None # solver of the last solve, e.g. 'value_iter:synchronous'
+        self.cold_sweeps = None # sweeps of the last cold solve this solution descends from (see "warm_start")
+        # {'matched_states', 'same_problem', 'sweeps', 'cold_sweeps', 'sweeps_saved', 'previous_cold_sweeps'}
+        self.warm_start_report = None
+        self.replan_report = None # {'dirty_cells', 'seeds', 'cells_touched', 'backups', 'rounds', 'policy_time', 'time'}
+        self.horizon_policy = None # "TimeIndexedPolicy" of the last finite-horizon solve
+        # results of the last discount sweep, in increasing gamma order (see "by_discount_sweep")
+        self.discount_gammas = None # (G,) gammas
+        self.discount_values = None # (G, S) state values
+        self.discount_policies = None # (G, S) action indices, -1 for END
+        self.discount_iterations = None # (G,) sweeps of every gamma
+        self._warm = None # checkpoint the running solve was warm started from
+        self._cold_reference = None # (method, keyword arguments) of the cold reference solve, see "by_value_iter"
 
     def expected_Q_value(self, state, action):
         """
@@ -22,19 +73,21 @@ class Iter:
         Take any (state, action) pair and return expected Q value based on (expected) state values in previous iteration
         """
         q_value = 0
-        if state in self.env.end_states:
+        model = self.model
+        s = model.index[state]
+        if model.terminal[s]:
             return q_value
         
-        transition_probs = self.env.transition_probs(state, action)
-        for new_state in transition_probs:
-            prob = transition_probs[new_state]
+        row = s*model.n_actions + model.action_index[action]
+        gamma = self.agent.gamma
+        for k in range(model.indptr[row], model.indptr[row+1]):
+            new_state = model.valid_states[model.next_states[k]]
+            prob = model.probs[k]
             reward = self.env.rewards[new_state]
-            gamma = self.agent.gamma
             # state value at the new_state (newly possible transition state) as calulated in previous iteration
             prev_iter_state_value = self.agent.state_values[new_state] 
             q_value += prob * (reward + gamma* prev_iter_state_value)
-        # Gauss seidel variety would be wrong (unstable)
-        # q_val += prob*(self.env.rewards[new_state] + gamma*self.agent.state_value[new_state])
+        # In-place (Gauss seidel) updates are available with the 'numpy' backend, see "by_value_iter"
         return q_value
 
     def state_value_greedy(self, state):
@@ -63,24 +116,662 @@ class Iter:
         policy_value = self.expected_Q_value(state, action)
         _, best_action = self.state_value_greedy(state)
         return policy_value, best_action # return best action too
-    
-    def by_value_iter(self, show_updates = False, anim = False):
+
+    def _phase(self, name):
+        """Helper function: timer of phase "name" (a no-op without instrumentation)"""
+        return NULL_PHASE if self.instrument is None else self.instrument.phase(name)
+
+    def log(self, message):
+        """Helper function: print a progress message unless quiet"""
+        if not self.quiet:
+            with self._phase('io'):
+                print(message)
+
+    def _start_solve(self):
+        """Helper function: reset the counters of the last solve"""
+        self.iterations = self.epochs = self.backups = 0
+        if self.instrument is not None:
+            self.instrument.reset()
+
+    def _finish_solve(self):
+        """Helper function: final write back, warm start report and instrumentation summary"""
+        if self.write_back and self.backend == 'numpy':
+            with self._phase('sync'):
+                self.sync_agent()
+        checkpoint, self._warm = self._warm, None
+        if checkpoint is None:
+            self.cold_sweeps = self.iterations
+            self.warm_start_report = None
+        else:
+            # the cold reference is only comparable when the same solver produced it for the same problem
+            # (after a reward or layout change it counts the sweeps of the previous problem, not of this one)
+            report = self.warm_start_report
+            same_solver = checkpoint.method == self.method
+            self.cold_sweeps = checkpoint.cold_sweeps if same_solver and report['same_problem'] else None
+            if self.cold_sweeps is None and self._cold_reference is not None:
+                self.cold_sweeps = self.cold_reference_sweeps(*self._cold_reference)
+            report['sweeps'] = self.iterations
+            report['cold_sweeps'] = self.cold_sweeps
+            report['sweeps_saved'] = None if self.cold_sweeps is None else self.cold_sweeps - self.iterations
+            report['previous_cold_sweeps'] = None if report['same_problem'] or not same_solver else checkpoint.cold_sweeps
+            if report['previous_cold_sweeps'] is not None and report['sweeps_saved'] is None:
+                self.log(
+                    f'*** Warm start: {self.iterations} sweeps (the previous problem took {checkpoint.cold_sweeps} '
+                    f'from a cold start, no cold start reference for this one) ***'
+                )
+            elif self.cold_sweeps is None:
+                self.log(f'*** Warm start: {self.iterations} sweeps (no cold start reference for {self.method}) ***')
+            else:
+                self.log(
+                    f'*** Warm start: {self.iterations} sweeps instead of {self.cold_sweeps} '
+                    f'--> {self.cold_sweeps - self.iterations} sweeps saved ***'
+                )
+        if self.instrument is not None:
+            self.instrument.counters['backups'] = int(self.backups)
+            self.instrument.emit_summary()
+
+    def cold_reference_sweeps(self, method, kwargs):
+        """
+        Helper function: Used for the cold_reference argument of the solvers
+        Solve the current problem from a cold start with a scratch agent "Mario" (same solver, backend and tol, nothing
+        written back, printed or instrumented) and return its number of sweeps
+        """
+        learn = Iter(env=self.env, agent=Mario(env=self.env, gamma=self.agent.gamma), tol=self.tolerance,
+                     backend=self.backend, write_back=False, quiet=True)
+        for _ in getattr(learn, method)(**kwargs):
+            pass
+        return learn.iterations
+
+    def _report_sweep(self, residual, message, frame, show_updates, anim):
+        """
+        Helper function: Used for the 'numpy' backend, bookkeeping after every sweep
+        (recorder, instrumentation, log, show_updates and animation frame)
+        """
+        if self.recorder is not None:
+            with self._phase('record'):
+                self.recorder.append(self.values, self.policy_index, residual)
+        if self.instrument is not None:
+            self.instrument.count('sweeps')
+            self.instrument.emit(
+                'sweep', iteration=self.iterations, epoch=self.epochs, residual=float(residual), backups=int(self.backups)
+            )
+        self.log(message)
+        if show_updates:
+            self.sync_agent()
+            self.agent.show_state_values()
+            self.agent.show_policy()
+        # wait for animation
+        if anim:
+            with self._phase('sync'):
+                self.sync_agent()
+            yield frame
+
+    def load_arrays(self):
+        """
+        Helper function: Used for the 'numpy' backend
+        Refresh the compiled model and read agent "Mario"'s state values and policy into (S,) arrays
+        """
+        self.model = self.env.model
+        self.values, self.policy_index = self.read_agent()
+        # expected immediate reward of every (state, action) pair --> fixed for the whole solve
+        rewards = self.env.reward_vector()
+        self.expected_rewards = self.batched_expectation(rewards)
+
+    def read_agent(self):
+        """
+        Helper function: Used for the 'numpy' backend and "warm_start"
+        Return agent "Mario"'s state values and policy as (S,) arrays, in the order of self.model.states
+        """
+        model = self.model
+        self.agent.sync_layout()
+        if self.agent.storage == 'array':
+            cells = (model.states[:, 1]-1, model.states[:, 0]-1)
+            values = self.agent.value_grid[cells].astype(np.float64)
+            policy_index = np.where(model.terminal, -1, np.maximum(self.agent.action_grid[cells], 0)).astype(np.int64)
+        else:
+            values = np.array([self.agent.state_values[state] for state in model.valid_states], dtype=np.float64)
+            policy_index = np.array([
+                -1 if model.terminal[s] else model.action_index.get(self.agent.policy[state][0], 0)
+                for s, state in enumerate(model.valid_states)
+            ], dtype=np.int64)
+        return values, policy_index
+
+    def save_checkpoint(self, path):
+        """
+        Save the current solution (state values, policy, counters of the last solve and the problem fingerprint) to path
+        Returns the object of class "Checkpoint" (checkpoint.py) that was written
+        """
+        self.model = self.env.model
+        if self.backend == 'numpy' and self.values is not None and len(self.values) == self.model.n_states:
+            values, policy_index = self.values, self.policy_index
+        else:
+            values, policy_index = self.read_agent()
+        checkpoint = Checkpoint(
+            self.env.xdim, self.env.ydim, self.model.states, self.model.actions, values, policy_index,
+            self.agent.gamma, fingerprint(self.env, self.agent.gamma), self.method,
+            self.iterations, self.epochs, self.backups, self.cold_sweeps,
+        )
+        checkpoint.save(path)
+        return checkpoint
+
+    def warm_start(self, checkpoint):
+        """
+        Write a previous solution into agent "Mario" as the starting point of the next solve
+            checkpoint: object of class "Checkpoint" or path of a checkpoint file (see "save_checkpoint")
+        States are matched by coordinates, so the previous grid may differ locally (moved blocked cells, end states,
+        rewards): matched states start from their previous value and action, the others keep the agent's current ones
+        Returns the checkpoint
+        """
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint.load(checkpoint)
+        self.model = self.env.model
+        model = self.model
+        values, policy_index = self.read_agent()
+        model_indices, checkpoint_indices = checkpoint.state_map(model)
+        values[model_indices] = checkpoint.values[checkpoint_indices]
+        action_map = np.array([model.action_index.get(tuple(action), -1) for action in checkpoint.actions.tolist()])
+        previous = checkpoint.policy[checkpoint_indices].astype(np.int64)
+        mapped = np.where(previous >= 0, action_map[np.maximum(previous, 0)], -1)
+        # former end states (and unknown actions) keep the current action
+        policy_index[model_indices] = np.where(mapped >= 0, mapped, policy_index[model_indices])
+        matched = np.zeros(model.n_states, dtype=bool)
+        matched[model_indices] = True
+        self._fill_new_states(values, matched)
+        values[model.terminal] = 0
+        policy_index[model.terminal] = -1
+        self.values, self.policy_index = values, policy_index
+        self.sync_agent()
+        self.warm_start_report = {
+            'matched_states': len(model_indices),
+            'sweeps': None, 'cold_sweeps': None, 'sweeps_saved': None, 'previous_cold_sweeps': None,
+            'same_problem': checkpoint.fingerprint == fingerprint(self.env, self.agent.gamma),
+        }
+        return checkpoint
+
+    def _fill_new_states(self, values, matched):
+        """
+        Helper function: Used for "warm_start" and "replan"
+        States new to the grid (e.g. a freed blocked cell) start from the mean value of their matched neighbours
+        """
+        model = self.model
+        new_states = np.flatnonzero(~matched & ~model.terminal)
+        if len(new_states) and matched.any():
+            neighbours = model._lookup(model.states[new_states][:, None, :] + np.array(model.actions)[None, :, :], -1)
+            weights = (neighbours >= 0) & matched[np.maximum(neighbours, 0)]
+            total = (weights * values[np.maximum(neighbours, 0)]).sum(axis=1)
+            count = weights.sum(axis=1)
+            values[new_states] = np.where(count > 0, total / np.maximum(count, 1), values[new_states])
+
+    def batched_expectation(self, vector):
+        """
+        Helper function: Used for the 'numpy' backend
+        Take any (S,) array over states and return its (S, A) expectation over transition states for every (state, action) pair
+        """
+        model = self.model
+        if self.instrument is not None:
+            self.instrument.count('transition_lookups', model.n_states*model.n_actions)
+        weights = model.probs * vector[model.next_states]
+        return np.bincount(model.rows, weights=weights, minlength=model.n_states*model.n_actions).reshape(
+            model.n_states, model.n_actions
+        )
+
+    def batched_Q_values(self, values):
+        """
+        Helper function: Used for the 'numpy' backend
+        Take (S,) state values of the previous iteration and return (S, A) Q-values (zero at end states)
+        """
+        Q_values = self.expected_rewards + self.agent.gamma * self.batched_expectation(values)
+        Q_values[self.model.terminal] = 0
+        return Q_values
+
+    def sync_agent(self):
+        """
+        Helper function: Used for the 'numpy' backend
+        Write the array results back into agent "Mario"'s state_values and policy (see "Mario.write_arrays")
+        """
+        self.agent.write_arrays(self.model, self.values, self.policy_index)
+
+    def subset_Q_values(self, states, entries):
+        """
+        Helper function: Used for in-place sweeps ("by_value_iter" with sweep = 'gauss_seidel' or 'prioritized')
+        Take state indices and the CSR entries of their rows and return their (len(states), A) Q-values from the latest values
+        """
+        model = self.model
+        A = model.n_actions
+        if self.instrument is not None:
+            self.instrument.count('transition_lookups', len(states)*A)
+        local_rows = np.searchsorted(states, model.rows[entries] // A) * A + model.rows[entries] % A
+        expectation = np.bincount(
+            local_rows, weights=model.probs[entries] * self.values[model.next_states[entries]], minlength=len(states)*A
+        ).reshape(len(states), A)
+        return self.expected_rewards[states] + self.agent.gamma * expectation
+
+    def _value_iter_numpy(self, show_updates, anim, sweep):
+        """Value iteration with the 'numpy' backend, see "by_value_iter" """
+        self.load_arrays()
+        terminal = self.model.terminal
+        n_live = int((~terminal).sum())
+        gamma = self.agent.gamma
+        iter = 0
+        self._start_solve()
+        if sweep == 'prioritized':
+            yield from self._prioritized_sweeping(show_updates, anim)
+            return
+        if sweep == 'synchronous' and self.executor is not None:
+            yield from self._parallel_sweeps(show_updates, anim)
+            return
+        # successive changes of a gamma-contraction bound the distance to the fixed point:
+        #   |v_k+1 - v*| <= gamma/(1-gamma) |v_k+1 - v_k|, so in-place sweeps stop once |v_k+1 - v_k| < tol*(1-gamma)/gamma
+        threshold = self.tolerance if sweep == 'synchronous' else self.tolerance * (1 - gamma) / max(gamma, 1e-12)
+        val_error = np.ones(self.model.n_states)
+        while val_error.max() > threshold:
+            if sweep == 'synchronous':
+                with self._phase('backup'):
+                    Q_values = self.batched_Q_values(self.values)
+                with self._phase('greedy'):
+                    state_values = Q_values.max(axis=1)
+                    val_error = np.abs(state_values - self.values)
+                    val_error[terminal] = 0
+                    self.values = state_values
+                    self.policy_index = np.where(terminal, -1, Q_values.argmax(axis=1))
+            else:
+                # Gauss-Seidel: classes are updated in turn, each one from the values just written by the previous ones
+                val_error = np.zeros(self.model.n_states)
+                for states, entries in self.model.color_classes():
+                    with self._phase('backup'):
+                        Q_values = self.subset_Q_values(states, entries)
+                    with self._phase('greedy'):
+                        state_values = Q_values.max(axis=1)
+                        val_error[states] = np.abs(state_values - self.values[states])
+                        self.values[states] = state_values
+                        self.policy_index[states] = Q_values.argmax(axis=1)
+            self.backups += n_live
+            # print log
+            iter += 1
+            self.iterations = iter
+            yield from self._report_sweep(val_error.max(), f'--> Iteration {iter}', "Iter: {}".format(iter), show_updates, anim)
+        self._finish_solve()
+
+    def _parallel_sweeps(self, show_updates, anim):
+        """
+        Synchronous value iteration on the worker processes of self.executor, see "by_value_iter"
+        self.values and self.policy_index are views into the executor's shared memory during the solve, copies after it
+        """
+        n_live = int((~self.model.terminal).sum())
+        with self._phase('start'):
+            self.executor.start(self.model, self.expected_rewards, self.agent.gamma, self.values)
+        try:
+            residual = np.inf
+            while residual > self.tolerance:
+                with self._phase('backup'):
+                    residual = self.executor.sweep()
+                if self.instrument is not None:
+                    self.instrument.count('transition_lookups', self.model.n_states*self.model.n_actions)
+                self.values, self.policy_index = self.executor.values, self.executor.policy_index
+                self.backups += n_live
+                self.iterations += 1
+                yield from self._report_sweep(
+                    residual, f'--> Iteration {self.iterations}', "Iter: {}".format(self.iterations), show_updates, anim
+                )
+        finally:
+            self.values, self.policy_index = self.executor.values.copy(), self.executor.policy_index.copy()
+            self.executor.close()
+        self._finish_solve()
+
+    def _prioritized_sweeping(self, show_updates, anim):
+        """
+        Value iteration by prioritized sweeping, see "by_value_iter"
+        One state is backed up at a time, the one with the largest Bellman residual |max_a Q(s,a) - v(s)|.
+        Residuals are kept exact: when v(s) changes, only the predecessors of s are re-evaluated.
+        Stops when every residual is under tol*(1-gamma), which bounds |v - v*| <= |Tv - v|/(1-gamma) < tol
+        Only pays off in backups on large maps with sparse rewards (see "compare_sweeps" in benchmark.py, same guarantee
+        for all runs): more backups than synchronous sweeps at 25x25 (49951 vs 45522), fewer from about 50x50 (173843
+        vs 278752) and fewer than Gauss-Seidel from about 100x100 (294387 vs 629860). One state at a time in Python,
+        it is slower in wall time than both at every size measured up to 200x200
+        """
+        model = self.model
+        terminal = model.terminal
+        A = model.n_actions
+        gamma = self.agent.gamma
+        pred_indptr, pred_states = model.predecessors()
+        threshold = self.tolerance * (1 - gamma)
+        n_states = model.n_states
+
+        with self._phase('backup'):
+            Q_values = self.batched_Q_values(self.values)
+        pending = Q_values.max(axis=1) # value each state would take when backed up next
+        residual = np.abs(pending - self.values)
+        residual[terminal] = 0
+        self.policy_index = np.where(terminal, -1, Q_values.argmax(axis=1))
+        self.backups += int((~terminal).sum())
+        queue = [(-res, s) for s, res in enumerate(residual.tolist()) if res > threshold]
+        heapq.heapify(queue)
+
+        updates = 0
+        iter = 0
+        while queue:
+            neg_res, s = heapq.heappop(queue)
+            if -neg_res != residual[s]:
+                continue # stale entry, the state was re-prioritized after this push
+            self.values[s] = pending[s]
+            residual[s] = 0
+            for p in pred_states[pred_indptr[s]:pred_indptr[s+1]]:
+                lo, hi = model.indptr[p*A], model.indptr[p*A + A]
+                q = self.expected_rewards[p] + gamma * np.bincount(
+                    model.rows[lo:hi] - p*A, weights=model.probs[lo:hi] * self.values[model.next_states[lo:hi]], minlength=A
+                )
+                pending[p] = q.max()
+                self.policy_index[p] = q.argmax()
+                residual[p] = abs(pending[p] - self.values[p])
+                if residual[p] > threshold:
+                    heapq.heappush(queue, (-residual[p], p))
+            self.backups += pred_indptr[s+1] - pred_indptr[s]
+            updates += 1
+            if updates % n_states == 0 or not queue:
+                # report once per sweep-equivalent (n_states updates)
+                iter += 1
+                self.iterations = iter
+                yield from self._report_sweep(
+                    residual.max(), f'--> Iteration {iter} | Updates {updates}', "Iter: {}".format(iter), show_updates, anim
+                )
+        self.backups = int(self.backups)
+        if self.instrument is not None:
+            self.instrument.counters['transition_lookups'] = A*self.backups
+        self._finish_solve()
+
+    def _row_entries(self, states):
+        """Helper function: CSR entries of all rows of the (sorted) state indices, see "subset_Q_values" """
+        model = self.model
+        A = model.n_actions
+        lo, hi = model.indptr[states*A], model.indptr[states*A + A]
+        counts = hi - lo
+        return np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    def replan(self, show_updates = False, anim = False):
+        """
+        Update the last solution after changes made through the "GridWorld" mutators ("add_blocked", "remove_blocked",
+        "set_end_state", "update_reward"), without solving again ('numpy' backend only)
+        The previous values and policy are carried over by coordinates (see "warm_start"). The states that can move into
+        the dirty cells are backed up first, then changes propagate outward as a frontier: every state whose value changed
+        by more than tol has the states that can move into it backed up in the next round, until the frontier is empty.
+        Same stopping rule as by_value_iter(sweep='synchronous'), restricted to the frontier; states the changes never
+        reach keep their previous values. Rewards must be changed through "update_reward"
+        The report is kept in self.replan_report:
+            dirty_cells: changed cells, seeds: states backed up first, cells_touched: states backed up at least once
+            backups: state backups, rounds: frontier rounds (also in self.iterations)
+            policy_time: seconds until every state of the new layout has an action, greedy around the changes
+            time: seconds until the frontier is empty
+        """
+        if self.backend != 'numpy':
+            raise ValueError("replan needs the 'numpy' backend")
+        start = time.perf_counter()
+        self.method = 'replan'
+        self._start_solve()
+        cold_sweeps = self.cold_sweeps
+        previous = self.model
+        if self.values is None or len(self.values) != previous.n_states:
+            self.values, self.policy_index = self.read_agent()
+        dirty, self.env.dirty = self.env.dirty, set()
+        self.model = model = self.env.model
+        A = model.n_actions
+        with self._phase('map'):
+            # previous solution --> new layout, by coordinates
+            new_index = model._lookup(previous.states, -1)
+            carried = new_index >= 0
+            matched = np.zeros(model.n_states, dtype=bool)
+            matched[new_index[carried]] = True
+            values = np.zeros(model.n_states)
+            values[new_index[carried]] = self.values[carried]
+            policy_index = np.zeros(model.n_states, dtype=np.int64)
+            policy_index[new_index[carried]] = self.policy_index[carried]
+            self.values, self.policy_index = values, policy_index
+            self._fill_new_states(values, matched)
+            values[model.terminal] = 0
+            policy_index[model.terminal] = -1
+            self.agent.sync_layout()
+            seeds = model.sources(sorted(dirty))
+            seeds = seeds[~model.terminal[seeds]]
+            # expected rewards only change in the rows that can move into a dirty cell
+            expected_rewards = self.expected_rewards
+            if expected_rewards is None or len(expected_rewards) != previous.n_states:
+                self.expected_rewards = self.batched_expectation(self.env.reward_vector())
+            else:
+                self.expected_rewards = np.zeros((model.n_states, A))
+                self.expected_rewards[new_index[carried]] = expected_rewards[carried]
+                entries = self._row_entries(seeds)
+                rewards = np.array([self.env.rewards[model.valid_states[s]] for s in model.next_states[entries].tolist()])
+                self.expected_rewards[seeds] = np.bincount(
+                    np.searchsorted(seeds, model.rows[entries] // A) * A + model.rows[entries] % A,
+                    weights=model.probs[entries] * rewards, minlength=len(seeds)*A,
+                ).reshape(len(seeds), A)
+        touched = np.zeros(model.n_states, dtype=bool)
+        policy_time = None
+        frontier = seeds
+        while len(frontier):
+            with self._phase('backup'):
+                Q_values = self.subset_Q_values(frontier, self._row_entries(frontier))
+            with self._phase('greedy'):
+                state_values = Q_values.max(axis=1)
+                change = np.abs(state_values - values[frontier])
+                values[frontier] = state_values
+                policy_index[frontier] = Q_values.argmax(axis=1)
+                touched[frontier] = True
+                self.backups += len(frontier)
+            if policy_time is None:
+                policy_time = time.perf_counter() - start
+            with self._phase('frontier'):
+                moved = frontier[change > self.tolerance]
+                frontier = model.sources(model.states[moved])
+                frontier = frontier[~model.terminal[frontier]]
+            self.iterations += 1
+            yield from self._report_sweep(
+                change.max(), f'--> Round {self.iterations} | {len(moved)} states changed', "Round: {}".format(self.iterations),
+                show_updates, anim
+            )
+        if policy_time is None:
+            policy_time = time.perf_counter() - start
+        self.replan_report = {
+            'dirty_cells': len(dirty), 'seeds': len(seeds), 'cells_touched': int(touched.sum()), 'backups': int(self.backups),
+            'rounds': self.iterations, 'policy_time': policy_time, 'time': time.perf_counter() - start,
+        }
+        self.log(
+            f"*** Replan: {len(dirty)} dirty cells, {self.replan_report['cells_touched']} of {model.n_states} states touched, "
+            f"valid policy after {1e3*policy_time:.2f} ms, converged after {1e3*self.replan_report['time']:.2f} ms ***"
+        )
+        self._finish_solve()
+        # a replan is not a cold solve, and once the layout changed the reference of the solve it updates is void
+        self.cold_sweeps = None if dirty else cold_sweeps
+
+    def policy_matrix(self, policy_index):
+        """
+        Helper function: Used for function "by_policy_iter" with the 'numpy' backend
+        Take (S,) action indices and return the transition matrix of that policy as CSR-style triplets
+        (rows, cols, probs) together with the (S,) expected reward vector r_pi (rows of end states are dropped)
+        """
+        model = self.model
+        actions = np.maximum(policy_index, 0)
+        entry_states = model.rows // model.n_actions
+        selected = (model.rows % model.n_actions == actions[entry_states]) & ~model.terminal[entry_states]
+        policy_rewards = self.expected_rewards[np.arange(model.n_states), actions]
+        policy_rewards[model.terminal] = 0
+        return entry_states[selected], model.next_states[selected], model.probs[selected], policy_rewards
+
+    def solve_policy_values(self, policy_index, linear_solver = 'direct', gamma = None):
+        """
+        Helper function: Used for function "by_policy_iter" with evaluation = 'exact' (and "by_discount_sweep")
+        Solve (I - gamma*P_pi) v = r_pi for the state values of the policy given as (S,) action indices
+            linear_solver: 'direct' (sparse LU through scipy when installed, dense LU on small maps otherwise) or
+                           'bicgstab' (matrix-free BiCGSTAB on the compiled tables, NumPy only)
+            gamma: discount (None for the agent's)
+        """
+        rows, cols, probs, policy_rewards = self.policy_matrix(policy_index)
+        n_states = self.model.n_states
+        gamma = self.agent.gamma if gamma is None else gamma
+        if linear_solver == 'direct':
+            try:
+                from scipy.sparse import csc_matrix, identity
+                from scipy.sparse.linalg import splu
+            except ImportError:
+                if n_states > 2000:
+                    # dense LU is cubic in the number of states --> use the matrix-free solver on large maps
+                    return self.solve_policy_values(policy_index, 'bicgstab', gamma)
+                system = np.eye(n_states)
+                np.add.at(system, (rows, cols), -gamma * probs)
+                return np.linalg.solve(system, policy_rewards)
+            system = identity(n_states, format='csc') - gamma * csc_matrix((probs, (rows, cols)), shape=(n_states, n_states))
+            return splu(system).solve(policy_rewards)
+        if linear_solver == 'bicgstab':
+            def matvec(v):
+                if self.instrument is not None:
+                    self.instrument.count('transition_lookups', n_states)
+                return v - gamma * np.bincount(rows, weights=probs * v[cols], minlength=n_states)
+            return self._bicgstab(matvec, policy_rewards, self.values, gamma)
+        raise ValueError(f"Unknown linear_solver '{linear_solver}', expected 'direct' or 'bicgstab'")
+
+    def _bicgstab(self, matvec, b, x0, gamma):
+        """Helper function: BiCGSTAB solve of matvec(x) = b, converged when the residual drops below tol*(1-gamma)"""
+        x = x0.copy()
+        r = b - matvec(x)
+        r_hat = r.copy()
+        rho = alpha = omega = 1.0
+        v = p = np.zeros_like(b)
+        stop = self.tolerance * (1 - gamma)
+        for _ in range(10 * len(b) + 100): # safety cap, BiCGSTAB converges in far fewer steps for gamma < 1
+            if np.abs(r).max() < stop:
+                break
+            rho_new = r_hat @ r
+            if rho_new == 0:
+                break
+            p = r + (rho_new / rho) * (alpha / omega) * (p - omega * v)
+            v = matvec(p)
+            alpha = rho_new / (r_hat @ v)
+            s = r - alpha * v
+            t = matvec(s)
+            omega = (t @ s) / (t @ t) if t @ t > 0 else 0.0
+            x += alpha * p + omega * s
+            r = s - omega * t
+            rho = rho_new
+            if omega == 0:
+                break
+        return x
+
+    def greedy_improvement(self, policy_index):
+        """
+        Helper function: Used for function "by_policy_iter" with the 'numpy' backend
+        Return the greedy policy w.r.t. the current state values, keeping the current action on (numerical) ties
+        so that policy iteration cannot cycle between equally good actions
+        """
+        Q_values = self.batched_Q_values(self.values)
+        states = np.arange(self.model.n_states)
+        best = Q_values.argmax(axis=1)
+        current = np.maximum(policy_index, 0)
+        tie = Q_values[states, current] >= Q_values[states, best] - 1e-12 * np.maximum(1, np.abs(Q_values[states, best]))
+        return np.where(self.model.terminal, -1, np.where(tie, current, best))
+
+    def _policy_iter_numpy(self, show_updates, anim, evaluation, sweeps, linear_solver):
+        """Policy iteration with the 'numpy' backend, see "by_policy_iter" """
+        self.load_arrays()
+        terminal = self.model.terminal
+        self._start_solve()
+        n_live = int((~terminal).sum())
+        n_states = self.model.n_states
+        epoch = 0 # counts number of policies tried
+        total_steps = 0
+        while True:
+            epoch += 1
+            self.epochs = epoch
+            iter = 0
+            rows, cols, probs, policy_rewards = self.policy_matrix(self.policy_index)
+            val_error = np.ones(n_states)
+            while val_error.max() > self.tolerance:
+                with self._phase('evaluation'):
+                    if evaluation == 'exact':
+                        policy_values = self.solve_policy_values(self.policy_index, linear_solver)
+                    else:
+                        policy_values = policy_rewards + self.agent.gamma * np.bincount(
+                            rows, weights=probs * self.values[cols], minlength=n_states
+                        )
+                        self.backups += n_live
+                        if self.instrument is not None:
+                            self.instrument.count('transition_lookups', n_live)
+                    val_error = np.abs(policy_values - self.values)
+                    val_error[terminal] = 0
+                    self.values = policy_values
+                # print log
+                iter += 1
+                total_steps += 1
+                self.iterations = total_steps
+                yield from self._report_sweep(
+                    val_error.max(), f'Epoch {epoch} --> Iteration {iter} | Total steps {total_steps}',
+                    "Epoch: {}, Iter: {}, Steps: {}".format(epoch, iter, total_steps), show_updates, anim
+                )
+                if evaluation == 'exact' or (evaluation == 'modified' and iter >= sweeps):
+                    break
+            # Policy improvement is done once per epoch, on the evaluated state values
+            with self._phase('improvement'):
+                updated_policy = self.greedy_improvement(self.policy_index)
+            self.backups += n_live
+            if self.instrument is not None:
+                policy_changes = int((updated_policy != self.policy_index).sum())
+                self.instrument.count('policy_changes', policy_changes)
+                self.instrument.emit('epoch', epoch=epoch, sweeps=iter, policy_changes=policy_changes)
+            if not np.array_equal(updated_policy, self.policy_index):
+                self.policy_index = updated_policy
+                self.log(f' --> Updated policy for Epoch {epoch+1}')
+                if not self.quiet:
+                    with self._phase('io'):
+                        self.sync_agent()
+                        self.agent.show_policy()
+            elif evaluation == 'modified' and val_error.max() > self.tolerance:
+                continue # policy is stable but its values are not converged yet
+            else:
+                break
+        self._finish_solve()
+
+    def by_value_iter(self, show_updates = False, anim = False, sweep = 'synchronous', warm_start = None,
+                      cold_reference = False):
         """
         Calculate Optimal Policy using Value Iteration
+            sweep: how states are updated ('numpy' backend only, except 'synchronous')
+                'synchronous': every state from the values of the previous iteration (stops when the change is under tol)
+                'gauss_seidel': in place, every state from the latest values (see "TransitionModel.color_classes" in grid_world.py)
+                'prioritized': prioritized sweeping, one state at a time by largest Bellman residual (fewer backups on
+                               large sparse-reward maps only, more on small ones, see "_prioritized_sweeping")
+            'gauss_seidel' and 'prioritized' stop with state values guaranteed within tol of the optimal ones
+            warm_start: "Checkpoint" or checkpoint path to start from instead of agent "Mario"'s current values
+                (see "warm_start", the sweeps saved are logged and kept in self.warm_start_report when the checkpoint
+                is of the same problem, otherwise only the cold sweeps of its problem are reported)
+            cold_reference: with warm_start, solve the new problem once more from a cold start when the checkpoint
+                has no cold sweep count for it (reward or layout changes), so that self.warm_start_report always gives
+                the sweeps saved (see "cold_reference_sweeps", costs one extra cold solve)
         """
+        if sweep not in ('synchronous', 'gauss_seidel', 'prioritized'):
+            raise ValueError(f"Unknown sweep '{sweep}', expected 'synchronous', 'gauss_seidel' or 'prioritized'")
+        self.method = f'value_iter:{sweep}'
+        self._warm = self.warm_start(warm_start) if warm_start is not None else None
+        self._cold_reference = ('by_value_iter', {'sweep': sweep}) if cold_reference else None
+        if self.backend == 'numpy':
+            yield from self._value_iter_numpy(show_updates, anim, sweep)
+            return
+        if sweep != 'synchronous':
+            raise ValueError(f"sweep '{sweep}' needs the 'numpy' backend")
         iter = 0
+        self._start_solve()
+        self.model = self.env.model
+        terminal = self.model.terminal
         val_error = np.ones(len(self.env.valid_states))
         while val_error.max() > self.tolerance: 
             curr_iter_state_values = {}
             updated_policy = {}
             for i, state in enumerate(self.env.valid_states):
-                if state in self.env.end_states:
+                if terminal[i]:
                     curr_iter_state_values[state] = 0
                     updated_policy[state] = ((0,0),'END')
                     val_error[i] = 0
                 else:
                     # get best Q-value action pair
                     state_value, action = self.state_value_greedy(state)
+                    self.backups += 1
                     # store in the answers in temp dicts
                     curr_iter_state_values[state] = state_value
                     updated_policy[state] = (action, self.env.action_space[action])
@@ -90,7 +781,11 @@ class Iter:
             self.agent.policy = updated_policy
             # print log
             iter += 1
-            print(f'--> Iteration {iter}')
+            self.iterations = iter
+            if self.instrument is not None:
+                self.instrument.count('sweeps')
+                self.instrument.emit('sweep', iteration=iter, residual=float(val_error.max()), backups=self.backups)
+            self.log(f'--> Iteration {iter}')
             if show_updates:
                 self.agent.show_state_values()
                 self.agent.show_policy()
@@ -100,28 +795,56 @@ class Iter:
             # Policy extraction, in a way, is done once for every loop over the states
             # We just save the current policy (as the while loop can end any time)
             # We don't use this policy in our subsequent calculation anywhere
+        self._finish_solve()
 
-    def by_policy_iter(self, show_updates = False, anim=False):
+    def by_policy_iter(self, show_updates = False, anim=False, evaluation = 'iterative', sweeps = 5, linear_solver = 'direct',
+                       warm_start = None, cold_reference = False):
         """
         Calculate Optimal Policy using Policy Iteration
+            evaluation: how the current policy is evaluated in every epoch ('numpy' backend only, except 'iterative')
+                'iterative': fixed-point sweeps until the change in state values is under tol
+                'exact': solve (I - gamma*P_pi) v = r_pi directly (see "solve_policy_values")
+                'modified': modified policy iteration, a fixed number of evaluation sweeps per epoch
+            sweeps: number of evaluation sweeps per epoch for evaluation = 'modified'
+            linear_solver: 'direct' or 'bicgstab', used for evaluation = 'exact'
+            warm_start: "Checkpoint" or checkpoint path to start from (previous values and policy), see "by_value_iter"
+            cold_reference: cold solve of the new problem for the warm start report, see "by_value_iter"
         """
+        if evaluation not in ('iterative', 'exact', 'modified'):
+            raise ValueError(f"Unknown evaluation '{evaluation}', expected 'iterative', 'exact' or 'modified'")
+        self.method = f'policy_iter:{evaluation}'
+        self._warm = self.warm_start(warm_start) if warm_start is not None else None
+        self._cold_reference = (
+            ('by_policy_iter', {'evaluation': evaluation, 'sweeps': sweeps, 'linear_solver': linear_solver})
+            if cold_reference else None
+        )
+        if self.backend == 'numpy':
+            yield from self._policy_iter_numpy(show_updates, anim, evaluation, sweeps, linear_solver)
+            return
+        if evaluation != 'iterative':
+            raise ValueError(f"evaluation '{evaluation}' needs the 'numpy' backend")
         epoch = 0 # counts number of policies tried
         total_steps = 0
+        self._start_solve()
+        self.model = self.env.model
+        terminal = self.model.terminal
         while True:
             epoch += 1
+            self.epochs = epoch
             iter = 0
             updated_policy = {}
             val_error = np.ones(len(self.env.valid_states))
             while val_error.max() > self.tolerance:
                 curr_iter_state_values = {}
                 for i, state in enumerate(self.env.valid_states):
-                    if state in self.env.end_states:
+                    if terminal[i]:
                         curr_iter_state_values[state] = 0
                         updated_policy[state] = ((0,0),'END')
                         val_error[i] = 0
                     else:
                         # get predicted Q-value and best action
                         policy_value, action = self.state_value_policy(state)
+                        self.backups += 1
                         # store in the answers in temp dicts
                         curr_iter_state_values[state] = policy_value
                         updated_policy[state] = (action, self.env.action_space[action])
@@ -131,7 +854,13 @@ class Iter:
                 # print log
                 iter += 1
                 total_steps += 1
-                print(f'Epoch {epoch} --> Iteration {iter} | Total steps {total_steps}')
+                self.iterations = total_steps
+                if self.instrument is not None:
+                    self.instrument.count('sweeps')
+                    self.instrument.emit(
+                        'sweep', iteration=total_steps, epoch=epoch, residual=float(val_error.max()), backups=self.backups
+                    )
+                self.log(f'Epoch {epoch} --> Iteration {iter} | Total steps {total_steps}')
                 if show_updates:
                     self.agent.show_state_values()
                     self.agent.show_policy()
@@ -141,13 +870,131 @@ class Iter:
                 # Policy improvement, in a way, is done once for every loop over the states
                 # We just save the current best policy (as the while loop can end any time)
                 # We don't use this policy in our subsequent calculation untill next loop
+            if self.instrument is not None:
+                policy_changes = sum(updated_policy[state] != self.agent.policy[state] for state in updated_policy)
+                self.instrument.count('policy_changes', policy_changes)
+                self.instrument.emit('epoch', epoch=epoch, sweeps=iter, policy_changes=policy_changes)
             if updated_policy != self.agent.policy:
-                self.agent.policy = copy.deepcopy(updated_policy)
-                print(f' --> Updated policy for Epoch {epoch+1}')
-                self.agent.show_policy()
+                # updated_policy is built fresh every epoch and holds immutable tuples --> no copy needed
+                self.agent.policy = updated_policy
+                self.log(f' --> Updated policy for Epoch {epoch+1}')
+                if not self.quiet:
+                    self.agent.show_policy()
             else:
                 break
-    
+        self._finish_solve()
+
+    def by_finite_horizon(self, horizon, show_updates = False, anim = False, terminal_values = None):
+        """
+        Calculate the optimal policies of the finite-horizon problem by backward induction ('numpy' backend only)
+            horizon: number of decision steps H
+            terminal_values: (S,) values after the last step, in the order of self.model.states (default: zero)
+        V_H = terminal_values, then for t = H-1 .. 0: V_t(s) = max_a sum_s' p(s'|s,a) (r(s') + gamma V_t+1(s')) with
+        agent "Mario"'s gamma (gamma = 1 is fine here, the horizon bounds the returns). Every step is one batched
+        backup, H of them in total, no tolerance is involved
+        The policies of every step are kept in self.horizon_policy (object of class "TimeIndexedPolicy" in horizon.py,
+        consecutive steps with the same policy are stored once). self.values and self.policy_index are V_0 and the
+        policy of step 0 (written back into agent "Mario"), self.iterations counts the steps
+        """
+        if self.backend != 'numpy':
+            raise ValueError("by_finite_horizon needs the 'numpy' backend")
+        if horizon < 1:
+            raise ValueError(f'The horizon must be at least one step, got {horizon}')
+        self.method = 'finite_horizon'
+        self.load_arrays()
+        self._start_solve()
+        model = self.model
+        terminal = model.terminal
+        n_live = int((~terminal).sum())
+        self.values = np.zeros(model.n_states) if terminal_values is None else np.array(terminal_values, dtype=np.float64)
+        self.values[terminal] = 0
+        starts, policies = [], [] # runs of identical policies, built backwards
+        for t in range(horizon - 1, -1, -1):
+            with self._phase('backup'):
+                Q_values = self.batched_Q_values(self.values)
+            with self._phase('greedy'):
+                state_values = Q_values.max(axis=1)
+                change = np.abs(state_values - self.values).max() if model.n_states else 0.0
+                self.values = state_values
+                self.policy_index = np.where(terminal, -1, Q_values.argmax(axis=1))
+                if policies and np.array_equal(self.policy_index, policies[-1]):
+                    starts[-1] = t
+                else:
+                    starts.append(t)
+                    policies.append(self.policy_index)
+            self.backups += n_live
+            self.iterations += 1
+            yield from self._report_sweep(
+                change, f'--> Step {t} | {horizon - t} steps to go', "Steps to go: {}".format(horizon - t), show_updates, anim
+            )
+        self.horizon_policy = TimeIndexedPolicy(horizon, starts[::-1], policies[::-1])
+        self.log(f'*** {horizon} steps, {len(policies)} distinct policies ***')
+        self._finish_solve()
+
+    def by_discount_sweep(self, gammas, show_updates = False, anim = False, linear_solver = 'direct'):
+        """
+        Calculate the optimal values and policies for several discounts in one run ('numpy' backend only)
+            gammas: discount factors in [0, 1), solved in increasing order by synchronous value iteration
+            linear_solver: solver of the warm start policy evaluations (see "solve_policy_values")
+        The compiled model and the expected rewards are computed once for all gammas. The first gamma starts from the
+        agent's values, every next one from the exact values of the previous gamma's optimal policy under its own gamma:
+        that policy is usually (close to) optimal for the next gamma too, so only a few sweeps remain, whereas starting
+        from the previous values themselves saves only a few percent of the sweeps of a cold start.
+        Every gamma stops when the change is under tol, as by_value_iter(sweep='synchronous')
+        Results, stacked in increasing gamma order:
+            self.discount_gammas: (G,) gammas, self.discount_values: (G, S) state values,
+            self.discount_policies: (G, S) action indices (-1 for END), self.discount_iterations: (G,) sweeps of every gamma
+        self.values and self.policy_index hold the solution for agent "Mario"'s gamma when it is one of gammas (and are
+        written back as usual), otherwise the one of the largest gamma (not written back). self.iterations counts all sweeps
+        """
+        if self.backend != 'numpy':
+            raise ValueError("by_discount_sweep needs the 'numpy' backend")
+        gammas = np.unique(np.asarray(gammas, dtype=np.float64))
+        if len(gammas) == 0 or gammas[0] < 0 or gammas[-1] >= 1:
+            raise ValueError('Discount sweeps need gammas in [0, 1)')
+        self.method = 'discount_sweep'
+        self.load_arrays()
+        self._start_solve()
+        model = self.model
+        terminal = model.terminal
+        n_live = int((~terminal).sum())
+        self.discount_gammas = gammas
+        self.discount_values = np.empty((len(gammas), model.n_states))
+        self.discount_policies = np.empty((len(gammas), model.n_states), dtype=np.int64)
+        self.discount_iterations = np.zeros(len(gammas), dtype=np.int64)
+        for g, gamma in enumerate(gammas.tolist()):
+            if g:
+                with self._phase('evaluation'):
+                    self.values = self.solve_policy_values(self.policy_index, linear_solver, gamma)
+            change = np.inf
+            while change > self.tolerance:
+                with self._phase('backup'):
+                    Q_values = self.expected_rewards + gamma * self.batched_expectation(self.values)
+                    Q_values[terminal] = 0
+                with self._phase('greedy'):
+                    state_values = Q_values.max(axis=1)
+                    change = np.abs(state_values - self.values).max() if model.n_states else 0.0
+                    self.values = state_values
+                    self.policy_index = np.where(terminal, -1, Q_values.argmax(axis=1))
+                self.backups += n_live
+                self.iterations += 1
+                self.discount_iterations[g] += 1
+                yield from self._report_sweep(
+                    change, f'--> gamma {gamma} | Iteration {self.discount_iterations[g]}',
+                    "gamma: {}, Iter: {}".format(gamma, self.discount_iterations[g]), show_updates, anim
+                )
+            self.discount_values[g] = self.values
+            self.discount_policies[g] = self.policy_index
+        self.log(f'*** {len(gammas)} gammas, sweeps per gamma: {self.discount_iterations.tolist()} ***')
+        own = np.flatnonzero(gammas == self.agent.gamma)
+        write_back = self.write_back
+        if len(own):
+            self.values, self.policy_index = self.discount_values[own[0]].copy(), self.discount_policies[own[0]].copy()
+        else:
+            self.write_back = False # the agent's gamma was not solved
+        self._finish_solve()
+        self.write_back = write_back
+
 # IGNORE: used for testing
 if __name__ == "__main__":
     # Hover over the class initializers for more info (VS code)
@@ -0,0 +1,264 @@
+from grid_world import GridWorld
+from mario import Mario
+from iter_schemes import Iter
+import abc
+import argparse
+import sys
+import time
+import numpy as np
+
+
+class VectorEnv:
+    def __init__(self, env, n_envs=64, start=None, max_episode_steps=None, seed=None):
+        """
+        N independent episodes of a "GridWorld" stepped at once, states are integer indices into env.model.states
+        Arguments:
+            env: object of class "GridWorld" (its compiled model and rewards are read once, at construction)
+            n_envs: number of parallel episodes
+            start: start state (as tuple) of every episode, None for a uniformly random non-terminal state (exploring starts)
+            max_episode_steps: episodes are cut (and restarted) after this many steps, None for no limit
+            seed: seed of the random generator (None for a random seed)
+        Episodes that end are restarted automatically, see "step"
+        """
+        self.env = env
+        self.model = env.model
+        self.rewards = env.reward_vector()
+        self.n_envs = n_envs
+        self.max_episode_steps = max_episode_steps
+        self.rng = np.random.default_rng(seed)
+        if start is None:
+            self.starts = np.flatnonzero(~self.model.terminal)
+        else:
+            self.starts = np.array([self.model.index[tuple(start)]])
+        if len(self.starts) == 0 or self.model.terminal[self.starts].any():
+            raise ValueError('Episodes need a non-terminal start state')
+        self.states = None
+        self.episode_steps = None
+        self.reset()
+
+    def reset(self):
+        """Restart all episodes, return the (n_envs,) start states"""
+        self.states = self.rng.choice(self.starts, size=self.n_envs)
+        self.episode_steps = np.zeros(self.n_envs, dtype=np.int64)
+        return self.states
+
+    def step(self, actions):
+        """
+        Take (n_envs,) action indices (into env.model.actions) in the current states and
+        return (next_states, rewards, terminated, truncated), all (n_envs,) arrays
+            terminated: the episode reached an end state (or the missing probability mass, see "GridWorld.step")
+            truncated: the episode was cut after max_episode_steps
+        Ended episodes are restarted: self.states then holds the new start states, next_states the states they ended in
+        """
+        model = self.model
+        next_states = model.sample(self.states*model.n_actions + actions, self.rng.random(self.n_envs))
+        lost = next_states < 0
+        next_states = np.where(lost, self.states, next_states)
+        rewards = np.where(lost, 0.0, self.rewards[next_states])
+        terminated = lost | model.terminal[next_states]
+        self.episode_steps += 1
+        truncated = ~terminated & (self.episode_steps >= self.max_episode_steps) if self.max_episode_steps else \
+            np.zeros(self.n_envs, dtype=bool)
+        done = terminated | truncated
+        self.states = next_states.copy()
+        if done.any():
+            self.states[done] = self.rng.choice(self.starts, size=int(done.sum()))
+            self.episode_steps[done] = 0
+        return next_states, rewards, terminated, truncated
+
+
+class TabularLearner(abc.ABC):
+    def __init__(self, env, agent, alpha=None, epsilon=0.1, n_envs=64, start=None, max_episode_steps=None, seed=None,
+                 quiet=False):
+        """
+        Base class of the model-free learners: learns (S, A) Q-values from transitions sampled by a "VectorEnv"
+        Arguments:
+            env: object of class "GridWorld" agent "Mario" learns in (only sampled, its transition model is never read)
+            agent: object of class "Mario" (gamma, and the learned values and greedy policy are written back into it)
+            alpha: learning rate, None for 1/n(s,a)**0.8 with n(s,a) the batches that updated the (state, action) pair
+                (decaying per pair --> the Q-values converge, a constant alpha keeps them noisy)
+            epsilon: probability of a random action (epsilon-greedy behaviour policy)
+            n_envs, start, max_episode_steps, seed: see "VectorEnv"
+            quiet: no progress printing
+        Attributes:
+            Q: (S, A) Q-values, in the order of env.model.states and env.model.actions (zero at end states)
+            steps: environment steps taken (over all parallel episodes), episodes: finished episodes
+            wall_time: seconds spent in "train"
+        """
+        self.env = env
+        self.agent = agent
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.quiet = quiet
+        self.vec_env = VectorEnv(env, n_envs, start, max_episode_steps, seed)
+        self.model = self.vec_env.model
+        self.rng = self.vec_env.rng
+        self.Q = np.zeros((self.model.n_states, self.model.n_actions))
+        self.visits = np.zeros((self.model.n_states, self.model.n_actions), dtype=np.int64)
+        self.steps = 0
+        self.episodes = 0
+        self.wall_time = 0.0
+
+    @property
+    def steps_per_second(self):
+        """Environment steps per second of training"""
+        return self.steps / self.wall_time if self.wall_time > 0 else 0.0
+
+    def epsilon_greedy(self, states):
+        """Helper function: sample (n_envs,) actions of the epsilon-greedy policy in states"""
+        greedy = self.Q[states].argmax(axis=1)
+        explore = self.rng.random(len(states)) < self.epsilon
+        return np.where(explore, self.rng.integers(self.model.n_actions, size=len(states)), greedy)
+
+    def update(self, states, actions, targets):
+        """
+        Helper function: move Q(states, actions) towards targets
+        Repeated (state, action) pairs of one batch are averaged into one target and take a single alpha step
+        (adding up their updates would step k*alpha for a pair seen k times, which overshoots and diverges for a constant alpha)
+        """
+        A = self.model.n_actions
+        pairs, inverse, counts = np.unique(states*A + actions, return_inverse=True, return_counts=True)
+        mean_targets = np.bincount(inverse, weights=targets, minlength=len(pairs)) / counts
+        states, actions = pairs // A, pairs % A
+        self.visits[states, actions] += 1
+        alpha = self.visits[states, actions] ** -0.8 if self.alpha is None else self.alpha
+        self.Q[states, actions] += alpha * (mean_targets - self.Q[states, actions])
+
+    @abc.abstractmethod
+    def next_value(self, next_states, next_actions):
+        """Helper function: value of the next (state, action) used in the bootstrapped target"""
+
+    def train(self, n_steps, anim=False, report_every=100000):
+        """
+        Learn from n_steps environment steps (rounded up to a multiple of n_envs)
+        Yields a frame label every report_every steps when anim (the agent is synced first, see "Animation" in animator.py)
+        """
+        vec_env = self.vec_env
+        gamma = self.agent.gamma
+        states = vec_env.states
+        actions = self.epsilon_greedy(states)
+        next_report = self.steps + report_every
+        stop = self.steps + n_steps
+        start = time.perf_counter()
+        while self.steps < stop:
+            next_states, rewards, terminated, truncated = vec_env.step(actions)
+            # next actions are chosen in the restarted states of ended episodes (SARSA needs them before the update)
+            next_actions = self.epsilon_greedy(vec_env.states)
+            bootstrap = np.where(terminated, 0.0, self.next_value(next_states, np.where(terminated | truncated, -1, next_actions)))
+            self.update(states, actions, rewards + gamma * bootstrap)
+            states, actions = vec_env.states, next_actions
+            self.steps += vec_env.n_envs
+            self.episodes += int((terminated | truncated).sum())
+            if self.steps >= next_report:
+                next_report += report_every
+                self.wall_time += time.perf_counter() - start
+                if not self.quiet:
+                    print(f'--> Steps {self.steps} | Episodes {self.episodes} | {self.steps_per_second:.0f} steps/s')
+                if anim:
+                    self.sync_agent()
+                    yield f'Steps: {self.steps}'
+                start = time.perf_counter()
+        self.wall_time += time.perf_counter() - start
+        self.sync_agent()
+
+    def values(self):
+        """Return the (S,) greedy state values max_a Q(s, a) (zero at end states)"""
+        return np.where(self.model.terminal, 0.0, self.Q.max(axis=1))
+
+    def policy_index(self):
+        """Return the (S,) greedy action indices, -1 for END"""
+        return np.where(self.model.terminal, -1, self.Q.argmax(axis=1))
+
+    def sync_agent(self):
+        """Write the greedy state values and policy into agent "Mario" (see "Mario.write_arrays")"""
+        self.agent.write_arrays(self.model, self.values(), self.policy_index())
+
+    def compare(self, Q_reference):
+        """
+        Compare the learned Q-values with reference (S, A) Q-values (e.g. "reference_Q")
+        Returns {'max_Q_error', 'max_value_error', 'policy_agreement' (fraction of non-terminal states with the same greedy action)}
+        """
+        live = ~self.model.terminal
+        values_reference = Q_reference.max(axis=1)
+        # ties in the reference (e.g. equally good moves) count as agreement
+        chosen = Q_reference[np.arange(len(Q_reference)), self.Q.argmax(axis=1)]
+        agree = chosen >= values_reference - 1e-9 * np.maximum(1, np.abs(values_reference))
+        return {
+            'max_Q_error': float(np.abs(self.Q - Q_reference)[live].max()) if live.any() else 0.0,
+            'max_value_error': float(np.abs(self.values() - np.where(live, values_reference, 0.0)).max()),
+            'policy_agreement': float(agree[live].mean()) if live.any() else 1.0,
+        }
+
+
+class QLearning(TabularLearner):
+    """Q-learning (off-policy): bootstraps from the greedy value max_a' Q(s', a'), see "TabularLearner" """
+
+    def next_value(self, next_states, next_actions):
+        return self.Q[next_states].max(axis=1)
+
+
+class SARSA(TabularLearner):
+    """
+    SARSA (on-policy): bootstraps from Q(s', a') of the action a' actually taken next, see "TabularLearner"
+    Converges to the Q-values of the epsilon-greedy policy (to the optimal ones only as epsilon goes to 0)
+    """
+
+    def next_value(self, next_states, next_actions):
+        # truncated episodes have no next action in s' --> greedy value, as in Q-learning
+        return np.where(
+            next_actions >= 0,
+            self.Q[next_states, np.maximum(next_actions, 0)],
+            self.Q[next_states].max(axis=1),
+        )
+
+
+def reference_Q(env, gamma=0.9, tol=0.000001):
+    """Return the optimal (S, A) Q-values of env (zero at end states), planned with "Iter.by_value_iter" on the known model"""
+    agent = Mario(env=env, gamma=gamma)
+    learn = Iter(env=env, agent=agent, tol=tol, write_back=False, quiet=True)
+    for _ in learn.by_value_iter():
+        pass
+    return learn.batched_Q_values(learn.values)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Learn the default GridWorld from sampled experience and compare with value iteration')
+    parser.add_argument('--method', choices=['q_learning', 'sarsa'], nargs='+', default=['q_learning', 'sarsa'])
+    parser.add_argument('--steps', type=int, default=2000000, help='environment steps per learner')
+    parser.add_argument('--envs', type=int, default=256, help='parallel episodes')
+    parser.add_argument('--alpha', type=float, default=None, help='constant learning rate (default: 1/visits**0.8)')
+    parser.add_argument('--epsilon', type=float, default=0.1)
+    parser.add_argument('--gamma', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-error', type=float, default=None,
+                        help='exit with status 1 when a learner ends with max |Q - Q*| above this (or not finite)')
+    args = parser.parse_args(argv)
+
+    env = GridWorld()
+    Q_star = reference_Q(env, args.gamma)
+    learners = {'q_learning': QLearning, 'sarsa': SARSA}
+    failed = []
+    for method in args.method:
+        agent = Mario(env=env, gamma=args.gamma)
+        learner = learners[method](env, agent, args.alpha, args.epsilon, args.envs, seed=args.seed, quiet=True)
+        for _ in learner.train(args.steps):
+            pass
+        errors = learner.compare(Q_star)
+        print(
+            f'*** {method}: {learner.steps} steps in {learner.wall_time:.2f}s ({learner.steps_per_second:.0f} steps/s), '
+            f'{learner.episodes} episodes ***'
+        )
+        print(
+            f"max |Q - Q*| {errors['max_Q_error']:.4f} | max |V - V*| {errors['max_value_error']:.4f} | "
+            f"greedy policy agrees on {100*errors['policy_agreement']:.0f}% of the states"
+        )
+        agent.show_policy()
+        if args.max_error is not None and not errors['max_Q_error'] <= args.max_error:
+            failed.append(method)
+    if failed:
+        print(f"*** max |Q - Q*| above {args.max_error} for {', '.join(failed)} ***")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,70 @@
 from grid_world import GridWorld
 from mario import Mario
 from iter_schemes import Iter
-from animator import Animation
+import argparse
 
 # Default setup of the problem statement seems to be 'ill-posed'
 # (Can give different results due to machine precision)
 
-# We encourage to play with the initialization of the objects below 
+# We encourage to play with the initialization of the objects below
 # by exploring the corresponding source code files mentioned beside them.
-env   = GridWorld()                 # Check gridworld.py 
-agent = Mario(env=env)              # Check mario.py 
-learn = Iter(env=env, agent=agent)  # Check iter_schemes.py 
-
-print('*** Env rewards ***')
-env.show_rewards()
-
-# Only change the 'value_iter' variable according to your preference for iteration scheme
-# which will also set 'poiicy_iter' variable for the opposite behaviour
-value_iter = False
-policy_iter = not value_iter
-animate = True
-
-if value_iter:
-    print("*** Starting value iter ***")
-    gen = learn.by_value_iter(anim=animate)
-    if animate:
-        animator = Animation(env, agent, gen, 'value_iter')
-        animator.animate()
-    print("*** Value iter convergence reached ***")
 
-if policy_iter:
-    print('*** Initial policy ***')
-    agent.show_policy()
-    print("*** Starting policy iter ***")
-    gen = learn.by_policy_iter(anim=animate)
+# Importing this module is cheap: matplotlib (through animator.py) is only loaded when an animation is rendered,
+# so batch workers can call "main(['--headless'])" or "solve" without paying for it
+
+
+def solve(learn, method='policy_iter', animate=False):
+    """
+    Run the solver "method" ('value_iter' or 'policy_iter') of object of class "Iter" learn to convergence
+    animate: render the iterations into <method>.gif (imports animator.py, hence matplotlib, only then)
+    """
+    gen = learn.by_value_iter(anim=animate) if method == 'value_iter' else learn.by_policy_iter(anim=animate)
     if animate:
-        animator = Animation(env, agent, gen, 'policy_iter')
+        from animator import Animation
+        animator = Animation(learn.env, learn.agent, gen, method)
         animator.animate()
-    print("*** Policy iter convergence reached ***")
+    else:
+        for _ in gen:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Solve the GridWorld with value or policy iteration')
+    parser.add_argument('--method', choices=['value_iter', 'policy_iter'], default='policy_iter')
+    parser.add_argument('--headless', action='store_true', help='no animation (matplotlib is never imported)')
+    parser.add_argument('--map', default=None, help='ASCII or PNG map (see maps.py), default: the default GridWorld')
+    parser.add_argument('--gamma', type=float, default=0.9)
+    parser.add_argument('--checkpoint', default=None, help='save the solution to this checkpoint file (see checkpoint.py)')
+    parser.add_argument('--quiet', action='store_true', help='no per-iteration printing, no grids')
+    args = parser.parse_args(argv)
+
+    if args.map is None:
+        env = GridWorld()                                   # Check gridworld.py
+    else:
+        from maps import load_map
+        env = load_map(args.map)
+    agent = Mario(env=env, gamma=args.gamma)                # Check mario.py
+    learn = Iter(env=env, agent=agent, quiet=args.quiet)    # Check iter_schemes.py
+    show = not args.quiet
+
+    if show:
+        print('*** Env rewards ***')
+        env.show_rewards()
+        if args.method == 'policy_iter':
+            print('*** Initial policy ***')
+            agent.show_policy()
+        print(f"*** Starting {args.method.replace('_', ' ')} ***")
+    solve(learn, args.method, animate=not args.headless)
+
+    if show:
+        print(f"*** {args.method.replace('_', ' ').capitalize()} convergence reached ***")
+        print('--> Optimal State values')
+        agent.show_state_values()
+        print('--> Optimal Policy')
+        agent.show_policy()
+    if args.checkpoint:
+        learn.save_checkpoint(args.checkpoint)
+
 
-print('--> Optimal State values')
-agent.show_state_values()
-print('--> Optimal Policy')
-agent.show_policy()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+from grid_world import GridWorld, TransitionModel, ACTION_SETS, SLIP_KERNELS, build_action_space
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+# ASCII map legend: character --> (kind, reward), kind 'free', 'blocked' or 'end', reward None for "other_states"
+LEGEND = {
+    '.': ('free', None),
+    '#': ('blocked', None),
+    'G': ('end', 1.0),
+    'X': ('end', -1.0),
+}
+
+# Compiled map file layout:
+#   MAGIC (8 bytes), header length (<u8), JSON header {version, key, xdim, ydim, controller_reliability, actions, slip, arrays},
+#   then every array of the header's arrays {name: [offset, dtype, shape]} at a 64 byte aligned offset
+MAGIC = b'MARIOMAP'
+VERSION = 2
+ALIGN = 64
+# Compiled arrays of a map: the TransitionModel arrays plus the (S,) reward vector
+MODEL_ARRAYS = ('states', 'grid_index', 'terminal', 'indptr', 'next_states', 'probs', 'outcomes', 'rows')
+
+
+def parse_ascii(text, legend=None, other_states=0.0):
+    """
+    Parse an ASCII map into (blocked, end, rewards) arrays of shape (ydim, xdim) with [y-1, x-1] indexing
+    The first line is the top row (y = ydim), as printed by "GridWorld.show_rewards"; all lines must have the same length
+        legend: {character: (kind, reward)}, see LEGEND (default)
+        other_states: reward of the cells whose legend reward is None
+    """
+    legend = LEGEND if legend is None else legend
+    lines = [line.rstrip('\r') for line in text.split('\n')]
+    while lines and not lines[-1]:
+        lines.pop()
+    if not lines:
+        raise ValueError('Empty map')
+    width = len(lines[0])
+    if any(len(line) != width for line in lines):
+        raise ValueError('All lines of an ASCII map must have the same length')
+    codes = np.frombuffer(''.join(lines).encode('ascii'), dtype=np.uint8).reshape(len(lines), width)[::-1]
+    known = np.zeros(codes.shape, dtype=bool)
+    blocked = np.zeros(codes.shape, dtype=bool)
+    end = np.zeros(codes.shape, dtype=bool)
+    rewards = np.full(codes.shape, float(other_states))
+    for char, (kind, reward) in legend.items():
+        if kind not in ('free', 'blocked', 'end'):
+            raise ValueError(f"Unknown legend kind '{kind}' for '{char}', expected 'free', 'blocked' or 'end'")
+        cells = codes == ord(char)
+        known |= cells
+        blocked |= cells & (kind == 'blocked')
+        end |= cells & (kind == 'end')
+        if reward is not None:
+            rewards[cells] = reward
+    if not known.all():
+        unknown = sorted({chr(c) for c in np.unique(codes[~known])})
+        raise ValueError(f'Characters missing from the legend: {unknown}')
+    return blocked, end, rewards
+
+
+def parse_image(path, threshold=0.5, other_states=0.0):
+    """
+    Parse a PNG occupancy image into (blocked, end, rewards) arrays of shape (ydim, xdim) with [y-1, x-1] indexing
+    One pixel per cell, the top pixel row is y = ydim:
+        dark pixels (luminance under threshold) are blocked,
+        green pixels are end states with reward +1, red pixels end states with reward -1,
+        every other pixel is a free cell with reward other_states
+    """
+    import matplotlib.image # only needed for images
+    image = np.asarray(matplotlib.image.imread(path), dtype=np.float64)
+    if image.max() > 1: # 8 bit images
+        image = image / 255
+    if image.ndim == 2:
+        image = image[..., None].repeat(3, axis=-1)
+    image = image[::-1, :, :3]
+    r, g, b = image[..., 0], image[..., 1], image[..., 2]
+    luminance = 0.299*r + 0.587*g + 0.114*b
+    green = (g >= 0.5) & (r < 0.5) & (b < 0.5)
+    red = (r >= 0.5) & (g < 0.5) & (b < 0.5)
+    end = green | red
+    blocked = (luminance < threshold) & ~end
+    rewards = np.where(green, 1.0, np.where(red, -1.0, float(other_states)))
+    return blocked, end, rewards
+
+
+def cache_key(source, **params):
+    """Return the content hash identifying a compiled map: source bytes, loader parameters and the file format version"""
+    digest = hashlib.sha256()
+    digest.update(f'{VERSION}|'.encode())
+    digest.update(source)
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def save_compiled(path, env, key=''):
+    """Write env, its compiled model and rewards into one compiled map file (see MAGIC for the layout)"""
+    model = env.model
+    arrays = {name: np.ascontiguousarray(getattr(model, name)) for name in MODEL_ARRAYS}
+    arrays['rewards'] = env.reward_vector()
+    header = {
+        'version': VERSION, 'key': key, 'xdim': env.xdim, 'ydim': env.ydim,
+        'controller_reliability': env.prob, 'actions': [[list(move), name] for move, name in env.action_space.items()],
+        'slip': [[list(move), weight] for move, weight in env.slip.items()], 'arrays': {},
+    }
+    # the header size depends on the offsets --> reserve room for it first
+    reserve = len(json.dumps({**header, 'arrays': {
+        name: [2**62, array.dtype.str, list(array.shape)] for name, array in arrays.items()
+    }}).encode())
+    offset = -(-(len(MAGIC) + 8 + reserve) // ALIGN) * ALIGN
+    for name, array in arrays.items():
+        header['arrays'][name] = [offset, array.dtype.str, list(array.shape)]
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    encoded = json.dumps(header).encode()
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as file:
+        file.write(MAGIC)
+        file.write(np.array(len(encoded), dtype='<u8').tobytes())
+        file.write(encoded)
+        for name, array in arrays.items():
+            file.seek(header['arrays'][name][0])
+            file.write(array.tobytes())
+        file.truncate(offset)
+    os.replace(tmp, path) # readers never see a partly written file
+
+
+def load_compiled(path):
+    """
+    Load a compiled map file as an object of class "GridWorld" whose compiled model is attached without compiling
+    The arrays are read-only views into a single memory map of the file
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f'{path} is not a compiled map file')
+    length = int(buffer[len(MAGIC):len(MAGIC)+8].view('<u8')[0])
+    header = json.loads(bytes(buffer[len(MAGIC)+8:len(MAGIC)+8+length]).decode())
+    if header['version'] != VERSION:
+        raise ValueError(f"Unsupported compiled map version {header['version']}")
+    arrays = {}
+    for name, (offset, dtype, shape) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        arrays[name] = buffer[offset:offset + dtype.itemsize*int(np.prod(shape))].view(dtype).reshape(shape)
+    ydim, xdim = header['ydim'], header['xdim']
+    blocked = arrays['grid_index'] < 0
+    end = np.zeros((ydim, xdim), dtype=bool)
+    rewards = np.zeros((ydim, xdim))
+    cells = (arrays['states'][:, 1]-1, arrays['states'][:, 0]-1)
+    end[cells] = arrays['terminal']
+    rewards[cells] = arrays['rewards']
+    env = GridWorld.from_arrays(
+        blocked, end, rewards, header['controller_reliability'],
+        {tuple(move): name for move, name in header['actions']}, {tuple(move): weight for move, weight in header['slip']},
+    )
+    env.attach_model(TransitionModel.from_arrays(env, arrays))
+    return env
+
+
+def cached(key, build, cache_dir):
+    """Helper function: load the compiled map "key" from cache_dir, or build the GridWorld, compile it and cache it"""
+    if cache_dir is None:
+        return build()
+    path = os.path.join(cache_dir, f'{key}.map')
+    if os.path.exists(path):
+        return load_compiled(path)
+    env = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    save_compiled(path, env, key)
+    return env
+
+
+def dynamics(actions='4', slip='perpendicular', stay=False):
+    """Helper function: JSON friendly description of the action set and slip kernel, part of the cache key"""
+    action_space = build_action_space(actions, stay)
+    slip = SLIP_KERNELS[slip] if isinstance(slip, str) else slip
+    return {'actions': [[list(move), name] for move, name in action_space.items()], 'slip': sorted(
+        [list(move), weight] for move, weight in slip.items()
+    )}
+
+
+def load_ascii(path, controller_reliability=0.8, legend=None, other_states=0.0, cache_dir=None,
+               actions='4', slip='perpendicular', stay=False):
+    """
+    Return the "GridWorld" of an ASCII map file (see "parse_ascii")
+        cache_dir: directory of compiled maps keyed by content hash, a map seen before is loaded with a single mmap
+        actions, slip, stay: see "GridWorld"
+    """
+    with open(path, 'rb') as file:
+        source = file.read()
+    key = cache_key(
+        source, loader='ascii', controller_reliability=controller_reliability,
+        legend=sorted((LEGEND if legend is None else legend).items()), other_states=other_states,
+        **dynamics(actions, slip, stay),
+    )
+    return cached(
+        key,
+        lambda: GridWorld.from_arrays(
+            *parse_ascii(source.decode('ascii'), legend, other_states), controller_reliability, actions, slip, stay
+        ),
+        cache_dir,
+    )
+
+
+def load_image(path, controller_reliability=0.8, threshold=0.5, other_states=0.0, cache_dir=None,
+               actions='4', slip='perpendicular', stay=False):
+    """Return the "GridWorld" of a PNG occupancy image (see "parse_image"), cache_dir etc.: see "load_ascii" """
+    with open(path, 'rb') as file:
+        source = file.read()
+    key = cache_key(
+        source, loader='image', controller_reliability=controller_reliability, threshold=threshold, other_states=other_states,
+        **dynamics(actions, slip, stay),
+    )
+    return cached(
+        key,
+        lambda: GridWorld.from_arrays(
+            *parse_image(path, threshold, other_states), controller_reliability, actions, slip, stay
+        ),
+        cache_dir,
+    )
+
+
+def load_map(path, controller_reliability=0.8, cache_dir=None, **kwargs):
+    """Return the "GridWorld" of a map file: PNG images by extension, ASCII maps otherwise"""
+    if path.lower().endswith('.png'):
+        return load_image(path, controller_reliability, cache_dir=cache_dir, **kwargs)
+    return load_ascii(path, controller_reliability, cache_dir=cache_dir, **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load an ASCII or PNG map, compile it and report the load times')
+    parser.add_argument('path')
+    parser.add_argument('--controller-reliability', type=float, default=0.8)
+    parser.add_argument('--actions', choices=list(ACTION_SETS), default='4')
+    parser.add_argument('--slip', choices=list(SLIP_KERNELS), default='perpendicular')
+    parser.add_argument('--stay', action='store_true')
+    parser.add_argument('--cache-dir', default=None, help='directory of compiled maps (content hashed)')
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    env = load_map(
+        args.path, args.controller_reliability, args.cache_dir, actions=args.actions, slip=args.slip, stay=args.stay
+    )
+    model = env.model
+    print(
+        f'{args.path}: {env.xdim}x{env.ydim} grid, {model.n_states} states, {int(model.terminal.sum())} end states, '
+        f'{len(model.probs)} transitions, loaded and compiled in {time.perf_counter() - start:.3f}s'
+    )
+
+
+if __name__ == "__main__":
+    main()
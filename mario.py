@@ -1,12 +1,19 @@
 from grid_world import GridWorld
+from collections.abc import MutableMapping
 import numpy as np
 
 class Mario:
-    def __init__(self, env, gamma=0.9):
+    def __init__(self, env, gamma=0.9, storage='dict'):
         """
         Arguments:
             env: object of class "GridWorld" over which agent "Mario" is intended to learn policy on
             gamma: value discount you want the agent "Mario" to learn the state-values with
+            storage: 'dict' (state_values and policy are plain dicts) or
+                     'array' (dense grids aligned with the gridworld layout, [y-1, x-1] indexing):
+                        value_grid: (ydim, xdim) float64 state values
+                        action_grid: (ydim, xdim) int8 action indices into env.action_space, -1 for END
+                        valid_mask: (ydim, xdim) bool, False for blocked cells (their grid entries are meaningless)
+                     state_values and policy are then lazy dict-like views over the grids (reads and writes go to the arrays)
 
         Default Policy:
             B: blocked states (default env setup)
@@ -16,16 +23,129 @@ class Mario:
             : v | B | v | END
             : v | v | v | v   
         """
+        if storage not in ('dict', 'array'):
+            raise ValueError(f"Unknown storage '{storage}', expected 'dict' or 'array'")
         self.gamma = gamma
         self.env = env
-        self.state_values = {
-            state: 0.0
+        self.storage = storage
+        self._layout_version = getattr(env, 'version', None) # layout the state set was built for (see "sync_layout")
+        if storage == 'array':
+            self.actions = list(self.env.action_space)
+            self.valid_mask = self.env.model.grid_index >= 0
+            self.value_grid = np.zeros((self.env.ydim, self.env.xdim), dtype=np.float64)
+            self.action_grid = np.zeros((self.env.ydim, self.env.xdim), dtype=np.int8) # first action (down) by default
+            for (x, y) in self.env.end_states:
+                self.action_grid[y-1, x-1] = -1
+            self._state_values = StateValueView(self)
+            self._policy = PolicyView(self)
+        else:
+            self._state_values = {
+                state: 0.0
+                for state in self.env.valid_states
+            }
+            first = next(iter(self.env.action_space.items()))
+            self._policy = {
+                state: (first if state not in self.env.end_states else ((0,0),'END'))
+                for state in self.env.valid_states
+            } # necessary to have default policy as the first action in action space for correct visualization
+
+    @classmethod
+    def from_grids(cls, env, value_grid, action_grid, valid_mask, gamma=0.9):
+        """
+        Agent "Mario" with storage = 'array' over existing grids (no copy, e.g. the memory-mapped results of tiled.py)
+            env: only xdim, ydim and action_space are used (no compiled model is needed)
+            value_grid, action_grid, valid_mask: see storage = 'array'
+        """
+        agent = cls.__new__(cls)
+        agent.gamma = gamma
+        agent.env = env
+        agent.storage = 'array'
+        agent._layout_version = getattr(env, 'version', None)
+        agent.actions = list(env.action_space)
+        agent.valid_mask = valid_mask
+        agent.value_grid = value_grid
+        agent.action_grid = action_grid
+        agent._state_values = StateValueView(agent)
+        agent._policy = PolicyView(agent)
+        return agent
+
+    def sync_layout(self):
+        """
+        Bring the state set in line with the gridworld after it changed (blocked cells and end states, see the
+        mutators of "GridWorld"): new states get value 0 and the first action, end states value 0 and END, former end
+        states the first action, blocked states are dropped. A no-op while env.version is unchanged
+        """
+        version = getattr(self.env, 'version', None)
+        if version is None or version == self._layout_version:
+            return
+        self._layout_version = version
+        if self.storage == 'array':
+            model = self.env.model
+            valid = model.grid_index >= 0
+            terminal = np.zeros_like(valid)
+            terminal[model.states[:, 1]-1, model.states[:, 0]-1] = model.terminal
+            new = valid & ~self.valid_mask
+            self.value_grid[new | terminal] = 0.0
+            self.action_grid[new | (valid & ~terminal & (self.action_grid < 0))] = 0
+            self.action_grid[terminal] = -1
+            self.valid_mask[...] = valid
+            return
+        end_states = set(self.env.end_states)
+        first = next(iter(self.env.action_space.items()))
+        values, policy = self._state_values, self._policy
+        self._state_values = {
+            state: 0.0 if state in end_states else values.get(state, 0.0) for state in self.env.valid_states
+        }
+        self._policy = {
+            state: ((0,0),'END') if state in end_states else
+                   policy[state] if state in policy and policy[state][1] != 'END' else first
             for state in self.env.valid_states
         }
+
+    def write_arrays(self, model, values, policy_index):
+        """
+        Write (S,) state values and (S,) action indices (-1 for END) given in the order of the states of "TransitionModel"
+        model into state_values and policy (shared by the solvers in iter_schemes.py and the learners in learners.py)
+        """
+        self.sync_layout()
+        if self.storage == 'array':
+            cells = (model.states[:, 1]-1, model.states[:, 0]-1)
+            self.value_grid[cells] = values
+            self.action_grid[cells] = policy_index
+            return
+        self.state_values = dict(zip(model.valid_states, np.asarray(values, dtype=np.float64).tolist()))
         self.policy = {
-            state: (((0,-1),'down') if state not in self.env.end_states else ((0,0),'END'))
-            for state in self.env.valid_states
-        } # necessary to have default policy as the first action in action space for correct visualization
+            state: ((0,0),'END') if a < 0 else (model.actions[a], self.env.action_space[model.actions[a]])
+            for state, a in zip(model.valid_states, np.asarray(policy_index).tolist())
+        }
+
+    @property
+    def state_values(self):
+        """{key = state: value = state value} (a view over value_grid with storage = 'array')"""
+        self.sync_layout()
+        return self._state_values
+
+    @state_values.setter
+    def state_values(self, state_values):
+        if self.storage == 'array':
+            if state_values is not self._state_values:
+                self._state_values.update(state_values)
+        else:
+            self._state_values = state_values
+
+    @property
+    def policy(self):
+        """{key = state: value = (action, action name)} (a view over action_grid with storage = 'array')"""
+        self.sync_layout()
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy):
+        if self.storage == 'array':
+            if policy is not self._policy:
+                self._policy.update(policy)
+        else:
+            self._policy = policy
 
     def show_state_values(self):
         for j in range(self.env.ydim, 0, -1):
@@ -44,4 +164,69 @@ class Mario:
                     print(f'{action_name:5s}', end='|')
                 else:
                     print("     ", end="|")
-            print()
\ No newline at end of file
+            print()
+
+
+class StateValueView(MutableMapping):
+    def __init__(self, agent):
+        """
+        Lazy dict-like view {key = state: value = state value} over agent.value_grid (no copy)
+        Arguments:
+            agent: object of class "Mario" with storage = 'array'
+        """
+        self.agent = agent
+
+    def _cell(self, state):
+        """Helper function: grid cell of a state, KeyError for blocked or out of bounds states"""
+        x, y = state
+        if not (1 <= x <= self.agent.env.xdim and 1 <= y <= self.agent.env.ydim) or not self.agent.valid_mask[y-1, x-1]:
+            raise KeyError(state)
+        return y-1, x-1
+
+    def __getitem__(self, state):
+        return float(self.agent.value_grid[self._cell(state)])
+
+    def __setitem__(self, state, value):
+        self.agent.value_grid[self._cell(state)] = value
+
+    def __delitem__(self, state):
+        raise TypeError('States cannot be removed from an array-backed view')
+
+    def __contains__(self, state):
+        try:
+            self._cell(state)
+        except (KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    def __iter__(self):
+        # row-major order (y outer, x inner), same as env.valid_states
+        ys, xs = np.nonzero(self.agent.valid_mask)
+        return ((int(x)+1, int(y)+1) for y, x in zip(ys, xs))
+
+    def __len__(self):
+        return int(self.agent.valid_mask.sum())
+
+
+class PolicyView(StateValueView):
+    def __init__(self, agent):
+        """
+        Lazy dict-like view {key = state: value = (action, action name)} over agent.action_grid (no copy)
+        Arguments:
+            agent: object of class "Mario" with storage = 'array'
+        """
+        self.agent = agent
+
+    def __getitem__(self, state):
+        a = int(self.agent.action_grid[self._cell(state)])
+        if a < 0:
+            return ((0,0),'END')
+        action = self.agent.actions[a]
+        return (action, self.agent.env.action_space[action])
+
+    def __setitem__(self, state, value):
+        action, name = value
+        cell = self._cell(state)
+        # END is told apart by name, the 'stay' action is (0,0) as well
+        self.agent.action_grid[cell] = -1 if name == 'END' else self.agent.actions.index(tuple(action))
+
@@ -0,0 +1,166 @@
+import multiprocessing as mp
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def _attach(spec):
+    """Helper function: map the shared arrays described by spec {name: (block name, shape, dtype)}, return (arrays, blocks)"""
+    arrays, blocks = {}, []
+    for name, (block, shape, dtype) in spec.items():
+        memory = shared_memory.SharedMemory(name=block)
+        blocks.append(memory)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    return arrays, blocks
+
+
+def _sweep_worker(spec, worker, band, n_actions, gamma, barrier):
+    """
+    Worker process of "SweepExecutor": synchronous Bellman backups of the states of one row band
+    Waits at the barrier for every sweep, backs up its band from values[parity] into values[1-parity] and policy,
+    writes the largest change of its band into residual[worker] and waits at the barrier again
+    """
+    arrays, blocks = _attach(spec)
+    try:
+        s0, s1 = band
+        A = n_actions
+        indptr = arrays['indptr'][s0*A:s1*A+1]
+        entries = slice(indptr[0], indptr[-1])
+        rows = np.repeat(np.arange((s1 - s0)*A), np.diff(indptr))
+        next_states, probs = arrays['next_states'][entries], arrays['probs'][entries]
+        expected_rewards, terminal = arrays['expected_rewards'][s0:s1], arrays['terminal'][s0:s1]
+        values, policy, residual, control = arrays['values'], arrays['policy'], arrays['residual'], arrays['control']
+        while True:
+            barrier.wait()
+            if control[0]:
+                break
+            parity = control[1]
+            previous = values[parity]
+            expectation = np.bincount(rows, weights=probs * previous[next_states], minlength=(s1 - s0)*A).reshape(s1 - s0, A)
+            Q_values = expected_rewards + gamma * expectation
+            Q_values[terminal] = 0
+            state_values = Q_values.max(axis=1)
+            change = np.abs(state_values - previous[s0:s1])
+            change[terminal] = 0
+            values[1 - parity, s0:s1] = state_values
+            policy[s0:s1] = np.where(terminal, -1, Q_values.argmax(axis=1))
+            residual[worker] = change.max() if len(change) else 0.0
+            barrier.wait()
+    except BaseException:
+        # wake the main process (and the other workers) instead of leaving them at the barrier
+        barrier.abort()
+        raise
+    finally:
+        del arrays
+        for memory in blocks:
+            memory.close()
+
+
+class SweepExecutor:
+    def __init__(self, n_workers=None, start_method=None):
+        """
+        Multi-core synchronous sweeps for the 'numpy' backend, pass it as Iter(..., executor=SweepExecutor())
+        Arguments:
+            n_workers: number of worker processes (default: the CPUs available to this process)
+            start_method: multiprocessing start method (default: the platform's)
+        The states are split into bands of grid rows with about the same number of states, one per worker. The
+        transition tables, the double-buffered values, the policy and the per-worker residuals live in
+        multiprocessing.shared_memory blocks: workers read values[parity] and write values[1-parity], a barrier
+        separates the sweeps and values are never pickled. Every worker reduces the change of its own band, so
+        the tol check only takes the max of n_workers numbers.
+        Workers live for one solve ("start" ... "close")
+        """
+        if n_workers is None:
+            n_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        self.n_workers = n_workers
+        self.context = mp.get_context(start_method)
+        self.arrays = None
+        self.blocks = []
+        self.processes = []
+        self.barrier = None
+        self.parity = 0
+
+    def _share(self, name, array):
+        """Helper function: copy array into a new shared memory block, return (spec entry, shared array)"""
+        array = np.ascontiguousarray(array)
+        memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(memory)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+        shared[...] = array
+        return (memory.name, array.shape, array.dtype.str), shared
+
+    def bands(self, model):
+        """Return the (s0, s1) state ranges of the row bands (states are in row-major order, see GridWorld.valid_states)"""
+        n_bands = max(1, min(self.n_workers, model.ydim))
+        # split on rows, balancing the number of states per band
+        row_ends = np.searchsorted(model.states[:, 1], np.arange(1, model.ydim + 1), side='right')
+        targets = np.linspace(0, model.n_states, n_bands + 1)[1:-1]
+        cuts = row_ends[np.minimum(np.searchsorted(row_ends, targets), model.ydim - 1)]
+        bounds = np.unique(np.concatenate([[0], cuts, [model.n_states]]))
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    def start(self, model, expected_rewards, gamma, values):
+        """Share the arrays of one solve and start the workers, values are the (S,) starting values"""
+        self.close()
+        bands = self.bands(model)
+        spec, self.arrays = {}, {}
+        for name, array in {
+            'indptr': model.indptr, 'next_states': model.next_states, 'probs': model.probs,
+            'expected_rewards': expected_rewards, 'terminal': model.terminal,
+            'values': np.stack([values, values]), 'policy': np.full(model.n_states, -1, dtype=np.int64),
+            'residual': np.zeros(len(bands)), 'control': np.zeros(2, dtype=np.int64), # [stop, parity]
+        }.items():
+            spec[name], self.arrays[name] = self._share(name, array)
+        self.parity = 0
+        self.barrier = self.context.Barrier(len(bands) + 1)
+        self.processes = [
+            self.context.Process(
+                target=_sweep_worker, args=(spec, worker, band, model.n_actions, gamma, self.barrier), daemon=True
+            )
+            for worker, band in enumerate(bands)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def sweep(self):
+        """Run one synchronous sweep on all workers, return the largest change of a state value"""
+        self.arrays['control'][1] = self.parity
+        self.barrier.wait() # start
+        self.barrier.wait() # done
+        self.parity = 1 - self.parity
+        return float(self.arrays['residual'].max())
+
+    @property
+    def values(self):
+        """(S,) values of the last sweep (a view into shared memory, valid until "close")"""
+        return self.arrays['values'][self.parity]
+
+    @property
+    def policy_index(self):
+        """(S,) greedy action indices of the last sweep, -1 for END (a view into shared memory, valid until "close")"""
+        return self.arrays['policy']
+
+    def close(self):
+        """Stop the workers and release the shared memory"""
+        if self.processes:
+            self.arrays['control'][0] = 1
+            try:
+                self.barrier.wait(timeout=10)
+            except Exception:
+                pass # broken barrier: a worker failed, the others are terminated below
+            for process in self.processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+        self.processes = []
+        self.arrays = None
+        for memory in self.blocks:
+            memory.close()
+            memory.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,206 @@
+from grid_world import GridWorld
+import argparse
+import os
+import numpy as np
+
+# Trajectory file layout (little endian):
+#   header: HEADER_DTYPE (64 bytes)
+#   states: (n_states, 2) int32 state coordinates, in the order of the solver arrays
+#   actions: (n_actions, 2) int32 actions, in the order of env.action_space
+#   action names: (n_actions,) NAME_DTYPE UTF-8 action names, same order
+#   records: (capacity,) records of record_dtype(n_states), the first "count" of them are valid
+MAGIC = b'MARIOTRJ'
+VERSION = 2
+NAME_DTYPE = np.dtype('S16')
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'), ('version', '<u4'), ('xdim', '<u4'), ('ydim', '<u4'), ('n_actions', '<u4'),
+    ('n_states', '<u8'), ('count', '<u8'), ('capacity', '<u8'), ('pad', 'V16'),
+])
+
+
+def record_dtype(n_states):
+    """One recorded sweep: state values, policy (action indices, -1 for END) and residual (max change of the sweep)"""
+    return np.dtype([('values', '<f8', (n_states,)), ('policy', 'i1', (n_states,)), ('residual', '<f8')])
+
+
+class TrajectoryRecorder:
+    def __init__(self, path, env, capacity=64):
+        """
+        Append-only recorder of solver sweeps into a preallocated, growable memory-mapped file
+        Arguments:
+            path: trajectory file to create (overwritten if it exists)
+            env: object of class "GridWorld" being solved
+            capacity: number of records preallocated, doubled whenever the file is full
+        Pass it as Iter(..., recorder=TrajectoryRecorder(path, env)); only the current record is touched in memory
+        """
+        model = env.model
+        names = [env.action_space[action].encode() for action in model.actions]
+        if max(len(name) for name in names) > NAME_DTYPE.itemsize:
+            raise ValueError(f'Action names are recorded with at most {NAME_DTYPE.itemsize} bytes')
+        self.path = path
+        self.n_states = model.n_states
+        self.dtype = record_dtype(self.n_states)
+        self.offset = HEADER_DTYPE.itemsize + 8*self.n_states + (8 + NAME_DTYPE.itemsize)*model.n_actions
+        with open(path, 'wb') as file:
+            header = np.zeros((), dtype=HEADER_DTYPE)
+            header['magic'] = MAGIC
+            header['version'] = VERSION
+            header['xdim'], header['ydim'] = env.xdim, env.ydim
+            header['n_actions'] = model.n_actions
+            header['n_states'] = self.n_states
+            file.write(header.tobytes())
+            file.write(model.states.astype('<i4').tobytes())
+            file.write(np.array(model.actions, dtype='<i4').reshape(-1, 2).tobytes())
+            file.write(np.array(names, dtype=NAME_DTYPE).tobytes())
+        self.header = np.memmap(path, dtype=HEADER_DTYPE, mode='r+', shape=())
+        self.count = 0
+        self.records = None
+        self._grow(max(int(capacity), 1))
+
+    def _grow(self, capacity):
+        """Helper function: resize the file to hold "capacity" records and map the record region again"""
+        if self.records is not None:
+            self.records.flush()
+            del self.records
+        with open(self.path, 'r+b') as file:
+            file.truncate(self.offset + capacity*self.dtype.itemsize)
+        self.records = np.memmap(self.path, dtype=self.dtype, mode='r+', offset=self.offset, shape=(capacity,))
+        self.capacity = capacity
+        self.header['capacity'] = capacity
+
+    def append(self, values, policy_index, residual):
+        if self.count == self.capacity:
+            self._grow(2*self.capacity)
+        self.records['values'][self.count] = values
+        self.records['policy'][self.count] = policy_index
+        self.records['residual'][self.count] = residual
+        self.count += 1
+        self.header['count'] = self.count
+
+    def close(self):
+        """Flush the records and trim the preallocated space"""
+        if self.records is None:
+            return
+        self.records.flush()
+        self.header.flush()
+        del self.records
+        self.records = None
+        with open(self.path, 'r+b') as file:
+            file.truncate(self.offset + self.count*self.dtype.itemsize)
+        self.header['capacity'] = self.count
+        self.header.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryReader:
+    def __init__(self, path):
+        """
+        Read-only, memory-mapped view of a trajectory file written by "TrajectoryRecorder"
+            reader[i] --> record i (fields 'values', 'policy', 'residual'), len(reader) --> number of records
+        """
+        self.path = path
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError(f'{path} is not a trajectory file')
+        if header['version'] != VERSION:
+            raise ValueError(f"Unsupported trajectory file version {header['version']}")
+        self.xdim, self.ydim = int(header['xdim']), int(header['ydim'])
+        self.n_states, self.count = int(header['n_states']), int(header['count'])
+        n_actions = int(header['n_actions'])
+        self.states = np.fromfile(path, dtype='<i4', count=2*self.n_states, offset=HEADER_DTYPE.itemsize).reshape(-1, 2)
+        self.actions = [
+            tuple(int(c) for c in action)
+            for action in np.fromfile(
+                path, dtype='<i4', count=2*n_actions, offset=HEADER_DTYPE.itemsize + 8*self.n_states
+            ).reshape(-1, 2)
+        ]
+        self.action_names = [
+            name.decode() for name in np.fromfile(
+                path, dtype=NAME_DTYPE, count=n_actions, offset=HEADER_DTYPE.itemsize + 8*self.n_states + 8*n_actions
+            )
+        ]
+        offset = HEADER_DTYPE.itemsize + 8*self.n_states + (8 + NAME_DTYPE.itemsize)*n_actions
+        self.records = np.memmap(path, dtype=record_dtype(self.n_states), mode='r', offset=offset, shape=(self.count,)) \
+            if self.count else np.empty(0, dtype=record_dtype(self.n_states))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def env(self):
+        """
+        Return a "GridWorld" with the recorded layout (blocked cells and end states) and action set
+        (rewards, controller reliability and slip kernel are not recorded, the defaults are used)
+        """
+        valid = {tuple(int(c) for c in state) for state in self.states}
+        blocked = [(i, j) for j in range(1, self.ydim+1) for i in range(1, self.xdim+1) if (i, j) not in valid]
+        end_states = [tuple(int(c) for c in state) for state in self.states[self.records[0]['policy'] < 0]] if self.count else []
+        return GridWorld(self.xdim, self.ydim, blocked, end_states, actions=dict(zip(self.actions, self.action_names)))
+
+    def snapshots(self, start=0, stop=None, step=1):
+        """
+        Yield records start:stop:step as snapshots for "Animation" (see animator.take_snapshot), labelled by iteration
+        Only one record at a time is read from disk
+        """
+        from animator import BLOCKED
+        cells = (self.states[:, 1]-1, self.states[:, 0]-1)
+        for i in range(*slice(start, stop, step).indices(self.count)):
+            record = self.records[i]
+            values = np.full((self.ydim, self.xdim), np.nan, dtype=np.float32)
+            actions = np.full((self.ydim, self.xdim), BLOCKED, dtype=np.int8)
+            values[cells] = record['values']
+            actions[cells] = record['policy']
+            yield f'Iter: {i+1} | Residual: {record["residual"]:.2e}', values, actions
+
+    def export(self, path, start=0, stop=None, step=1):
+        """Write records start:stop:step into a new trajectory file (same layout), one record at a time"""
+        indices = range(*slice(start, stop, step).indices(self.count))
+        header_size = HEADER_DTYPE.itemsize + 8*self.n_states + (8 + NAME_DTYPE.itemsize)*len(self.actions)
+        with open(self.path, 'rb') as source, open(path, 'wb') as target:
+            target.write(source.read(header_size))
+            for i in indices:
+                target.write(self.records[i].tobytes())
+        header = np.memmap(path, dtype=HEADER_DTYPE, mode='r+', shape=())
+        header['count'] = header['capacity'] = len(indices)
+        header.flush()
+        return len(indices)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect, replay or export recorded solver trajectories')
+    parser.add_argument('command', choices=['info', 'replay', 'export'])
+    parser.add_argument('path', help='trajectory file written by TrajectoryRecorder')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stop', type=int, default=None)
+    parser.add_argument('--step', type=int, default=1)
+    parser.add_argument('--out', help="gif name (replay, without extension) or trajectory file (export)")
+    parser.add_argument('--fps', type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    reader = TrajectoryReader(args.path)
+    if args.command == 'info':
+        print(f'{args.path}: {reader.xdim}x{reader.ydim} grid, {reader.n_states} states, {len(reader)} records')
+        if len(reader):
+            print(f"Residual: first {reader[0]['residual']:.3e} | last {reader[len(reader)-1]['residual']:.3e}")
+    elif args.command == 'replay':
+        from animator import Animation
+        out = args.out or os.path.splitext(args.path)[0]
+        snapshots = reader.snapshots(args.start, args.stop, args.step)
+        Animation(reader.env(), None, None, out, snapshots=snapshots).animate(fps=args.fps)
+        print(f'*** Replay saved to {out}.gif ***')
+    else:
+        if not args.out:
+            parser.error('export needs --out')
+        count = reader.export(args.out, args.start, args.stop, args.step)
+        print(f'*** Exported {count} records to {args.out} ***')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+from grid_world import GridWorld
+from mario import Mario
+from iter_schemes import Iter
+import argparse
+import statistics
+import time
+import numpy as np
+
+PERCENTILES = (5, 25, 50, 75, 95) # percentiles of the returns and episode lengths in the report
+
+
+class RolloutEvaluator:
+    def __init__(self, env, agent, start=None, max_episode_steps=1000, batch_size=100000, seed=None):
+        """
+        Monte Carlo evaluation of agent "Mario"'s policy under the slip dynamics of env, many episodes stepped at once
+        Arguments:
+            env: object of class "GridWorld" (its compiled model and rewards are read once, at construction)
+            agent: object of class "Mario", its policy and state values are read once, at construction (gamma discounts the returns)
+            start: start distribution of the episodes:
+                None: uniform over the non-terminal states
+                state (as tuple): every episode starts there
+                list of states: uniform over them
+                {key = state: value = weight}: proportional to the weights
+            max_episode_steps: episodes still running after this many steps are cut (truncated, partial return)
+            batch_size: episodes stepped at once (memory is a few arrays of this size)
+            seed: seed of the random generator (None for a random seed)
+        Every step samples the transitions of all running episodes with one "TransitionModel.sample" call, episodes
+        ending in an end state (or in the missing probability mass, see "GridWorld.step") drop out of the batch
+        """
+        self.env = env
+        self.agent = agent
+        self.model = env.model
+        self.rewards = env.reward_vector()
+        self.max_episode_steps = max_episode_steps
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        # the agent's policy and values as (S,) arrays, in the order of the model states
+        self.values, self.policy_index = Iter(env, agent, quiet=True).read_agent()
+        self.starts, self.start_probs = self.start_distribution(start)
+        # results of the last "run", one entry per episode
+        self.start_states = None # (N,) start state indices
+        self.returns = None # (N,) discounted returns
+        self.lengths = None # (N,) steps taken
+        self.truncated = None # (N,) bool, cut after max_episode_steps
+        self.wall_time = 0.0
+
+    def start_distribution(self, start):
+        """Helper function: (start state indices, probabilities) of a start distribution, see the constructor"""
+        model = self.model
+        if start is None:
+            starts = np.flatnonzero(~model.terminal)
+            weights = np.ones(len(starts))
+        else:
+            if isinstance(start, tuple):
+                start = [start]
+            if not isinstance(start, dict):
+                start = {tuple(state): 1.0 for state in start}
+            missing = [state for state in start if tuple(state) not in model.index]
+            if missing:
+                raise ValueError(f'Start states {missing} are not valid states')
+            starts = np.array([model.index[tuple(state)] for state in start], dtype=np.int64)
+            weights = np.array(list(start.values()), dtype=np.float64)
+        if len(starts) == 0 or weights.sum() <= 0:
+            raise ValueError('Episodes need a start state with positive weight')
+        return starts, weights / weights.sum()
+
+    def rollout(self, start_states):
+        """
+        Run one episode from every start state (state indices) under the policy
+        Return ((N,) discounted returns, (N,) lengths, (N,) truncated)
+        """
+        model = self.model
+        A = model.n_actions
+        gamma = self.agent.gamma
+        n = len(start_states)
+        returns = np.zeros(n)
+        lengths = np.zeros(n, dtype=np.int64)
+        truncated = np.zeros(n, dtype=bool)
+        # running episodes: their ids and current states, compacted every step
+        running = np.flatnonzero(~model.terminal[start_states])
+        states = start_states[running]
+        discount = 1.0
+        for step in range(self.max_episode_steps):
+            if not len(running):
+                break
+            next_states = model.sample(states*A + self.policy_index[states], self.rng.random(len(running)))
+            lost = next_states < 0
+            returns[running] += discount * np.where(lost, 0.0, self.rewards[np.maximum(next_states, 0)])
+            lengths[running] += 1
+            discount *= gamma
+            going = ~lost & ~model.terminal[np.maximum(next_states, 0)]
+            running, states = running[going], next_states[going]
+        truncated[running] = True
+        return returns, lengths, truncated
+
+    def run(self, n_episodes):
+        """
+        Run n_episodes episodes from the start distribution, in batches of batch_size
+        The results are kept per episode (start_states, returns, lengths, truncated), see "report"
+        """
+        start = time.perf_counter()
+        self.start_states = self.rng.choice(self.starts, size=n_episodes, p=self.start_probs)
+        self.returns = np.empty(n_episodes)
+        self.lengths = np.empty(n_episodes, dtype=np.int64)
+        self.truncated = np.empty(n_episodes, dtype=bool)
+        for lo in range(0, n_episodes, self.batch_size):
+            hi = min(lo + self.batch_size, n_episodes)
+            self.returns[lo:hi], self.lengths[lo:hi], self.truncated[lo:hi] = self.rollout(self.start_states[lo:hi])
+        self.wall_time = time.perf_counter() - start
+        return self.report()
+
+    def predicted(self):
+        """Expected return of the start distribution according to the agent's state values (e.g. written by "Iter")"""
+        return float(self.start_probs @ self.values[self.starts])
+
+    def report(self, confidence=0.95):
+        """
+        Summary of the last "run":
+            episodes, steps, wall_time, steps_per_second
+            mean_return, std_return, ci_low, ci_high: normal confidence interval of the mean return at the given level
+            return_percentiles, length_percentiles: {percentile: value} (see PERCENTILES), mean_length, max_length
+            truncated: fraction of the episodes cut after max_episode_steps
+            predicted: expected return from the agent's state values, error: mean_return - predicted,
+            z_score: error in standard errors, within_ci: predicted lies in the confidence interval
+        """
+        n = len(self.returns)
+        mean = float(self.returns.mean())
+        std = float(self.returns.std(ddof=1)) if n > 1 else 0.0
+        half_width = statistics.NormalDist().inv_cdf(0.5 + confidence/2) * std / np.sqrt(n)
+        predicted = self.predicted()
+        steps = int(self.lengths.sum())
+        return {
+            'episodes': n, 'steps': steps, 'wall_time': self.wall_time,
+            'steps_per_second': steps / self.wall_time if self.wall_time > 0 else 0.0,
+            'mean_return': mean, 'std_return': std, 'ci_low': mean - half_width, 'ci_high': mean + half_width,
+            'return_percentiles': dict(zip(PERCENTILES, np.percentile(self.returns, PERCENTILES).tolist())),
+            'mean_length': float(self.lengths.mean()), 'max_length': int(self.lengths.max()),
+            'length_percentiles': dict(zip(PERCENTILES, np.percentile(self.lengths, PERCENTILES).tolist())),
+            'truncated': float(self.truncated.mean()),
+            'predicted': predicted, 'error': mean - predicted,
+            'z_score': (mean - predicted) / (std / np.sqrt(n)) if std > 0 else 0.0,
+            'within_ci': mean - half_width <= predicted <= mean + half_width,
+        }
+
+    def histogram(self, bins=20):
+        """Return (counts, bin edges) of the returns of the last "run" (numpy.histogram)"""
+        return np.histogram(self.returns, bins=bins)
+
+    def per_start(self):
+        """
+        Mean return of the last "run" per start state, next to the agent's value of that state
+        Returns {key = state: value = (episodes, mean return, state value)}
+        """
+        counts = np.bincount(self.start_states, minlength=self.model.n_states)
+        totals = np.bincount(self.start_states, weights=self.returns, minlength=self.model.n_states)
+        return {
+            self.model.valid_states[s]: (int(counts[s]), float(totals[s] / counts[s]), float(self.values[s]))
+            for s in np.flatnonzero(counts).tolist()
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Solve a gridworld, then evaluate the optimal policy by Monte Carlo rollouts")
+    parser.add_argument('--map', default=None, help='ASCII or PNG map (see maps.py), default: the default GridWorld')
+    parser.add_argument('--episodes', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=100000)
+    parser.add_argument('--max-episode-steps', type=int, default=1000)
+    parser.add_argument('--start', default=None, help='start state "x,y" (default: uniform over the non-terminal states)')
+    parser.add_argument('--controller-reliability', type=float, default=0.8)
+    parser.add_argument('--gamma', type=float, default=0.9)
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.map is None:
+        env = GridWorld(controller_reliability=args.controller_reliability)
+    else:
+        from maps import load_map
+        env = load_map(args.map, args.controller_reliability)
+    agent = Mario(env=env, gamma=args.gamma)
+    learn = Iter(env=env, agent=agent, quiet=True)
+    for _ in learn.by_value_iter():
+        pass
+    start = tuple(int(n) for n in args.start.split(',')) if args.start else None
+    evaluator = RolloutEvaluator(env, agent, start, args.max_episode_steps, args.batch_size, args.seed)
+    evaluator.run(args.episodes)
+    report = evaluator.report(args.confidence)
+    print(
+        f"*** {report['episodes']} episodes, {report['steps']} steps in {report['wall_time']:.2f}s "
+        f"({report['steps_per_second']:.0f} steps/s) ***"
+    )
+    print(
+        f"return {report['mean_return']:+.5f} +- {report['std_return']:.4f} | "
+        f"{100*args.confidence:.0f}% CI [{report['ci_low']:+.5f}, {report['ci_high']:+.5f}] | "
+        f"value iteration {report['predicted']:+.5f} ({'inside' if report['within_ci'] else 'outside'} the CI, "
+        f"z = {report['z_score']:+.2f})"
+    )
+    print('return percentiles: ' + ' | '.join(f'{p}%: {v:+.4f}' for p, v in report['return_percentiles'].items()))
+    print(
+        f"episode length: mean {report['mean_length']:.2f}, max {report['max_length']}, "
+        f"{100*report['truncated']:.3f}% truncated | " + ' | '.join(f'{p}%: {v:.0f}' for p, v in report['length_percentiles'].items())
+    )
+
+
+if __name__ == "__main__":
+    main()
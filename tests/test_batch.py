@@ -0,0 +1,38 @@
+import json
+import os
+
+import numpy as np
+
+from batch import load_results, make_chunks, normalize_config, solve_batch
+from grid_world import GridWorld
+from iter_schemes import Iter
+from mario import Mario
+
+# slip only to the right of the intended move, twice as often as straight back
+SLIP = {(1,0): 2.0, (0,-1): 1.0}
+
+
+def test_batch_with_custom_slip_kernel(tmp_path):
+    configs = [
+        {'slip': SLIP, 'controller_reliability': 0.7},
+        {'slip': [[move, weight] for move, weight in SLIP.items()], 'controller_reliability': 0.9},
+        {'controller_reliability': 0.8},
+    ]
+    # dict and list kernels share one topology, the named default gets its own
+    assert len(make_chunks([normalize_config(config) for config in configs], 16)) == 2
+    path = str(tmp_path / 'results')
+    assert solve_batch(configs, path, max_workers=1) == 3
+
+    results = load_results(path)
+    offsets = results['offsets']
+    for row, index in enumerate(results['index']):
+        env = GridWorld(controller_reliability=configs[index]['controller_reliability'], slip=SLIP if index < 2 else 'perpendicular')
+        learn = Iter(env=env, agent=Mario(env=env), write_back=False, quiet=True)
+        for _ in learn.by_value_iter():
+            pass
+        assert np.allclose(results['values'][offsets[row]:offsets[row+1]], learn.values)
+
+    # configs.json round-trips through "normalize_config"
+    with open(os.path.join(path, 'configs.json')) as file:
+        saved = json.load(file)
+    assert [normalize_config(config) for config in saved] == [normalize_config(config) for config in configs]
@@ -0,0 +1,41 @@
+import pytest
+
+from grid_world import GridWorld
+from iter_schemes import Iter
+from mario import Mario
+
+
+def solve(env, method, kwargs, warm_start=None, cold_reference=False):
+    learn = Iter(env=env, agent=Mario(env=env), quiet=True)
+    for _ in getattr(learn, method)(warm_start=warm_start, cold_reference=cold_reference, **kwargs):
+        pass
+    return learn
+
+
+@pytest.mark.parametrize('method, kwargs', [('by_value_iter', {}), ('by_policy_iter', {'evaluation': 'exact'})])
+def test_cold_reference_reports_sweeps_saved_after_a_change(tmp_path, method, kwargs):
+    env = GridWorld()
+    path = str(tmp_path / 'solution.npz')
+    solve(env, method, kwargs).save_checkpoint(path)
+    env.update_reward((1,1), -0.04)
+
+    without = solve(env, method, kwargs, warm_start=path)
+    assert not without.warm_start_report['same_problem']
+    assert without.warm_start_report['sweeps_saved'] is None
+
+    learn = solve(env, method, kwargs, warm_start=path, cold_reference=True)
+    report = learn.warm_start_report
+    cold = solve(env, method, kwargs).iterations
+    assert report['cold_sweeps'] == learn.cold_sweeps == cold
+    assert report['sweeps_saved'] == cold - report['sweeps']
+    assert report['previous_cold_sweeps'] is not None
+
+
+def test_cold_reference_is_skipped_for_the_same_problem(tmp_path):
+    env = GridWorld()
+    path = str(tmp_path / 'solution.npz')
+    first = solve(env, 'by_value_iter', {})
+    first.save_checkpoint(path)
+    learn = solve(env, 'by_value_iter', {}, warm_start=path, cold_reference=True)
+    assert learn.warm_start_report['same_problem']
+    assert learn.warm_start_report['cold_sweeps'] == first.iterations
@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+from benchmark import COLD_STARTS, HEAVY_MODULES, cold_start, heavy_imports
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET = 1.0 # seconds, median of a few fresh interpreters (same default as "benchmark.py coldstart")
+
+
+def test_import_main_within_budget():
+    times = cold_start(COLD_STARTS['import_main'], repeats=3)
+    assert times[len(times) // 2] < BUDGET
+
+
+def test_import_main_skips_heavy_modules():
+    code = f'import sys, main; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    assert output.strip() == ''
+
+
+def test_headless_solve_skips_heavy_modules():
+    assert heavy_imports() == []
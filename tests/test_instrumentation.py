@@ -0,0 +1,45 @@
+import pytest
+
+from grid_world import GridWorld
+from instrumentation import Instrumentation
+from iter_schemes import Iter
+from mario import Mario
+from parallel import SweepExecutor
+
+# every sweep path of the 'numpy' backend: (method, keyword arguments)
+SWEEP_PATHS = [
+    ('by_value_iter', {}),
+    ('by_value_iter', {'sweep': 'gauss_seidel'}),
+    ('by_value_iter', {'sweep': 'prioritized'}),
+    ('by_value_iter', {'parallel': True}),
+    ('by_policy_iter', {}),
+    ('by_policy_iter', {'evaluation': 'exact', 'linear_solver': 'bicgstab'}),
+    ('by_policy_iter', {'evaluation': 'modified'}),
+]
+
+
+def solve(method, kwargs):
+    env = GridWorld(5, 4, blocked_states=[(2,2)], end_states=[(5,4),(5,3)])
+    instrument = Instrumentation()
+    kwargs = dict(kwargs)
+    executor = SweepExecutor(2) if kwargs.pop('parallel', False) else None
+    learn = Iter(env=env, agent=Mario(env=env), instrument=instrument, quiet=True, executor=executor)
+    for _ in getattr(learn, method)(**kwargs):
+        pass
+    return learn, instrument.summary()
+
+
+@pytest.mark.parametrize('method, kwargs', SWEEP_PATHS)
+def test_every_sweep_path_counts_transition_lookups(method, kwargs):
+    learn, summary = solve(method, kwargs)
+    assert summary['sweeps'] > 0
+    assert summary['transition_lookups'] > 0
+
+
+def test_parallel_sweeps_count_like_serial_ones():
+    serial, serial_summary = solve('by_value_iter', {})
+    parallel, parallel_summary = solve('by_value_iter', {'parallel': True})
+    model = serial.model
+    assert parallel_summary['sweeps'] == serial_summary['sweeps']
+    assert serial_summary['transition_lookups'] == serial_summary['sweeps'] * model.n_states * model.n_actions
+    assert parallel_summary['transition_lookups'] == serial_summary['transition_lookups']
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from grid_world import GridWorld
+from iter_schemes import Iter
+from mario import Mario
+
+# every solver of "Iter": (backend, method, keyword arguments)
+SOLVERS = [
+    ('numpy', 'by_value_iter', {}),
+    ('numpy', 'by_value_iter', {'sweep': 'gauss_seidel'}),
+    ('numpy', 'by_value_iter', {'sweep': 'prioritized'}),
+    ('numpy', 'by_policy_iter', {}),
+    ('numpy', 'by_policy_iter', {'evaluation': 'exact'}),
+    ('numpy', 'by_policy_iter', {'evaluation': 'modified'}),
+    ('dict', 'by_value_iter', {}),
+    ('dict', 'by_policy_iter', {}),
+]
+MUTATORS = {
+    'remove_blocked': lambda env: env.remove_blocked([(2,2)]),
+    'add_blocked': lambda env: env.add_blocked([(2,1)]),
+    'set_end_state': lambda env: env.set_end_state((1,3), reward=0.5),
+    'unset_end_state': lambda env: env.set_end_state((4,2), end=False),
+    'update_reward': lambda env: env.update_reward((1,1), 0.2),
+}
+
+
+def solve(env, agent, backend, method, kwargs):
+    learn = Iter(env=env, agent=agent, backend=backend, quiet=True)
+    for _ in getattr(learn, method)(**kwargs):
+        pass
+    return learn
+
+
+@pytest.mark.parametrize('storage', ['dict', 'array'])
+@pytest.mark.parametrize('mutator', list(MUTATORS))
+@pytest.mark.parametrize('backend, method, kwargs', SOLVERS)
+def test_solvers_run_after_mutator(storage, mutator, backend, method, kwargs):
+    env = GridWorld()
+    agent = Mario(env=env, storage=storage)
+    solve(env, agent, backend, method, kwargs)
+    MUTATORS[mutator](env)
+    solve(env, agent, backend, method, kwargs)
+    # the agent's views follow the new layout and match a solve from scratch
+    assert sorted(agent.state_values) == sorted(env.valid_states)
+    assert sorted(agent.policy) == sorted(env.valid_states)
+    fresh = Mario(env=env, storage=storage)
+    solve(env, fresh, 'numpy', 'by_value_iter', {})
+    values = np.array([agent.state_values[state] for state in env.valid_states])
+    expected = np.array([fresh.state_values[state] for state in env.valid_states])
+    assert np.abs(values - expected).max() < 1e-4
+    for state in env.valid_states:
+        assert (agent.policy[state][1] == 'END') == (state in env.end_states)
@@ -0,0 +1,233 @@
+from grid_world import ACTION_SETS, SLIP_KERNELS
+from mario import Mario
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+VERSION = 1
+# Tiled worlds use the default GridWorld dynamics: 4 neighbour actions and perpendicular slips (a one-cell halo)
+ACTION_SPACE = ACTION_SETS['4']
+SLIP = SLIP_KERNELS['perpendicular']
+# Arrays of a tiled world, all (ydim, xdim) with [y-1, x-1] indexing (same layout as Mario's 'array' storage)
+ARRAYS = {
+    'valid': (np.bool_, True), # False for blocked cells
+    'terminal': (np.bool_, False), # True for end states
+    'rewards': (np.float64, 0.0), # reward of entering a cell
+    'values': (np.float64, 0.0), # state values
+    'policy': (np.int8, 0), # action indices into ACTION_SPACE, -1 for END
+}
+
+
+class TiledWorld:
+    def __init__(self, path, mode='r+'):
+        """
+        Gridworld stored on disk for out-of-core solving: a directory of memory-mapped .npy arrays (see ARRAYS)
+        plus meta.json (xdim, ydim, controller_reliability). Nothing is held in memory but the pages being touched,
+        so maps can be larger than RAM. Create one with "create" (then fill the arrays slice by slice) or "from_gridworld"
+        Arguments:
+            path: directory written by "create"
+            mode: 'r+' (read/write) or 'r' (read only)
+        Transitions follow the default GridWorld: the intended move with probability controller_reliability, each
+        transverse move with half the rest, moves into blocked cells or off the grid stay in place
+        """
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        if meta['version'] != VERSION:
+            raise ValueError(f"Unsupported tiled world version {meta['version']}")
+        self.path = path
+        self.xdim = meta['xdim']
+        self.ydim = meta['ydim']
+        self.prob = meta['controller_reliability']
+        self.action_space = dict(ACTION_SPACE)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mode))
+
+    @classmethod
+    def create(cls, path, xdim, ydim, controller_reliability=0.8):
+        """Create an empty world in directory path: no blocked cells, no end states, zero rewards and values"""
+        os.makedirs(path, exist_ok=True)
+        for name, (dtype, fill) in ARRAYS.items():
+            array = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=(ydim, xdim))
+            array[...] = fill
+            array.flush()
+            del array
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump({'version': VERSION, 'xdim': xdim, 'ydim': ydim, 'controller_reliability': controller_reliability}, file)
+        return cls(path)
+
+    @classmethod
+    def from_gridworld(cls, path, env):
+        """Write object of class "GridWorld" env into a tiled world in directory path"""
+        if list(env.action_space.items()) != list(ACTION_SPACE.items()) or env.slip != SLIP:
+            raise ValueError('Tiled worlds use the default GridWorld actions and slip kernel')
+        world = cls.create(path, env.xdim, env.ydim, env.prob)
+        model = env.model
+        cells = (model.states[:, 1]-1, model.states[:, 0]-1)
+        world.valid[...] = model.grid_index >= 0
+        world.terminal[cells] = model.terminal
+        world.rewards[cells] = env.reward_vector()
+        world.policy[cells] = np.where(model.terminal, -1, 0)
+        world.flush()
+        return world
+
+    def tiles(self, tile):
+        """Yield the (y0, y1, x0, x1) bounds of tile x tile blocks covering the grid, row-major"""
+        for y0 in range(0, self.ydim, tile):
+            for x0 in range(0, self.xdim, tile):
+                yield y0, min(y0 + tile, self.ydim), x0, min(x0 + tile, self.xdim)
+
+    def halo(self, array, y0, y1, x0, x1, fill):
+        """Helper function: copy of array[y0:y1, x0:x1] with a one-cell halo, fill outside of the grid"""
+        out = np.full((y1 - y0 + 2, x1 - x0 + 2), fill, dtype=array.dtype)
+        ys, xs = max(y0 - 1, 0), max(x0 - 1, 0)
+        ye, xe = min(y1 + 1, self.ydim), min(x1 + 1, self.xdim)
+        out[ys-y0+1:ye-y0+1, xs-x0+1:xe-x0+1] = array[ys:ye, xs:xe]
+        return out
+
+    def agent(self, gamma=0.9):
+        """Return an agent "Mario" whose state_values and policy are views over the memory-mapped values and policy"""
+        return Mario.from_grids(self, self.values, self.policy, self.valid, gamma)
+
+    def flush(self):
+        for name in ARRAYS:
+            array = getattr(self, name)
+            if isinstance(array, np.memmap) and array.mode != 'r':
+                array.flush()
+
+
+class TiledSolver:
+    def __init__(self, world, gamma=0.9, tol=0.000001, tile=512, quiet=False):
+        """
+        Synchronous value iteration over a "TiledWorld", one tile at a time
+        Arguments:
+            world: object of class "TiledWorld" (values and policy are read from and written to its arrays)
+            gamma: discount
+            tol: sweeps stop when the largest change of a state value is under tol (as Iter.by_value_iter)
+            tile: side of the square tiles, resident memory is a few dozen tile-sized arrays
+            quiet: no per-iteration printing
+        Every tile reads its values with a one-cell halo from the previous sweep and writes the new values into a
+        scratch array (values_next.npy in the world directory), so a sweep is exactly a synchronous sweep of the whole
+        grid and the result matches Iter.by_value_iter(sweep='synchronous')
+        """
+        self.world = world
+        self.gamma = gamma
+        self.tolerance = tol
+        self.tile = tile
+        self.quiet = quiet
+        self.iterations = 0
+        self.backups = 0
+        self.wall_time = 0.0
+        path = os.path.join(world.path, 'values_next.npy')
+        if os.path.exists(path):
+            self.scratch = np.load(path, mmap_mode='r+')
+        else:
+            self.scratch = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(world.ydim, world.xdim))
+
+    def log(self, message):
+        """Helper function: print a progress message unless quiet"""
+        if not self.quiet:
+            print(message)
+
+    def backup_tile(self, values, y0, y1, x0, x1):
+        """
+        Helper function: Bellman backup of one tile from the values with a one-cell halo
+        Return ((h, w) new values, (h, w) greedy action indices, max change, number of live states)
+        """
+        world = self.world
+        valid = world.halo(world.valid, y0, y1, x0, x1, False)
+        target = world.halo(world.rewards, y0, y1, x0, x1, 0.0) + self.gamma * world.halo(values, y0, y1, x0, x1, 0.0)
+        terminal = world.terminal[y0:y1, x0:x1]
+        live = valid[1:-1, 1:-1] & ~terminal
+        h, w = y1 - y0, x1 - x0
+        here = target[1:-1, 1:-1]
+        Q_values = np.empty((len(world.action_space), h, w))
+        for a, (dx, dy) in enumerate(world.action_space):
+            # outcomes: intended move, then the two transverse moves (outcomes that stay in place add up)
+            outcomes = [((dx, dy), world.prob), ((dy, dx), 0.5*(1-world.prob)), ((-dy, -dx), 0.5*(1-world.prob))]
+            Q_values[a] = 0
+            for (ox, oy), prob in outcomes:
+                stays = ~valid[1+oy:1+oy+h, 1+ox:1+ox+w]
+                Q_values[a] += prob * np.where(stays, here, target[1+oy:1+oy+h, 1+ox:1+ox+w])
+        new_values = np.where(live, Q_values.max(axis=0), 0.0)
+        policy = np.where(terminal, -1, Q_values.argmax(axis=0)).astype(np.int8)
+        change = float(np.abs(new_values - values[y0:y1, x0:x1])[live].max()) if live.any() else 0.0
+        return new_values, policy, change, int(live.sum())
+
+    def sweep(self):
+        """One synchronous sweep over all tiles, return the largest change of a state value"""
+        world = self.world
+        change = 0.0
+        for y0, y1, x0, x1 in world.tiles(self.tile):
+            new_values, policy, tile_change, n_live = self.backup_tile(world.values, y0, y1, x0, x1)
+            self.scratch[y0:y1, x0:x1] = new_values
+            world.policy[y0:y1, x0:x1] = policy
+            change = max(change, tile_change)
+            self.backups += n_live
+        # the new values become the current ones (copied tile by tile, resident memory stays bounded)
+        for y0, y1, x0, x1 in world.tiles(self.tile):
+            world.values[y0:y1, x0:x1] = self.scratch[y0:y1, x0:x1]
+        return change
+
+    def solve(self, max_sweeps=None):
+        """Sweep until the change is under tol (or max_sweeps), flush the arrays and return the number of sweeps"""
+        self.iterations = self.backups = 0
+        start = time.perf_counter()
+        change = np.inf
+        while change > self.tolerance and (max_sweeps is None or self.iterations < max_sweeps):
+            change = self.sweep()
+            self.iterations += 1
+            self.log(f'--> Iteration {self.iterations} | change {change:.3e}')
+        self.world.flush()
+        self.wall_time = time.perf_counter() - start
+        return self.iterations
+
+
+def random_tiled_world(path, x, y, controller_reliability=0.8, blocked_fraction=0.1, n_end=2, tile=512, seed=0):
+    """
+    Create a x by y "TiledWorld" with random blocked cells and end states (first end state +1, the others -1)
+    and a small living penalty, generated tile by tile (same kind of map as benchmark.random_world, not the same cells)
+    """
+    world = TiledWorld.create(path, x, y, controller_reliability)
+    rng = np.random.default_rng(seed)
+    for y0, y1, x0, x1 in world.tiles(tile):
+        world.valid[y0:y1, x0:x1] = rng.random((y1 - y0, x1 - x0)) >= blocked_fraction
+        world.rewards[y0:y1, x0:x1] = -0.01
+    ends = [(int(rng.integers(x)), int(rng.integers(y))) for _ in range(n_end)]
+    for i, (ex, ey) in enumerate(ends):
+        world.valid[ey, ex] = True
+        world.terminal[ey, ex] = True
+        world.rewards[ey, ex] = 1.0 if i == 0 else -1.0
+        world.policy[ey, ex] = -1
+    world.flush()
+    return world
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Out-of-core value iteration over a tiled, memory-mapped gridworld')
+    parser.add_argument('path', help='tiled world directory')
+    parser.add_argument('--create', metavar='XxY', default=None, help='first create a random world of this size')
+    parser.add_argument('--controller-reliability', type=float, default=0.8)
+    parser.add_argument('--gamma', type=float, default=0.9)
+    parser.add_argument('--tol', type=float, default=0.000001)
+    parser.add_argument('--tile', type=int, default=512)
+    parser.add_argument('--max-sweeps', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+    if args.create:
+        x, y = (int(n) for n in args.create.lower().split('x'))
+        world = random_tiled_world(args.path, x, y, args.controller_reliability, tile=args.tile, seed=args.seed)
+    else:
+        world = TiledWorld(args.path)
+    solver = TiledSolver(world, args.gamma, args.tol, args.tile, args.quiet)
+    solver.solve(args.max_sweeps)
+    print(
+        f'*** {world.xdim}x{world.ydim}: {solver.iterations} sweeps in {solver.wall_time:.2f}s '
+        f'({solver.backups / max(solver.wall_time, 1e-12):.0f} backups/s), results in {args.path} ***'
+    )
+
+
+if __name__ == "__main__":
+    main()